@@ -0,0 +1,197 @@
+"""
+Mergeable summaries of a cohort by group, e.g. by exposure.
+
+Aggregates holds the number of patients in each group, the count of each
+category of some categorical columns per group, and the n, sum and sum of
+squares of some continuous columns per group. Summaries of disjoint sets
+of patients add up to the summary of their union, so a cohort can be
+summarised one chunk at a time (see chunked_pipeline.py). Counts and the
+sums of integer columns are exact; the sums of float columns are float64
+sums, which may differ from a single pass in the last bits.
+
+Missing values are never counted, as with `safecount if var == c`, and
+neither are rows whose group is missing.
+"""
+
+import os
+
+import numpy as np
+import pandas as pd
+
+MOMENTS = ["n", "sum", "sum_sq"]
+
+
+def _group_codes(df, by):
+    groups = df[by]
+    present = groups.notna().to_numpy()
+    codes, uniques = pd.factorize(groups[present], sort=True)
+    return present, codes, pd.Index(uniques, name=by)
+
+
+class Aggregates:
+    def __init__(self, sizes, counts, moments):
+        # Patients per group
+        self.sizes = sizes
+        # Indexed by (variable, category), a column per group
+        self.counts = counts
+        # Indexed by (variable, moment), a column per group
+        self.moments = moments
+
+    @classmethod
+    def of(cls, df, by, categorical=(), continuous=(), weights=None):
+        """
+        Summarise the columns of df by group of `by`. Every categorical
+        column is counted with one bincount over (category, group) codes.
+
+        With `weights` (a column of df), counts and moments are weighted as
+        frequency weights: each count is a sum of weights, and moment "n"
+        is the sum of the weights of the non-missing values, so that sd()
+        is as `tabstat [fw=weights]`. sizes stay numbers of patients.
+        """
+        present, group_codes, groups = _group_codes(df, by)
+        width = len(groups)
+        w = None if weights is None else df[weights][present].to_numpy("float64")
+        sizes = pd.Series(
+            np.bincount(group_codes, minlength=width), index=groups, name="N"
+        )
+
+        counts = []
+        for name in categorical:
+            # Every category in the column, as levelsof lists them, even if
+            # only found where the group is missing
+            codes, categories = _category_codes(df[name])
+            if not present.all():
+                codes = codes[present]
+            # Missing values (code -1) are counted in a first row, dropped
+            cells = np.bincount(
+                (codes + 1) * width + group_codes,
+                weights=w,
+                minlength=(len(categories) + 1) * width,
+            ).reshape(len(categories) + 1, width)[1:]
+            index = pd.MultiIndex.from_product(
+                [[name], categories], names=["variable", "category"]
+            )
+            counts.append(pd.DataFrame(cells, index=index, columns=groups))
+
+        moments = []
+        for name in continuous:
+            values = df[name][present].to_numpy()
+            found = ~pd.isna(values)
+            values = values[found]
+            dtype = "int64" if values.dtype.kind in "iub" and w is None else "float64"
+            values = values.astype(dtype)
+            codes = group_codes[found]
+            if w is None:
+                rows = [
+                    np.bincount(codes, minlength=width),
+                    _sum_by(codes, values, width),
+                    _sum_by(codes, values * values, width),
+                ]
+            else:
+                weighted = w[found] * values
+                rows = [
+                    np.bincount(codes, weights=w[found], minlength=width),
+                    np.bincount(codes, weights=weighted, minlength=width),
+                    np.bincount(codes, weights=weighted * values, minlength=width),
+                ]
+            index = pd.MultiIndex.from_product(
+                [[name], MOMENTS], names=["variable", "moment"]
+            )
+            moments.append(pd.DataFrame(rows, index=index, columns=groups))
+
+        return cls(
+            sizes,
+            _concat(counts, ["variable", "category"], groups),
+            _concat(moments, ["variable", "moment"], groups),
+        )
+
+    def __add__(self, other):
+        return Aggregates(
+            self.sizes.add(other.sizes, fill_value=0).astype("int64"),
+            _add(self.counts, other.counts),
+            _add(self.moments, other.moments),
+        )
+
+    def __radd__(self, other):
+        # So that sum() of a list of Aggregates works
+        return self if other == 0 else self + other
+
+    def mean(self):
+        """Mean of each continuous column by group."""
+        n, total = self._moment("n"), self._moment("sum")
+        return total / n.where(n > 0)
+
+    def sd(self):
+        """Sample standard deviation of each continuous column by group."""
+        n, total = self._moment("n"), self._moment("sum")
+        sum_sq = self._moment("sum_sq")
+        variance = (sum_sq - total * total / n.where(n > 0)) / (n - 1).where(n > 1)
+        return np.sqrt(variance.clip(lower=0))
+
+    def _moment(self, moment):
+        return self.moments.xs(moment, level="moment").astype("float64")
+
+    def write(self, directory):
+        """Write sizes.csv, counts.csv and moments.csv to directory."""
+        for name, frame in [
+            ("sizes", self.sizes.to_frame().T),
+            ("counts", self.counts),
+            ("moments", self.moments),
+        ]:
+            frame.to_csv(os.path.join(directory, f"{name}.csv"))
+
+
+def _category_codes(series):
+    """
+    The code of each value in the sorted categories of a column (-1 where
+    missing), and the categories. Integer columns of a narrow range, such
+    as flags and categorised variables, are coded by offset, which is
+    cheaper than factorising.
+    """
+    values = series.to_numpy()
+    if values.dtype.kind in "iu" and len(values):
+        low, high = int(values.min()), int(values.max())
+        if high - low < max(len(values), 256):
+            offsets = values.astype("int64") - low
+            seen = np.bincount(offsets, minlength=high - low + 1) > 0
+            categories = pd.Index(np.flatnonzero(seen) + low)
+            if seen.all():
+                return offsets, categories
+            return (np.cumsum(seen) - 1)[offsets], categories
+    return pd.factorize(series, sort=True)
+
+
+def _sum_by(codes, values, width):
+    sums = np.bincount(codes, weights=values, minlength=width)
+    if values.dtype.kind == "i":
+        # bincount sums in float64, which is exact for integers up to 2**53
+        if np.abs(values).sum(dtype="float64") >= 2**53:
+            raise OverflowError("Integer sums are too large to be exact")
+        return sums.astype("int64")
+    return sums
+
+
+def _concat(frames, names, groups):
+    if frames:
+        return pd.concat(frames)
+    index = pd.MultiIndex.from_tuples([], names=names)
+    return pd.DataFrame(index=index, columns=groups, dtype="int64")
+
+
+def _add(a, b):
+    # Variables stay in the order they were summarised in, with the union
+    # of their categories sorted as Aggregates.of sorts them
+    index = a.index.append(b.index).unique()
+    columns = a.columns.append(b.columns).unique().sort_values()
+    total = a.reindex(index=index, columns=columns, fill_value=0) + b.reindex(
+        index=index, columns=columns, fill_value=0
+    )
+    variables = index.get_level_values(0).unique()
+    rank = dict(zip(variables, range(len(variables))))
+    total = total.sort_index(
+        key=lambda level: level.map(rank) if level.name == index.names[0] else level
+    )
+    integer = all(
+        frame[column].dtype.kind == "i" for frame in [a, b] for column in frame
+    )
+    return total.astype("int64") if integer else total
@@ -0,0 +1,522 @@
+"""
+Benchmark of the local extractor against synthetic event tables.
+
+generate_tables writes a synthetic copy of every table in event_tables.py,
+sized by its number of clinical event rows (1M to 50M is a useful range),
+with the other tables in proportion (ROWS_PER_PATIENT). Codes are drawn
+from the codelists the study definition uses (most of which are read from
+the CSVs in codelists/), each codelist's codes following a Zipf law so
+that a few codes dominate as they do in practice, mixed with codes which
+are in no codelist. Rows are drawn in chunks from `default_rng([seed,
+table, chunk])` and written as feather (Arrow IPC) files, which
+EventTables.from_directory reads: these stand in for the backend database.
+
+The tables are kept under BENCHMARK_DIR, named by their size, seed and
+GENERATOR_VERSION, so runs at different commits measure the same data and
+only the first one pays for generating it (in a separate process, so that
+it does not count towards the benchmark's peak memory).
+
+run_benchmark loads the tables and runs study_definition.py through a
+staged LocalExtractor with an ExtractionProfile, and writes a report to
+logs/benchmark-<rows>-<commit>-<time>.json with the time of each stage
+(loading, each extraction stage, building the output frame), the time,
+rows and memory of each variable, the process's peak resident memory and
+the commit, library versions and machine it ran on. With several repeats
+each stage reports its fastest run. `compare` sets two reports side by
+side.
+
+Run from the root of the repository:
+
+    python analysis/benchmark.py [clinical event rows] [workers] [repeats] [seed]
+    python analysis/benchmark.py compare <baseline report> <report>
+"""
+
+import json
+import os
+import platform
+import resource
+import string
+import subprocess
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+
+from dummy_data import MAX_AGE, population_age_weights
+from event_tables import OPEN_DATE, TABLES, EventTables, to_day
+from extraction_plan import EVENT_PATIENT_QUERIES, EVENT_QUERIES
+from extraction_profile import LOG_DIR, ExtractionProfile
+from local_extractor import LocalExtractor
+from prefix_index import SEPARATOR
+
+BENCHMARK_DIR = os.path.join("output", ".benchmark")
+
+# Bump when a change here alters the tables generated
+GENERATOR_VERSION = 1
+
+CHUNK_SIZE = 1_000_000
+
+# The study's start_date, around which ages and registrations are drawn
+INDEX_DATE = "2020-09-01"
+
+# Rows of each event table per patient (deaths are at most one each)
+ROWS_PER_PATIENT = {
+    "clinical_events": 40,
+    "medications": 20,
+    "admissions": 0.3,
+    "ons_deaths": 0.02,
+    "sgss_tests": 0.5,
+}
+
+# Range of the dates in each event table
+EVENT_DATES = {
+    "clinical_events": ("2000-01-01", "2021-06-30"),
+    "medications": ("2015-01-01", "2021-06-30"),
+    "admissions": ("2015-01-01", "2021-06-30"),
+    "ons_deaths": ("2020-01-01", "2021-06-30"),
+    "sgss_tests": ("2020-02-01", "2021-06-30"),
+}
+
+# Share of rows whose code is from one of the study's codelists
+CODELIST_SHARE = {
+    "clinical_events": 0.3,
+    "medications": 0.5,
+    "admissions": 0.3,
+    "ons_deaths": 0.3,
+}
+
+# Number of distinct codes in no codelist, per table
+NOISE_CODES = 20_000
+ZIPF_EXPONENT = 1.1
+
+REGIONS = [
+    "East",
+    "East Midlands",
+    "London",
+    "North East",
+    "North West",
+    "South East",
+    "South West",
+    "West Midlands",
+    "Yorkshire and The Humber",
+]
+
+# Deprivation ranks run from 1 to the number of LSOAs in England
+IMD_RANKS = 32_844
+POSITIVE_TEST_SHARE = 0.1
+
+# Largest number of codes in one admission's diagnoses, or one death's causes
+MAX_FIELD_CODES = 3
+
+
+def plain_codes(codes):
+    """The codes of a codelist, without categories."""
+    if getattr(codes, "has_categories", False):
+        return [code for code, category in codes]
+    return [str(code) for code in codes]
+
+
+def study_codelists(covariate_definitions):
+    """The distinct codelists matched against each event table."""
+    codelists = {table: [] for table in CODELIST_SHARE}
+    for query_type, arguments in covariate_definitions.values():
+        table = EVENT_QUERIES.get(query_type) or EVENT_PATIENT_QUERIES.get(query_type)
+        codes = arguments.get("with_these_diagnoses", arguments.get("codelist"))
+        if table not in codelists or not codes:
+            continue
+        codes = sorted(set(plain_codes(codes)))
+        if codes not in codelists[table]:
+            codelists[table].append(codes)
+    return codelists
+
+
+def noise_codes(table, rng, n=NOISE_CODES):
+    """Codes of the table's coding system, made up, for rows in no codelist."""
+    if table == "medications":
+        # dm+d identifiers are 6 to 18 digit numbers
+        codes = rng.integers(10**8, 10**16, n).astype(str)
+    elif table in ("admissions", "ons_deaths"):
+        letters = np.array(list("ABCDEFGHIJKLMNOPQRSTVWXYZ"))[rng.integers(0, 25, n)]
+        digits = rng.integers(0, 1000, n).astype(str)
+        codes = np.char.add(letters, np.char.zfill(digits, 3))
+    else:
+        # CTV3 codes are five characters
+        alphabet = np.array(list(string.digits + string.ascii_letters))
+        characters = alphabet[rng.integers(0, len(alphabet), (n, 5))]
+        codes = np.array(["".join(row) for row in characters])
+    return list(np.unique(codes))
+
+
+def zipf(n, rng):
+    """Zipf weights of n codes, in a random order."""
+    weights = 1 / np.arange(1, n + 1) ** ZIPF_EXPONENT
+    return rng.permutation(weights / weights.sum())
+
+
+class CodePool:
+    """The codes drawn for one table, and their probabilities."""
+
+    def __init__(self, table, codelists, rng):
+        noise = noise_codes(table, rng)
+        share = CODELIST_SHARE[table] if codelists else 0.0
+        codes, p = list(noise), [(1 - share) * zipf(len(noise), rng)]
+        for codelist in codelists:
+            codes += codelist
+            p.append(share / len(codelists) * zipf(len(codelist), rng))
+        self.codes = pa.array(codes, type=pa.string())
+        self.cdf = np.cumsum(np.concatenate(p))
+        self.cdf /= self.cdf[-1]
+
+    def draw(self, rng, n):
+        indices = np.searchsorted(self.cdf, rng.random(n), side="right")
+        return self.codes.take(pa.array(np.minimum(indices, len(self.codes) - 1)))
+
+    def draw_fields(self, rng, n, first=None):
+        """
+        n "||"-separated fields of 1 to MAX_FIELD_CODES codes, the first of
+        which are `first` if given.
+        """
+        counts = rng.integers(1, MAX_FIELD_CODES + 1, n)
+        columns = [self.draw(rng, n) if first is None else first]
+        for j in range(1, MAX_FIELD_CODES):
+            columns.append(pc.if_else(pa.array(counts > j), self.draw(rng, n), None))
+        return pc.binary_join_element_wise(*columns, SEPARATOR, null_handling="skip")
+
+
+def to_timestamps(days, missing=None):
+    """Day numbers as an Arrow timestamp array, as the backend holds dates."""
+    seconds = np.asarray(days, dtype="int64") * 86400
+    return pa.array(seconds, type=pa.timestamp("s"), mask=missing)
+
+
+def uniform_days(rng, n, start, end):
+    return rng.integers(to_day(start), to_day(end) + 1, n)
+
+
+def write_table(path, batches):
+    """
+    Write Arrow tables to a feather file, via a temporary file; returns the
+    number of rows written.
+    """
+    writer = None
+    temporary = f"{path}.partial"
+    rows = 0
+    try:
+        for batch in batches:
+            if writer is None:
+                writer = pa.ipc.new_file(temporary, batch.schema)
+            writer.write_table(batch)
+            rows += batch.num_rows
+    finally:
+        if writer is not None:
+            writer.close()
+    os.replace(temporary, path)
+    return rows
+
+
+def chunks(rng_key, rows):
+    """(generator, first row, rows) for each chunk of a table of `rows` rows."""
+    for number, start in enumerate(range(0, rows, CHUNK_SIZE)):
+        rng = np.random.default_rng(rng_key + [number])
+        yield rng, start, min(CHUNK_SIZE, rows - start)
+
+
+def patient_batches(seed, patients):
+    index_day = to_day(INDEX_DATE)
+    for rng, start, n in chunks([seed, 0], patients):
+        first = start + 1
+        ages = rng.choice(MAX_AGE, size=n, p=population_age_weights())
+        birth_days = index_day - ages * 365 - rng.integers(0, 365, n)
+        yield pa.table(
+            {
+                "patient_id": pa.array(np.arange(first, first + n, dtype="int64")),
+                "date_of_birth": to_timestamps(birth_days),
+                "sex": pa.array(rng.choice(["F", "M", "U"], n, p=[0.5, 0.499, 0.001])),
+            }
+        )
+
+
+def spell_batches(seed, patients, number, values, unrecorded=0.0):
+    """
+    One registration or address per patient (but for an `unrecorded` share
+    of them): most began before the index date and are still current.
+    """
+    for rng, first, n in chunks([seed, number], patients):
+        starts = uniform_days(rng, n, "1990-01-01", "2021-06-30")
+        ended = rng.random(n) < 0.07
+        ends = np.where(ended, starts + rng.integers(1, 3650, n), OPEN_DATE)
+        columns = {
+            "patient_id": pa.array(np.arange(first + 1, first + n + 1, dtype="int64")),
+            "start_date": to_timestamps(starts),
+            "end_date": to_timestamps(ends),
+        }
+        columns.update(values(rng, n))
+        yield pa.table(columns).filter(pa.array(rng.random(n) >= unrecorded))
+
+
+def event_batches(seed, number, table, rows, patients, pool, setup):
+    start, end = EVENT_DATES[table]
+    if table == "ons_deaths":
+        # Drawn all at once, so that no patient dies twice
+        deaths = setup.choice(patients, size=rows, replace=False) + 1
+    for rng, first, n in chunks([seed, number], rows):
+        if table == "ons_deaths":
+            ids = deaths[first : first + n]
+        else:
+            ids = rng.integers(1, patients + 1, n)
+        columns = {
+            "patient_id": pa.array(ids.astype("int64")),
+            TABLES[table][1]: to_timestamps(uniform_days(rng, n, start, end)),
+        }
+        if table == "clinical_events":
+            columns["code"] = pool.draw(rng, n)
+            values = np.round(rng.normal(50, 15, n), 1)
+            columns["numeric_value"] = pa.array(values, mask=rng.random(n) < 0.8)
+        elif table == "medications":
+            columns["code"] = pool.draw(rng, n)
+        elif table == "admissions":
+            columns["diagnoses"] = pool.draw_fields(rng, n)
+        elif table == "ons_deaths":
+            columns["underlying_cause"] = pool.draw(rng, n)
+            columns["causes"] = pool.draw_fields(rng, n, columns["underlying_cause"])
+        else:
+            columns["pathogen"] = pa.array(np.full(n, "SARS-CoV-2", dtype=object))
+            positive = rng.random(n) < POSITIVE_TEST_SHARE
+            columns["result"] = pa.array(np.where(positive, "positive", "negative"))
+        yield pa.table(columns)
+
+
+def generate_tables(directory, clinical_events=1_000_000, seed=0):
+    """
+    Write synthetic tables with `clinical_events` clinical event rows to
+    `directory`; returns the number of rows of each table.
+    """
+    from study_definition import study
+
+    os.makedirs(directory, exist_ok=True)
+    patients = max(clinical_events // ROWS_PER_PATIENT["clinical_events"], 1)
+    codelists = study_codelists(study.covariate_definitions)
+    rows = {}
+
+    def write(name, batches):
+        rows[name] = write_table(os.path.join(directory, f"{name}.feather"), batches)
+
+    write("patients", patient_batches(seed, patients))
+    write(
+        "registrations",
+        spell_batches(
+            seed,
+            patients,
+            1,
+            lambda rng, n: {"region": pa.array(rng.choice(REGIONS, n))},
+        ),
+    )
+    write(
+        "addresses",
+        spell_batches(
+            seed,
+            patients,
+            2,
+            lambda rng, n: {"imd": rng.integers(1, IMD_RANKS + 1, n)},
+            unrecorded=0.02,
+        ),
+    )
+    for number, table in enumerate(ROWS_PER_PATIENT, start=3):
+        count = max(round(patients * ROWS_PER_PATIENT[table]), 1)
+        if table == "clinical_events":
+            count = clinical_events
+        # Generator for what is drawn once per table, rather than per chunk
+        setup = np.random.default_rng([seed, number])
+        pool = None
+        if table in CODELIST_SHARE:
+            pool = CodePool(table, codelists[table], setup)
+        write(table, event_batches(seed, number, table, count, patients, pool, setup))
+    # Written last, marking the tables as complete
+    with open(os.path.join(directory, "rows.json"), "w") as f:
+        json.dump(rows, f, indent=2)
+    return rows
+
+
+def benchmark_tables(clinical_events, seed=0):
+    """The directory of the benchmark's tables, generating them if needed."""
+    directory = os.path.join(
+        BENCHMARK_DIR, f"{clinical_events}-{seed}-v{GENERATOR_VERSION}"
+    )
+    marker = os.path.join(directory, "rows.json")
+    if not os.path.exists(marker):
+        with ProcessPoolExecutor(1) as pool:
+            pool.submit(generate_tables, directory, clinical_events, seed).result()
+    with open(marker) as f:
+        return directory, json.load(f)
+
+
+def git_commit():
+    """The commit checked out (with "+" if there are changes), or None."""
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+        changes = subprocess.run(
+            ["git", "status", "--porcelain", "--untracked-files=no"],
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return commit + ("+" if changes else "")
+
+
+def peak_rss():
+    """Peak resident memory of this process, in bytes (ru_maxrss is in KiB)."""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def environment():
+    return {
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "pandas": pd.__version__,
+        "pyarrow": pa.__version__,
+        "machine": platform.machine(),
+        "processor": platform.processor(),
+        "cpus": os.cpu_count(),
+    }
+
+
+def run_once(study, directory, workers):
+    """Stage timings, population size and profile of one extraction."""
+    stages = {}
+    start = time.perf_counter()
+    tables = EventTables.from_directory(directory)
+    stages["load"] = time.perf_counter() - start
+
+    profile = ExtractionProfile()
+    extractor = LocalExtractor(
+        study.covariate_definitions, tables, staged=True, profile=profile
+    )
+    extractor.run(workers)
+    for stage in profile.stages:
+        stages[f"extraction stage {stage['stage']}"] = stage["seconds"]
+
+    start = time.perf_counter()
+    population = len(extractor.to_frame())
+    stages["to_frame"] = time.perf_counter() - start
+    return stages, population, profile
+
+
+def run_benchmark(clinical_events=1_000_000, workers=1, repeats=1, seed=0):
+    """
+    Run the benchmark; returns the report, the path it was written to and
+    the profile of the fastest extraction.
+    """
+    from study_definition import study
+
+    directory, rows = benchmark_tables(clinical_events, seed)
+    stages, profile = {}, None
+    for _ in range(repeats):
+        times, population, run_profile = run_once(study, directory, workers)
+        for name, seconds in times.items():
+            stages[name] = min(seconds, stages.get(name, seconds))
+        if profile is None or run_profile.seconds < profile.seconds:
+            profile = run_profile
+
+    started = datetime.now()
+    report = {
+        "started": started.isoformat(timespec="seconds"),
+        "environment": environment(),
+        "settings": {
+            "clinical_events": clinical_events,
+            "seed": seed,
+            "generator_version": GENERATOR_VERSION,
+            "workers": workers,
+            "repeats": repeats,
+        },
+        "rows": rows,
+        "population": population,
+        "stages": stages,
+        "peak_rss_bytes": peak_rss(),
+        "profile": profile.report(),
+    }
+    os.makedirs(LOG_DIR, exist_ok=True)
+    commit = (report["environment"]["commit"] or "unknown")[:10]
+    stamp = started.strftime("%Y%m%d-%H%M%S")
+    path = os.path.join(LOG_DIR, f"benchmark-{clinical_events}-{commit}-{stamp}.json")
+    with open(path, "w") as f:
+        json.dump(report, f, indent=2)
+    return report, path, profile
+
+
+def stage_table(report):
+    lines = [f"{'stage':<32} {'seconds':>8}"]
+    for name, seconds in report["stages"].items():
+        lines.append(f"{name:<32} {seconds:>8.3f}")
+    lines.append(
+        f"{'total':<32} {sum(report['stages'].values()):>8.3f}"
+        f"   population {report['population']},"
+        f" peak RSS {report['peak_rss_bytes'] / 2**20:.0f} MB"
+    )
+    return "\n".join(lines)
+
+
+def compare(baseline, current, top=10):
+    """Stage and variable times of two reports (paths), side by side."""
+    reports = []
+    for path in [baseline, current]:
+        with open(path) as f:
+            reports.append(json.load(f))
+    old, new = reports
+    lines = []
+    if old["settings"] != new["settings"] or old["rows"] != new["rows"]:
+        lines.append("Warning: the reports are of different settings or tables")
+
+    def row(name, before, after):
+        ratio = f"{after / before:>7.2f}x" if before else ""
+        return f"{name:<32} {before:>9.3f} {after:>9.3f} {ratio}"
+
+    lines.append(f"{'stage':<32} {'baseline':>9} {'current':>9}   ratio")
+    for name in dict.fromkeys([*old["stages"], *new["stages"]]):
+        lines.append(row(name, old["stages"].get(name, 0), new["stages"].get(name, 0)))
+    lines.append(
+        row("total", sum(old["stages"].values()), sum(new["stages"].values()))
+    )
+    lines.append(
+        f"{'peak RSS MB':<32} {old['peak_rss_bytes'] / 2**20:>9.0f}"
+        f" {new['peak_rss_bytes'] / 2**20:>9.0f}"
+    )
+
+    before = {k: v["seconds"] for k, v in old["profile"]["variables"].items()}
+    after = {k: v["seconds"] for k, v in new["profile"]["variables"].items()}
+    changes = sorted(
+        set(before) & set(after), key=lambda name: -abs(after[name] - before[name])
+    )
+    lines.append(f"\n{'variable':<32} {'baseline':>9} {'current':>9}   ratio")
+    for name in changes[:top]:
+        lines.append(row(name, before[name], after[name]))
+    return "\n".join(lines)
+
+
+def benchmark(clinical_events=1_000_000, workers=1, repeats=1, seed=0):
+    report, path, profile = run_benchmark(
+        int(clinical_events), int(workers), int(repeats), int(seed)
+    )
+    print(stage_table(report))
+    print(profile.summary())
+    print(f"Benchmark report written to {path}")
+
+
+def main(*arguments):
+    if arguments[:1] == ("compare",):
+        print(compare(*arguments[1:]))
+    else:
+        benchmark(*arguments)
+
+
+if __name__ == "__main__":
+    main(*sys.argv[1:])
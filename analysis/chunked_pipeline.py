@@ -0,0 +1,367 @@
+"""
+Run extraction, derivation and the descriptive counts one chunk of
+patients at a time, within a memory budget.
+
+local_extractor.py and derive_cohort.py hold the whole cohort in memory.
+This splits the tables into chunks by patient_id range, each with the
+same number of patients, and works through the chunks in worker
+processes:
+
+  1. partition: stream each table through once, writing each chunk's rows
+     to output/chunks/<chunk>/<table>.{csv,feather} (the format of the
+     input, so that the tables read back exactly as they would have been)
+  2. extract: run the staged LocalExtractor on a chunk and write its
+     cohort with cohort_io.write_cohort, returning the counts of the
+     values that the IMD quintiles and age knots are percentiles of
+  3. add up those counts and compute the cut points from them, which are
+     exactly those of the whole cohort (see derive_cohort.cut_points)
+  4. derive: derive the analysis dataset of a chunk with those cut points,
+     and summarise it by exposure (Aggregates of the Table 1 variables,
+     the outcome flags, and the moments of age and eGFR)
+  5. merge: concatenate the chunks' analysis datasets, in patient order,
+     into output/analysis_dataset.csv, add up their aggregates into
+     output/aggregates/, and write Table 1, the outcomes by exposure and
+     the standardised differences from them (see table_1.py,
+     descriptive_stats.py and standardised_differences.py)
+
+Chunks and worker processes are sized so that the estimated peak memory
+of each worker, CHUNK_BASELINE plus the size of its share of the tables
+times TABLE_EXPANSION, stays within memory_budget / workers. Each worker
+process handles one chunk and exits, so that memory is returned between
+chunks. The report printed at the end gives each worker's measured peak.
+
+Run from the root of the repository:
+
+    python analysis/chunked_pipeline.py <tables directory> [memory budget MB]
+        [workers]
+"""
+
+import math
+import os
+import resource
+import shutil
+import sys
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pa_csv
+
+from aggregates import Aggregates
+from cohort_io import cohort_schema, read_cohort, write_cohort
+from derive_cohort import (
+    OUTCOME_FLAGS,
+    OUTPUT_FILE,
+    cut_point_counts,
+    cut_points,
+    derive_cohort,
+)
+from descriptive_stats import OUTPUT_FILE as DESCRIPTIVE_STATS_FILE
+from descriptive_stats import SEQUENCES_FILE, write_descriptive_stats
+from event_tables import TABLES, EventTables
+from local_extractor import LocalExtractor
+from standardised_differences import CONTINUOUS
+from standardised_differences import OUTPUT_FILE as DIFFERENCES_FILE
+from standardised_differences import standardised_differences
+from table_1 import OUTPUT_FILE as TABLE_1_FILE
+from table_1 import VARIABLES as TABLE_1_VARIABLES
+from table_1 import table_1, write_table
+
+CHUNK_DIR = os.path.join("output", "chunks")
+AGGREGATES_DIR = os.path.join("output", "aggregates")
+
+MEMORY_BUDGET = 4096 * 2**20
+
+# Peak memory of a worker, in bytes: CHUNK_BASELINE plus TABLE_EXPANSION
+# times the bytes its tables take on disk. Measured on the benchmark's
+# (feather) tables and on CSV tables of 50,000 patients
+CHUNK_BASELINE = 250 * 2**20
+TABLE_EXPANSION = {"feather": 2.5, "csv": 4.0}
+
+# Rows of each table read at a time when partitioning a CSV
+CSV_BLOCK_SIZE = 16 * 2**20
+
+# Summarised by exposure besides the variables of Table 1
+SUMMARISED = OUTCOME_FLAGS + ["outcome_sequence"]
+
+
+def table_paths(directory):
+    """The file of each table and its format, as EventTables.from_directory."""
+    paths = {}
+    for name in TABLES:
+        path = os.path.join(directory, name)
+        if os.path.exists(f"{path}.feather"):
+            paths[name] = (f"{path}.feather", "feather")
+        else:
+            paths[name] = (f"{path}.csv", "csv")
+    return paths
+
+
+def estimate_memory(directory, chunks=1):
+    """Estimated peak memory of a worker extracting one of `chunks` chunks."""
+    total = sum(
+        os.path.getsize(path) * TABLE_EXPANSION[kind]
+        for path, kind in table_paths(directory).values()
+    )
+    return CHUNK_BASELINE + total / chunks
+
+
+def plan_chunks(directory, memory_budget=MEMORY_BUDGET, workers=1):
+    """
+    The number of chunks and of worker processes to run at once: as many
+    workers as asked for, fewer if the budget cannot hold that many
+    workers extracting the smallest useful chunk, and enough chunks for
+    each to fit its worker's share of the budget.
+    """
+    tables = estimate_memory(directory) - CHUNK_BASELINE
+    share = memory_budget / workers
+    while workers > 1 and share <= CHUNK_BASELINE:
+        workers -= 1
+        share = memory_budget / workers
+    if share <= CHUNK_BASELINE:
+        raise ValueError(
+            f"A memory budget of {memory_budget / 2**20:.0f} MB is too small"
+        )
+    chunks = max(math.ceil(tables / (share - CHUNK_BASELINE)), workers, 1)
+    return chunks, workers
+
+
+def read_patient_ids(path, kind):
+    if kind == "feather":
+        table = pa.ipc.open_file(path).read_all().select(["patient_id"])
+    else:
+        table = pa_csv.read_csv(
+            path,
+            convert_options=pa_csv.ConvertOptions(
+                include_columns=["patient_id"],
+                column_types={"patient_id": pa.int64()},
+            ),
+        )
+    return np.sort(table["patient_id"].to_numpy())
+
+
+def chunk_starts(patient_ids, chunks):
+    """The first patient_id of each chunk of (near) equal numbers of patients."""
+    chunks = max(min(chunks, len(patient_ids)), 1)
+    if not len(patient_ids):
+        return np.zeros(1, dtype="int64")
+    positions = np.arange(chunks) * len(patient_ids) // chunks
+    return np.unique(patient_ids[positions])
+
+
+def read_batches(path, kind, name):
+    """A table's record batches; CSV columns are read as text, unconverted."""
+    if kind == "feather":
+        reader = pa.ipc.open_file(path)
+        for i in range(reader.num_record_batches):
+            yield reader.get_batch(i)
+        return
+    types = dict.fromkeys(TABLES[name], pa.string())
+    reader = pa_csv.open_csv(
+        path,
+        read_options=pa_csv.ReadOptions(block_size=CSV_BLOCK_SIZE),
+        convert_options=pa_csv.ConvertOptions(
+            column_types=types, strings_can_be_null=True
+        ),
+    )
+    yield from reader
+
+
+def open_writer(path, kind, schema):
+    if kind == "feather":
+        options = pa.ipc.IpcWriteOptions(compression=None)
+        return pa.ipc.new_file(path, schema, options=options)
+    return pa_csv.CSVWriter(path, schema)
+
+
+def partition(directory, starts, output_dir=CHUNK_DIR):
+    """
+    Write the rows of every table whose patient_id is in each chunk to
+    output_dir/<chunk>/, streaming each table once; returns the chunk
+    directories. Rows of patients before the first chunk go to the first.
+    """
+    chunk_dirs = [os.path.join(output_dir, str(i)) for i in range(len(starts))]
+    for chunk_dir in chunk_dirs:
+        os.makedirs(chunk_dir, exist_ok=True)
+    for name, (path, kind) in table_paths(directory).items():
+        writers = None
+        for batch in read_batches(path, kind, name):
+            if writers is None:
+                writers = [
+                    open_writer(
+                        os.path.join(chunk_dir, f"{name}.{kind}"), kind, batch.schema
+                    )
+                    for chunk_dir in chunk_dirs
+                ]
+            ids = pc.cast(batch["patient_id"], pa.int64()).to_numpy(
+                zero_copy_only=False
+            )
+            chunk = np.maximum(np.searchsorted(starts, ids, side="right") - 1, 0)
+            # Stable, so rows keep their order within each chunk
+            order = np.argsort(chunk, kind="stable")
+            batch = batch.take(pa.array(order))
+            ends = np.cumsum(np.bincount(chunk, minlength=len(starts)))
+            for writer, start, end in zip(writers, np.r_[0, ends[:-1]], ends):
+                writer.write_batch(batch.slice(start, end - start))
+        for writer in writers or []:
+            writer.close()
+    return chunk_dirs
+
+
+def peak_rss():
+    """
+    Peak resident memory of this process, in bytes. On Linux this is read
+    from VmHWM, as ru_maxrss carries over the parent's peak into a spawned
+    worker.
+    """
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def extract_chunk(chunk_dir):
+    """Extract a chunk's cohort to chunk_dir/input.feather."""
+    from study_definition import study
+
+    tables = EventTables.from_directory(chunk_dir)
+    extractor = LocalExtractor(study.covariate_definitions, tables, staged=True)
+    df = extractor.extract()
+    del tables, extractor
+    write_cohort(
+        df,
+        os.path.join(chunk_dir, "input.feather"),
+        cohort_schema(study.covariate_definitions),
+    )
+    return cut_point_counts(df), peak_rss()
+
+
+def derive_chunk(chunk_dir, cuts):
+    """
+    Derive a chunk's analysis dataset to chunk_dir/analysis_dataset.csv,
+    returning its aggregates by exposure.
+    """
+    df = read_cohort(os.path.join(chunk_dir, "input.feather"))
+    df = derive_cohort(df, cuts)
+    df.to_csv(
+        os.path.join(chunk_dir, "analysis_dataset.csv"),
+        index=False,
+        date_format="%Y-%m-%d",
+    )
+    aggregates = Aggregates.of(
+        df,
+        "exp",
+        categorical=[c for c in TABLE_1_VARIABLES + SUMMARISED if c in df],
+        continuous=[c for c in CONTINUOUS if c in df],
+    )
+    return aggregates, peak_rss()
+
+
+def run_chunks(function, arguments, workers):
+    """function(*a) for each of arguments, one fresh process per call."""
+    with ProcessPoolExecutor(workers, max_tasks_per_child=1) as pool:
+        futures = [pool.submit(function, *a) for a in arguments]
+        return [future.result() for future in futures]
+
+
+def add_counts(counts):
+    """Add up the cut_point_counts of several chunks."""
+    return {
+        name: sum_value_counts([c[name] for c in counts]) for name in counts[0]
+    }
+
+
+def sum_value_counts(series):
+    total = series[0]
+    for s in series[1:]:
+        total = total.add(s, fill_value=0)
+    return total.astype("int64")
+
+
+def concatenate(paths, output_file):
+    """Concatenate CSV files with the same header, keeping the first header."""
+    with open(output_file, "wb") as out:
+        for i, path in enumerate(paths):
+            with open(path, "rb") as f:
+                header = f.readline()
+                if i == 0:
+                    out.write(header)
+                shutil.copyfileobj(f, out)
+
+
+def run_pipeline(
+    tables_directory,
+    memory_budget=MEMORY_BUDGET,
+    workers=1,
+    chunks=None,
+    output_file=OUTPUT_FILE,
+    aggregates_dir=AGGREGATES_DIR,
+    table_1_file=TABLE_1_FILE,
+    descriptive_stats_files=(DESCRIPTIVE_STATS_FILE, SEQUENCES_FILE),
+    differences_file=DIFFERENCES_FILE,
+    chunk_dir=CHUNK_DIR,
+):
+    """Run every step; returns the merged Aggregates and a run report."""
+    planned, workers = plan_chunks(tables_directory, memory_budget, workers)
+    chunks = chunks or planned
+
+    path, kind = table_paths(tables_directory)["patients"]
+    starts = chunk_starts(read_patient_ids(path, kind), chunks)
+    shutil.rmtree(chunk_dir, ignore_errors=True)
+    chunk_dirs = partition(tables_directory, starts, chunk_dir)
+
+    extracted = run_chunks(extract_chunk, [(d,) for d in chunk_dirs], workers)
+    cuts = cut_points(add_counts([counts for counts, _ in extracted]))
+
+    derived = run_chunks(derive_chunk, [(d, cuts) for d in chunk_dirs], workers)
+    aggregates = sum(a for a, _ in derived)
+
+    concatenate(
+        [os.path.join(d, "analysis_dataset.csv") for d in chunk_dirs], output_file
+    )
+    os.makedirs(aggregates_dir, exist_ok=True)
+    aggregates.write(aggregates_dir)
+    write_table(table_1(aggregates), table_1_file)
+    write_descriptive_stats(
+        aggregates.counts.xs("outcome_sequence", level="variable"),
+        aggregates.sizes,
+        *descriptive_stats_files,
+    )
+    write_table(standardised_differences(aggregates), differences_file)
+    shutil.rmtree(chunk_dir)
+
+    report = {
+        "chunks": len(chunk_dirs),
+        "workers": workers,
+        "memory_budget_bytes": memory_budget,
+        "estimated_peak_bytes": estimate_memory(tables_directory, len(chunk_dirs)),
+        "peak_rss_bytes": [
+            max(e, d) for (_, e), (_, d) in zip(extracted, derived)
+        ],
+    }
+    return aggregates, report
+
+
+def main(tables_directory, memory_budget=None, workers=1):
+    if memory_budget is None:
+        memory_budget = MEMORY_BUDGET
+    else:
+        memory_budget = int(float(memory_budget) * 2**20)
+    aggregates, report = run_pipeline(tables_directory, memory_budget, int(workers))
+    print(
+        f"{report['chunks']} chunks on {report['workers']} workers, estimated"
+        f" peak {report['estimated_peak_bytes'] / 2**20:.0f} MB per worker"
+        f" within a budget of {memory_budget / 2**20:.0f} MB"
+    )
+    for i, peak in enumerate(report["peak_rss_bytes"]):
+        print(f"chunk {i}: peak {peak / 2**20:.0f} MB")
+    print(f"Patients by exposure:\n{aggregates.sizes.to_string()}")
+
+
+if __name__ == "__main__":
+    main(*sys.argv[1:])
@@ -0,0 +1,75 @@
+"""
+Compiled store for codelists read from codelists/*.csv.
+
+Each CSV codelist is parsed once and the resulting codes are pickled under
+codelists/.compiled, keyed by the SHA-1 of the file's contents, so any
+change to the file (by `opensafely codelists update` or by hand)
+invalidates its entry. The SHAs recorded in codelists/codelists.json are
+not used, as they need not match the files on disk. Within a process,
+identical requests return the same Codelist object, so a code set used
+by several variables is held once.
+"""
+
+import hashlib
+import os
+import pickle
+
+from cohortextractor import codelist, codelist_from_csv
+
+CODELISTS_DIR = "codelists"
+STORE_DIR = os.path.join(CODELISTS_DIR, ".compiled")
+
+_interned = {}
+
+
+def file_sha(filename):
+    """The SHA-1 of a file's contents."""
+    with open(filename, "rb") as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+
+def load_codelist(filename, system, column="code", category_column=None):
+    """
+    Drop-in replacement for cohortextractor's codelist_from_csv that reads
+    from, and populates, the compiled store.
+    """
+    key = (file_sha(filename), system, column, category_column)
+    if key in _interned:
+        return _interned[key]
+
+    path = os.path.join(STORE_DIR, "{}-{}-{}-{}.pickle".format(*key))
+    try:
+        with open(path, "rb") as f:
+            codes = codelist(pickle.load(f), system, check_categories=False)
+    except (OSError, pickle.UnpicklingError, EOFError):
+        codes = codelist_from_csv(filename, system, column, category_column)
+        try:
+            os.makedirs(STORE_DIR, exist_ok=True)
+            with open(path, "wb") as f:
+                pickle.dump(list(codes), f, protocol=pickle.HIGHEST_PROTOCOL)
+        except OSError:
+            # A read-only checkout just means we parse the CSV every time
+            pass
+
+    _interned[key] = codes
+    return codes
+
+
+def lazy_codelists(module_globals, definitions):
+    """
+    Return a module `__getattr__` which loads each of `definitions` (a map
+    of name to load_codelist arguments) on first access and caches it in
+    the module namespace.
+    """
+
+    def __getattr__(name):
+        try:
+            kwargs = definitions[name]
+        except KeyError:
+            raise AttributeError(
+                f"module {module_globals['__name__']!r} has no attribute {name!r}"
+            ) from None
+        module_globals[name] = load_codelist(**kwargs)
+        return module_globals[name]
+
+    return __getattr__
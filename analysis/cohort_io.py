@@ -0,0 +1,304 @@
+"""
+Typed, columnar storage for extracted cohorts.
+
+`generate_cohort` writes output/input.csv, where dates are YYYY-MM-DD
+strings and categories are repeated strings, so every downstream action
+pays for parsing the whole file again. This module converts it once, with
+load_cohort, to an uncompressed Arrow IPC (Feather v2) file in which,
+following cohort_schema:
+
+  * dates are date32, i.e. int32 day numbers since 1970-01-01
+  * flags are int8, other integers int32 and patient_id int64
+  * string columns are dictionary encoded
+
+so a column has the same type whatever values it happens to hold. The
+file can be memory-mapped and read a column at a time with `read_cohort`.
+Columns written without a schema (e.g. those of propensity_scores.py)
+keep the kind of their dtype: integers are downcast, floats stay floats.
+
+`load_cohort` reads output/input.csv straight into compact pandas columns
+instead, streaming it in blocks, with types taken from the study
+definition rather than guessed from the values (see cohort_schema):
+
+  * dates are int32 day numbers (NULL_DATE where missing), YYYY-MM dates
+    being the first of the month
+  * flags, including 0/1 categorised_as variables, are int8
+  * string columns (categorised_as, returning="category", sex, region)
+    are categoricals, with the categories the definition allows first
+  * other integers (age, imd) take the smallest type which holds every
+    value read, so that IMD rounded to the nearest 100 is only int16 if
+    no rank is above 32,767
+
+Run from the root of the repository:
+
+    python analysis/cohort_io.py [input] [output]
+"""
+
+import re
+import sys
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pa_csv
+import pyarrow.feather as feather
+
+from event_tables import NULL_DATE
+
+INPUT_FILE = "output/input.csv"
+OUTPUT_FILE = "output/input.feather"
+
+# Bytes of CSV parsed at a time by load_cohort
+BLOCK_SIZE = 64 * 2**20
+
+# How load_cohort parses each kind of column in cohort_schema
+PARSE_TYPES = {
+    "date": pa.timestamp("s"),
+    "month": pa.timestamp("s"),
+    "flag": pa.int8(),
+    "category": pa.dictionary(pa.int32(), pa.string()),
+    "int": pa.int64(),
+    "float": pa.float64(),
+    "id": pa.int64(),
+}
+# The type write_cohort stores each kind of column as
+ARROW_TYPES = {
+    "date": pa.date32(),
+    "month": pa.date32(),
+    "flag": pa.int8(),
+    "category": pa.dictionary(pa.int32(), pa.string()),
+    "int": pa.int32(),
+    "float": pa.float64(),
+    "id": pa.int64(),
+}
+DATE_PARSERS = ["%Y-%m-%d", "%Y-%m", "%Y"]
+
+FULL_DATE = re.compile(r"^\d{4}-\d{2}-\d{2}$")
+MONTH_DATE = re.compile(r"^\d{4}-\d{2}$")
+
+# Columns stored from a YYYY-MM value carry this in their field metadata,
+# and are stored as the first of the month
+PRECISION_KEY = b"date_precision"
+
+
+def _date_format(values):
+    """Return "day", "month" or None for a column of non-null strings."""
+    if not len(values):
+        return None
+    for precision, pattern in [("day", FULL_DATE), ("month", MONTH_DATE)]:
+        if values.str.fullmatch(pattern).all():
+            return precision
+    return None
+
+
+def _date_array(series, kind):
+    """A date column of any representation as date32 and its metadata."""
+    precision = b"month" if kind == "month" else b"day"
+    if pd.api.types.is_integer_dtype(series):
+        days = series.astype("float64").where(series != NULL_DATE)
+        days = days.to_numpy().astype("datetime64[D]")
+    elif pd.api.types.is_datetime64_any_dtype(series):
+        days = series.to_numpy().astype("datetime64[D]")
+    else:
+        series = series.astype(object).where(series.notna() & (series != ""))
+        if kind == "month":
+            # Stored as the first of the month, whatever day it was given
+            series = series.str.slice(0, 7) + "-01"
+        days = series.fillna("NaT").to_numpy(dtype=str).astype("datetime64[D]")
+    array = pa.array(days, type=pa.date32(), from_pandas=True)
+    return array, {PRECISION_KEY: precision}
+
+
+def to_arrow_array(series, kind=None):
+    """
+    Convert one column to its compact Arrow representation: that of its
+    kind in cohort_schema, if given, otherwise one following its dtype.
+    """
+    metadata = None
+    if kind in ("date", "month"):
+        array, metadata = _date_array(series, kind)
+    elif kind == "category":
+        values = series.astype(object).where(series.notna())
+        array = pa.array(values, type=pa.string()).dictionary_encode()
+    elif kind is not None:
+        if kind == "flag":
+            series = series.fillna(0)
+        array = pa.array(series, from_pandas=True).cast(ARROW_TYPES[kind])
+    elif series.dtype == object or isinstance(series.dtype, pd.StringDtype):
+        values = series.dropna().astype(str)
+        precision = _date_format(values)
+        if precision == "month":
+            series = series.where(series.isna(), series + "-01")
+        if precision:
+            # Via numpy so that sentinels such as 9999-12-31 survive
+            days = series.fillna("NaT").to_numpy(dtype=str).astype("datetime64[D]")
+            array = pa.array(days, type=pa.date32(), from_pandas=True)
+            metadata = {PRECISION_KEY: precision.encode()}
+        else:
+            array = pa.array(series, type=pa.string()).dictionary_encode()
+    elif pd.api.types.is_datetime64_any_dtype(series):
+        days = series.to_numpy().astype("datetime64[D]")
+        array = pa.array(days, type=pa.date32(), from_pandas=True)
+        metadata = {PRECISION_KEY: b"day"}
+    elif isinstance(series.dtype, pd.CategoricalDtype):
+        array = pa.array(series.astype(object), type=pa.string()).dictionary_encode()
+    elif pd.api.types.is_bool_dtype(series):
+        array = pa.array(series.astype("int8"))
+    elif pd.api.types.is_integer_dtype(series):
+        values = series.dropna()
+        dtype = pd.to_numeric(values, downcast="integer").dtype
+        array = pa.array(series.astype(np.dtype(dtype).name.capitalize()))
+    else:
+        array = pa.array(series)
+    return array, metadata
+
+
+def to_arrow_table(df, schema=None):
+    """df as an Arrow table, with the types of cohort_schema, if given."""
+    schema = schema or {}
+    arrays, fields = [], []
+    for name in df.columns:
+        array, metadata = to_arrow_array(df[name], schema.get(name, (None,))[0])
+        arrays.append(array)
+        fields.append(pa.field(name, array.type, metadata=metadata))
+    return pa.Table.from_arrays(arrays, schema=pa.schema(fields))
+
+
+def write_cohort(df, path, schema=None):
+    # Uncompressed so the file can be memory-mapped without decoding
+    feather.write_feather(
+        to_arrow_table(df, schema), path, compression="uncompressed"
+    )
+
+
+def read_cohort_table(path, columns=None):
+    """
+    Read a cohort as an Arrow table. Feather files are memory-mapped and
+    only the requested columns are touched; CSV is parsed as before.
+    """
+    path = str(path)
+    if path.endswith(".csv") or path.endswith(".csv.gz"):
+        return to_arrow_table(pd.read_csv(path, usecols=columns))
+    return feather.read_table(path, columns=columns, memory_map=True)
+
+
+def read_cohort(path, columns=None):
+    """
+    Read a cohort into a DataFrame, with dates as datetime64, dictionary
+    columns as categoricals and month-precision dates set to mid month as
+    in the analysis code.
+    """
+    table = read_cohort_table(path, columns)
+    df = table.to_pandas(date_as_object=False)
+    for field in table.schema:
+        if (field.metadata or {}).get(PRECISION_KEY) == b"month":
+            df[field.name] = df[field.name] + pd.Timedelta(days=14)
+    return df
+
+
+def codelist_categories(codes):
+    if getattr(codes, "has_categories", False):
+        return sorted({str(category) for code, category in codes})
+    return None
+
+
+def cohort_schema(covariate_definitions):
+    """
+    The kind ("date", "month" for YYYY-MM dates, "flag", "category",
+    "int", "float" or "id") of each column generate_cohort writes for a
+    study, with the categories a category column can take, where the
+    definition says (otherwise None).
+    """
+    schema = {}
+    for name, (query_type, arguments) in covariate_definitions.items():
+        if name == "population" or arguments.get("hidden"):
+            continue
+        column_type = arguments.get("column_type")
+        categories = None
+        if column_type == "date":
+            kind = "month" if arguments.get("date_format") == "YYYY-MM" else "date"
+        elif column_type == "bool":
+            kind = "flag"
+        elif column_type == "str":
+            kind = "category"
+            if query_type == "categorised_as":
+                categories = [str(c) for c in arguments["category_definitions"]]
+            elif arguments.get("returning") == "category":
+                categories = codelist_categories(arguments.get("codelist"))
+        elif column_type == "int":
+            kind = "int"
+        else:
+            kind = "float"
+        schema[name] = (kind, categories)
+    schema["patient_id"] = ("id", None)
+    return schema
+
+
+def _convert_batch(batch, schema):
+    """One parsed block of the CSV, with its dates as day numbers."""
+    columns = {}
+    for name, column in zip(batch.schema.names, batch.columns):
+        kind = schema.get(name, (None, None))[0]
+        if kind in ("date", "month"):
+            days = pc.cast(pc.cast(column, pa.date32()), pa.int32())
+            column = days.fill_null(NULL_DATE)
+        elif kind == "flag":
+            column = column.fill_null(0)
+        columns[name] = column
+    return pa.record_batch(columns)
+
+
+def load_cohort(path, covariate_definitions, block_size=BLOCK_SIZE):
+    """
+    Read a CSV written by generate_cohort into a DataFrame of compact
+    columns following cohort_schema(covariate_definitions), parsing
+    block_size bytes at a time. Columns the study does not define are
+    parsed as pyarrow infers them.
+    """
+    schema = cohort_schema(covariate_definitions)
+    types = {name: PARSE_TYPES[kind] for name, (kind, _) in schema.items()}
+    reader = pa_csv.open_csv(
+        path,
+        read_options=pa_csv.ReadOptions(block_size=block_size),
+        convert_options=pa_csv.ConvertOptions(
+            column_types=types,
+            timestamp_parsers=DATE_PARSERS,
+            strings_can_be_null=True,
+        ),
+    )
+    batches = [_convert_batch(batch, schema) for batch in reader]
+    if not batches:
+        empty = pa.RecordBatch.from_pylist([], schema=reader.schema)
+        batches = [_convert_batch(empty, schema)]
+    table = pa.Table.from_batches(batches)
+    # Blocks have their own dictionaries, which must agree to make one
+    # categorical of each column
+    table = table.unify_dictionaries()
+    del batches
+    df = table.to_pandas(split_blocks=True, self_destruct=True)
+    del table
+
+    for name in df.columns:
+        kind, categories = schema.get(name, (None, None))
+        if kind == "category":
+            # Categories the definition allows first, in its order
+            categories = list(categories or [])
+            seen = df[name].cat.categories
+            categories += [c for c in seen if c not in categories]
+            df[name] = df[name].cat.set_categories(categories)
+        elif kind == "int" and df[name].notna().all():
+            df[name] = pd.to_numeric(df[name], downcast="integer")
+    return df
+
+
+def main(input_file=INPUT_FILE, output_file=OUTPUT_FILE):
+    from study_definition import study
+
+    definitions = study.covariate_definitions
+    df = load_cohort(input_file, definitions)
+    write_cohort(df, output_file, cohort_schema(definitions))
+
+
+if __name__ == "__main__":
+    main(*sys.argv[1:])
@@ -0,0 +1,139 @@
+"""
+Date expressions relative to another variable, e.g. a window of
+`between=["exposure_date - 90 days", "exposure_date"]`.
+
+cohortextractor resolves expressions on `index_date` to ISO dates when the
+study definition is loaded, but passes those on another column through
+unchanged for the backend to evaluate per patient. This module compiles
+them, with the same grammar
+
+    [function(]column[)] [+|- N days|months|years]
+
+into operations on int32 day-number arrays (NULL_DATE where missing).
+As in SQL's DATEADD, adding months to the 31st gives the month's last day.
+"""
+
+import re
+from collections import namedtuple
+
+import numpy as np
+
+from event_tables import NULL_DATE
+
+ISO_DATE = re.compile(r"^\d{4}-\d{2}-\d{2}$")
+
+# Arguments of the processed definitions which hold dates or date expressions
+DATE_ARGUMENTS = ["between", "reference_date", "date", "start_date", "end_date"]
+
+EXPRESSION = re.compile(
+    r"""^(?:(?P<function>[A-Za-z][A-Za-z0-9_]*)\()?
+    (?P<column>[A-Za-z][A-Za-z0-9_\.]*)\)?
+    (?:(?P<operator>[+-])(?P<quantity>\d+)(?P<units>[A-Za-z]+))?$""",
+    re.VERBOSE,
+)
+
+UNITS = {
+    "day": (1, 0),
+    "days": (1, 0),
+    "month": (0, 1),
+    "months": (0, 1),
+    "year": (0, 12),
+    "years": (0, 12),
+}
+
+# `function` is None or one of FUNCTIONS; the offset is `months` then `days`
+ColumnDate = namedtuple("ColumnDate", ["column", "function", "months", "days"])
+
+
+def is_iso_date(value):
+    return isinstance(value, str) and bool(ISO_DATE.match(value))
+
+
+def parse_date_expression(value):
+    """A ColumnDate for an expression on another column, None for a date."""
+    if value is None or is_iso_date(value):
+        return None
+    match = EXPRESSION.match(value.replace(" ", ""))
+    if not match:
+        raise ValueError(f"Could not parse date expression: {value!r}")
+    function, column, operator, quantity, units = match.group(
+        "function", "column", "operator", "quantity", "units"
+    )
+    if function is not None and function not in FUNCTIONS:
+        raise ValueError(f"Unknown date function {function!r} in {value!r}")
+    days = months = 0
+    if operator:
+        if units not in UNITS:
+            raise ValueError(f"Unknown date units {units!r} in {value!r}")
+        sign = -1 if operator == "-" else 1
+        days, months = (sign * int(quantity) * n for n in UNITS[units])
+    return ColumnDate(column, function, months, days)
+
+
+def columns_in(arguments):
+    """The columns which the date arguments of a query refer to."""
+    columns = []
+    for key in DATE_ARGUMENTS:
+        values = arguments.get(key)
+        if not isinstance(values, (list, tuple)):
+            values = [values]
+        for value in values:
+            expression = parse_date_expression(value)
+            if expression is not None:
+                columns.append(expression.column)
+    return columns
+
+
+def _first_of_month(dates):
+    return dates.astype("datetime64[M]").astype("datetime64[D]")
+
+
+def _last_of_month(dates):
+    return (dates.astype("datetime64[M]") + 1).astype("datetime64[D]") - 1
+
+
+def _start_of_year(dates, month):
+    """First day of the year (starting in `month`, 1-12) containing dates."""
+    months = dates.astype("datetime64[M]").astype("int64")
+    start = months - (months - (month - 1)) % 12
+    return start.astype("datetime64[M]").astype("datetime64[D]")
+
+
+def _end_of_year(dates, month):
+    start = _start_of_year(dates, month)
+    return (start.astype("datetime64[M]") + 12).astype("datetime64[D]") - 1
+
+
+FUNCTIONS = {
+    "first_day_of_month": _first_of_month,
+    "last_day_of_month": _last_of_month,
+    "first_day_of_year": lambda dates: _start_of_year(dates, 1),
+    "last_day_of_year": lambda dates: _end_of_year(dates, 1),
+    "first_day_of_nhs_financial_year": lambda dates: _start_of_year(dates, 4),
+    "last_day_of_nhs_financial_year": lambda dates: _end_of_year(dates, 4),
+    "first_day_of_school_year": lambda dates: _start_of_year(dates, 9),
+    "last_day_of_school_year": lambda dates: _end_of_year(dates, 9),
+}
+
+
+def add_months(dates, months):
+    """Add whole months to datetime64[D] dates, keeping the day if it exists."""
+    month_start = dates.astype("datetime64[M]")
+    day = (dates - month_start.astype("datetime64[D]")).astype("int64")
+    target = month_start + months
+    last_day = _last_of_month(target.astype("datetime64[D]"))
+    return np.minimum(target.astype("datetime64[D]") + day, last_day)
+
+
+def evaluate_date_expression(expression, days):
+    """Apply a ColumnDate to the int32 day numbers of its column."""
+    days = np.asarray(days)
+    missing = days == NULL_DATE
+    dates = np.where(missing, 0, days).astype("int64").astype("datetime64[D]")
+    if expression.function is not None:
+        dates = FUNCTIONS[expression.function](dates)
+    if expression.months:
+        dates = add_months(dates, expression.months)
+    out = (dates + expression.days).astype("int64").astype("int32")
+    out[missing] = NULL_DATE
+    return out
@@ -0,0 +1,515 @@
+"""
+Derive the analysis dataset from the extracted cohort.
+
+Python port of the covariate derivation in 000_cr_descriptive_cohort.do.
+Every derived variable is built from whole columns at once, so the cost
+is a handful of passes over the data rather than one pass per
+gen/replace statement.
+
+Reads either the typed cohort written by cohort_io.py or the raw CSV, and
+also accepts the compact columns of cohort_io.load_cohort (dates as day
+numbers, categoricals).
+Run from the root of the repository:
+
+    python analysis/derive_cohort.py [input] [output]
+"""
+
+import sys
+
+import numpy as np
+import pandas as pd
+
+from cohort_io import read_cohort
+from event_tables import NULL_DATE
+from outcome_sequences import outcome_sequence, sequence_flags
+
+INPUT_FILE = "output/input.feather"
+OUTPUT_FILE = "output/analysis_dataset.csv"
+
+INDEX_DATE = pd.Timestamp("2020-09-01")
+END_DATE = pd.Timestamp("2021-06-01")
+
+# Dates returned with date_format="YYYY-MM-DD"
+FULL_DATES = [
+    "deregistered",
+    "died_date_ons",
+    "hospitalised_covid_date",
+    "first_comm_covid_date",
+]
+
+# Dates returned with include_month=True (YYYY-MM), set to mid month
+MONTH_DATES = {
+    "bmi_date_measured": "bmi_date_measured",
+    "hba1c_mmol_per_mol_date": "hba1c_mmol_per_mol_date",
+    "hba1c_percentage_date": "hba1c_percentage_date",
+    "haem_cancer": "haem_cancer_date",
+    "lung_cancer": "lung_cancer_date",
+    "other_cancer": "other_cancer_date",
+    "temporary_immunodeficiency": "temporary_immunodeficiency_date",
+    "aplastic_anaemia": "aplastic_anaemia_date",
+}
+
+IMD_PERCENTILES = [20, 40, 60, 80]
+# Knots of the restricted cubic spline for age
+AGE_KNOT_PERCENTILES = [5, 35, 65, 95]
+
+EXPOSURES = {"SGLT2i": 1, "DPP4i": 2, "Sulfonylureas": 3, "Three": 4, "Four": 5}
+
+REGIONS = [
+    "East Midlands",
+    "East",
+    "London",
+    "North East",
+    "North West",
+    "South East",
+    "South West",
+    "West Midlands",
+    "Yorkshire and The Humber",
+]
+
+# region_9 -> region_7
+REGION_7 = {1: 3, 2: 1, 3: 2, 4: 4, 5: 5, 6: 6, 7: 7, 8: 3, 9: 4}
+
+LABELS = {
+    "exp": {v: k for k, v in EXPOSURES.items()},
+    "male": {0: "female", 1: "male"},
+    "agegroup": {1: "18-<50", 2: "50-<60", 3: "60-<70", 4: "70-<80", 5: "80+"},
+    "ethnicity": {
+        1: "White",
+        2: "Mixed",
+        3: "Asian or Asian British",
+        4: "Black",
+        5: "Other",
+        6: "Unknown",
+    },
+    "imd": {1: "1 least deprived", 2: "2", 3: "3", 4: "4", 5: "5 most deprived"},
+    "smoke": {1: "Never", 2: "Former", 3: "Current"},
+    "smoke_nomiss": {1: "Never", 2: "Former", 3: "Current"},
+    "region_9": dict(enumerate(REGIONS, start=1)),
+    "region_7": {
+        1: "East",
+        2: "London",
+        3: "Midlands",
+        4: "North East and Yorkshire",
+        5: "North West",
+        6: "South East",
+        7: "South West",
+    },
+    "bmicat": {
+        1: "Underweight (<18.5)",
+        2: "Normal (18.5-24.9)",
+        3: "Overweight (25-29.9)",
+        4: "Obese I (30-34.9)",
+        5: "Obese II (35-39.9)",
+        6: "Obese III (40+)",
+    },
+    "obese4cat": {
+        1: "No record of obesity",
+        2: "Obese I (30-34.9)",
+        3: "Obese II (35-39.9)",
+        4: "Obese III (40+)",
+    },
+    "bpcat": {1: "Normal", 2: "Elevated", 3: "High, stage I", 4: "High, stage II"},
+    "cancer_haem_cat": {1: "Never", 2: "Last year", 3: "2-5 years ago", 4: "5+ years"},
+    "cancer_exhaem_cat": {
+        1: "Never",
+        2: "Last year",
+        3: "2-5 years ago",
+        4: "5+ years",
+    },
+    "hba1ccat": {0: "<6.5%", 1: ">=6.5-7.4", 2: ">=7.5-7.9", 3: ">=8-8.9", 4: ">=9"},
+    "diabcat": {
+        1: "Controlled diabetes",
+        2: "Uncontrolled diabetes",
+        3: "No hba1c measure",
+    },
+}
+
+KEEP = [
+    "patient_id",
+    "indexdate",
+    "exp",
+    "hospitalised_covid_date",
+    "died_date_ons_date",
+    "first_comm_covid_date",
+    "metformin_3mths",
+    "insulin_meds_3mths",
+    "hospitalised_covid",
+    "died_covid",
+    "first_comm_covid",
+    "deregistered_date",
+    "other_immunosuppression",
+    "age",
+    "age1",
+    "age2",
+    "age3",
+    "agegroup",
+    "male",
+    "ethnicity",
+    "imd",
+    "region_9",
+    "region_7",
+    "smoke",
+    "smoke_nomiss",
+    "bmicat",
+    "obese4cat",
+    "obese4cat_withmiss",
+    "bpcat",
+    "bpcat_nomiss",
+    "bphigh",
+    "egfr",
+    "ckd",
+    "chronic_kidney_disease",
+    "reduced_kidney_function_cat",
+    "hba1ccat",
+    "diabcat",
+    "chronic_cardiac_disease",
+    "hypertension",
+    "chronic_respiratory_disease",
+    "organ_transplant",
+    "dysplenia",
+    "sickle_cell",
+    "spleen",
+    "hiv",
+    "permanent_immunodeficiency",
+    "ra_sle_psoriasis",
+    "other_neuro",
+    "dementia",
+    "chronic_liver_disease",
+    "cancer_exhaem_cat",
+    "cancer_haem_cat",
+]
+
+# Flag for patients with exactly these outcomes, each on or after the
+# date of the one before
+OUTCOME_SEQUENCES = {
+    # Individual outcomes only
+    "comm_only": ["comm"],
+    "hosp_only": ["hosp"],
+    "died_only": ["death"],
+    # Combinations of two
+    "comm_death": ["comm", "death"],
+    "comm_hosp": ["comm", "hosp"],
+    "hosp_comm": ["hosp", "comm"],
+    "hosp_death": ["hosp", "death"],
+    # Combinations of three
+    "comm_hosp_death": ["comm", "hosp", "death"],
+    "hosp_comm_death": ["hosp", "comm", "death"],
+    "death_comm_hosp": ["death", "comm", "hosp"],
+    "death_hosp_comm": ["death", "hosp", "comm"],
+}
+OUTCOME_FLAGS = list(OUTCOME_SEQUENCES)
+
+
+def stata_round(values, digits=1):
+    """Stata's round(x, 10^-digits), which rounds halves up, not to even."""
+    scale = 10**digits
+    return np.floor(values * scale + 0.5) / scale
+
+
+def stata_pctile(values, percentiles):
+    """
+    Percentiles using the default definition of Stata's _pctile, as the
+    breaks of egen cut(), group() and mkspline's knots in the do-file.
+    """
+    x = np.sort(np.asarray(values, dtype="float64"))
+    x = x[~np.isnan(x)]
+    n = len(x)
+    if n == 0:
+        return np.full(len(percentiles), np.nan)
+    w = n * np.asarray(percentiles, dtype="float64") / 100
+    i = np.floor(w).astype("int64")
+    exact = w == i
+    lower = x[np.clip(i - 1, 0, n - 1)]
+    upper = x[np.clip(i, 0, n - 1)]
+    return np.where(exact & (i > 0), (lower + upper) / 2, upper)
+
+
+def stata_pctile_counts(counts, percentiles):
+    """
+    stata_pctile of the values counted in `counts` (a Series of counts
+    indexed by value), i.e. of each value repeated its number of times.
+    """
+    counts = counts[counts > 0].sort_index()
+    x = counts.index.to_numpy(dtype="float64")
+    cumulative = np.cumsum(counts.to_numpy())
+    n = cumulative[-1] if len(cumulative) else 0
+    if n == 0:
+        return np.full(len(percentiles), np.nan)
+    w = n * np.asarray(percentiles, dtype="float64") / 100
+    i = np.floor(w).astype("int64")
+    exact = w == i
+
+    def order_statistic(k):
+        # The k-th (from 0) of the sorted values
+        return x[np.searchsorted(cumulative, np.clip(k, 0, n - 1), side="right")]
+
+    lower, upper = order_statistic(i - 1), order_statistic(i)
+    return np.where(exact & (i > 0), (lower + upper) / 2, upper)
+
+
+def cut_point_counts(df):
+    """
+    Counts of the values which derive_demographics takes percentiles of
+    (IMD, and age among patients with an IMD) among the patients with T2DM,
+    to be added up over chunks of a cohort and passed to cut_points.
+    """
+    df = df[df["t2dm"] == 1]
+    imd = df["imd"].astype("float64")
+    has_imd = (imd != -1) & imd.notna()
+    return {
+        # As egen cut, whose groups are of every value including -1
+        "imd": imd.value_counts(),
+        "age": df["age"][has_imd].astype("float64").value_counts(),
+    }
+
+
+def cut_points(counts):
+    """IMD quintile cut points and age spline knots, from cut_point_counts."""
+    return {
+        "imd": stata_pctile_counts(counts["imd"], IMD_PERCENTILES),
+        "age": stata_pctile_counts(counts["age"], AGE_KNOT_PERCENTILES),
+    }
+
+
+def inrange(dates, lower, upper):
+    """Stata's inrange() for date columns; missing dates are never in range."""
+    return dates.ge(lower) & dates.le(upper)
+
+
+def as_dates(series, month=False):
+    """Parse a date column, unless it has already been read as dates."""
+    if pd.api.types.is_datetime64_any_dtype(series):
+        return series
+    if pd.api.types.is_integer_dtype(series):
+        # Day numbers, with months stored as their first day
+        days = series.astype("float64").where(series != NULL_DATE)
+        dates = pd.to_datetime(days, unit="D", errors="coerce")
+        return dates + pd.Timedelta(days=14) if month else dates
+    if month:
+        series = series.astype("string") + "-15"
+    return pd.to_datetime(series, format="%Y-%m-%d", errors="coerce")
+
+
+def convert_dates(df):
+    for column in FULL_DATES:
+        target = column if column.endswith("_date") else f"{column}_date"
+        df[target] = as_dates(df.pop(column))
+
+    for column, target in MONTH_DATES.items():
+        df[target] = as_dates(df.pop(column), month=True)
+
+    # The default deregistration date is 9999-12-31 and deaths may be
+    # recorded after the end of the study
+    df.loc[df["deregistered_date"] > END_DATE, "deregistered_date"] = pd.NaT
+    df.loc[df["died_date_ons_date"] > END_DATE, "died_date_ons_date"] = pd.NaT
+    return df
+
+
+def derive_demographics(df, cuts=None):
+    df["exp"] = df["exposure"].map(EXPOSURES).astype("Int8")
+
+    if not df["sex"].isin(["M", "F"]).all():
+        raise ValueError("sex must be one of 'M' or 'F'")
+    df["male"] = (df.pop("sex") == "M").astype("int8")
+
+    # Quintiles of IMD, reversed so that high is more deprived. As egen
+    # cut(), group(5) icodes: the breaks are percentiles of every value
+    # (-1, unknown, only being set missing after grouping) and intervals
+    # are closed on the left, so a value equal to a break (IMD is rounded
+    # to 100, so many are) is in the group above it
+    imd = df.pop("imd").astype("float64")
+    imd_cuts = stata_pctile(imd, IMD_PERCENTILES) if cuts is None else cuts["imd"]
+    quintile = np.searchsorted(imd_cuts, imd.to_numpy(), side="right") + 1
+    imd = imd.where(imd != -1)
+    df["imd"] = pd.Series(6 - quintile, index=df.index).where(imd.notna())
+    df = df[df["imd"].notna()].copy()
+    df["imd"] = df["imd"].astype("int8")
+
+    df["smoke"] = df.pop("smoking_status").map({"N": 1, "E": 2, "S": 3}).astype("Int8")
+    df["smoke_nomiss"] = df["smoke"].fillna(1).astype("int8")
+
+    ethnicity = pd.to_numeric(df["ethnicity"].astype(object))
+    df["ethnicity"] = ethnicity.fillna(6).astype("int8")
+
+    if "region" in df:
+        df["region_9"] = pd.Categorical(df.pop("region"), categories=REGIONS).codes + 1
+        df["region_9"] = df["region_9"].replace(0, np.nan).astype("Int8")
+        df["region_7"] = df["region_9"].map(REGION_7).astype("Int8")
+
+    if df["age"].isna().any():
+        raise ValueError("age must not be missing")
+    df["agegroup"] = pd.cut(
+        df["age"], [-np.inf, 50, 60, 70, 80, np.inf], right=False, labels=False
+    ).astype("int8") + 1
+
+    # Restricted cubic spline for age with 4 knots, as mkspline ..., cubic
+    age = df["age"].to_numpy(dtype="float64")
+    knots = stata_pctile(age, AGE_KNOT_PERCENTILES) if cuts is None else cuts["age"]
+    t_k, t_km1, scale = knots[-1], knots[-2], (knots[-1] - knots[0]) ** 2
+    df["age1"] = age
+    for i, t_i in enumerate(knots[:-2], start=2):
+        df[f"age{i}"] = (
+            np.maximum(age - t_i, 0) ** 3
+            - np.maximum(age - t_km1, 0) ** 3 * (t_k - t_i) / (t_k - t_km1)
+            + np.maximum(age - t_k, 0) ** 3 * (t_km1 - t_i) / (t_k - t_km1)
+        ) / scale
+    return df
+
+
+def derive_bmi(df):
+    # Set implausible BMIs to missing
+    df["bmi"] = df["bmi"].where(df["bmi"].between(15, 50))
+    bmicat = pd.cut(
+        df["bmi"], [-np.inf, 18.5, 25, 30, 35, 40, np.inf], right=False, labels=False
+    )
+    df["bmicat"] = (bmicat + 1).astype("Int8")
+    df["obese4cat"] = df["bmicat"].map({4: 2, 5: 3, 6: 4}).fillna(1).astype("int8")
+    df["obese4cat_withmiss"] = df["obese4cat"].where(df["bmicat"].notna()).astype("Int8")
+    return df
+
+
+def derive_blood_pressure(df):
+    # Only possible when bp_sys and bp_dias have been extracted
+    if not {"bp_sys", "bp_dias"} <= set(df.columns):
+        return df
+    sys_, dias = df["bp_sys"], df["bp_dias"]
+    bpcat = pd.Series(np.nan, index=df.index)
+    bpcat[(sys_ < 120) & (dias < 80)] = 1
+    bpcat[sys_.between(120, 130) & (dias < 80)] = 2
+    bpcat[sys_.between(130, 140) | dias.between(80, 90)] = 3
+    bpcat[(sys_ >= 140) | (dias >= 90)] = 4
+    bpcat[sys_.isna() | dias.isna() | (sys_ == 0) | (dias == 0)] = np.nan
+    df["bpcat"] = bpcat.astype("Int8")
+    df["bpcat_nomiss"] = df["bpcat"].fillna(1).astype("int8")
+    df["bphigh"] = (df["bpcat"] == 4).fillna(False).astype("int8")
+    return df
+
+
+def derive_comorbidities(df):
+    indexdate = df["indexdate"]
+    fiveybefore = indexdate - pd.to_timedelta(5 * 365.25, unit="D")
+    oneybefore = indexdate - pd.to_timedelta(365.25, unit="D")
+    earliest = pd.Timestamp("1900-01-01")
+
+    # Spleen problems (dysplenia/splenectomy/etc and sickle cell disease)
+    df["spleen"] = df[["dysplenia", "sickle_cell"]].max(axis=1)
+
+    def cancer_category(*columns):
+        category = pd.Series(1, index=df.index, dtype="int8")
+        for value, lower, upper in [
+            (4, earliest, fiveybefore),
+            (3, fiveybefore, oneybefore),
+            (2, oneybefore, indexdate),
+        ]:
+            in_window = np.logical_or.reduce(
+                [inrange(df[c], lower, upper) for c in columns]
+            )
+            category = category.mask(in_window, value)
+        return category
+
+    df["cancer_haem_cat"] = cancer_category("haem_cancer_date")
+    df["cancer_exhaem_cat"] = cancer_category("lung_cancer_date", "other_cancer_date")
+
+    # HIV, permanent immunodeficiency ever, OR temporary immunodeficiency
+    # or aplastic anaemia last year
+    df["other_immunosuppression"] = (
+        df[["hiv", "permanent_immunodeficiency"]].max(axis=1).fillna(0).astype(bool)
+        | inrange(df["temporary_immunodeficiency_date"], oneybefore, indexdate)
+        | inrange(df["aplastic_anaemia_date"], oneybefore, indexdate)
+    ).astype("int8")
+    return df
+
+
+def derive_egfr(df):
+    # Only possible when creatinine has been extracted
+    if "creatinine" not in df:
+        return df
+    creatinine = df["creatinine"].where(df["creatinine"].between(20, 3000))
+    scr_adj = creatinine / 88.4
+    female = df["male"] == 0
+    k = np.where(female, 0.7, 0.9)
+    alpha = np.where(female, -0.329, -0.411)
+    ratio = scr_adj / k
+    egfr = np.maximum(ratio**alpha, 1) * np.minimum(ratio**-1.209, 1) * 141
+    egfr = egfr * 0.993 ** df["age"]
+    df["egfr"] = egfr.where(~female, egfr * 1.018)
+
+    egfr_cat = pd.cut(df["egfr"], [0, 15, 30, 45, 60, 5000], right=False, labels=False)
+    df["ckd"] = egfr_cat.map({0: 5, 1: 4, 2: 3, 3: 2, 4: 0}).astype("Int8")
+    df["chronic_kidney_disease"] = (
+        df["ckd"].map({0: 0, 2: 1, 3: 1, 4: 1, 5: 1}).where(creatinine.notna(), 0)
+    ).astype("Int8")
+    df["reduced_kidney_function_cat"] = (
+        df["ckd"].map({0: 1, 2: 2, 3: 2, 4: 3, 5: 3}).where(creatinine.notna(), 1)
+    ).astype("Int8")
+    return df
+
+
+def derive_hba1c(df):
+    fifteenmbefore = df["indexdate"] - pd.to_timedelta(15 * 365.25 / 12, unit="D")
+
+    # Zero or negative values and measurements older than 15 months are
+    # treated as missing
+    for column in ["hba1c_percentage", "hba1c_mmol_per_mol"]:
+        value = df[column].where(df[column] > 0)
+        df[column] = value.mask(df[f"{column}_date"] < fifteenmbefore)
+
+    # Express all values as percentage, valid between 0 and 20
+    hba1c_pct = (df["hba1c_mmol_per_mol"] / 10.929 + 2.15).fillna(
+        df["hba1c_percentage"]
+    )
+    df["hba1c_pct"] = stata_round(hba1c_pct.where(hba1c_pct.between(0, 20)))
+
+    hba1ccat = pd.cut(
+        df["hba1c_pct"], [-np.inf, 6.5, 7.5, 8, 9, np.inf], right=False, labels=False
+    )
+    df["hba1ccat"] = hba1ccat.astype("Int8")
+    diabcat = hba1ccat.map({0: 1, 1: 1, 2: 2, 3: 2, 4: 2}).fillna(3)
+    df["diabcat"] = diabcat.astype("int8")
+    return df
+
+
+def derive_outcomes(df):
+    df["died"] = df["died_date_ons_date"].notna().astype("int8")
+
+    # One code per patient for the order of their outcomes, from which
+    # each flag is read
+    df["outcome_sequence"] = outcome_sequence(df)
+    flags = sequence_flags(df["outcome_sequence"], OUTCOME_SEQUENCES)
+    for name, flag in flags.items():
+        df[name] = flag.astype("int8")
+    return df
+
+
+def derive_cohort(df, cuts=None):
+    """
+    The analysis dataset. IMD quintiles and age knots are percentiles over
+    the whole cohort, so a chunk of it must be given the `cuts` of the
+    whole (see cut_points).
+    """
+    # Check population have T2DM
+    df = df[df["t2dm"] == 1].copy()
+    df["indexdate"] = INDEX_DATE
+
+    df = convert_dates(df)
+    df = derive_demographics(df, cuts)
+    df = derive_bmi(df)
+    df = derive_blood_pressure(df)
+    df = derive_comorbidities(df)
+    df = derive_egfr(df)
+    df = derive_hba1c(df)
+
+    keep = [c for c in KEEP if c in df]
+    df = df[keep].copy()
+    return derive_outcomes(df)
+
+
+def main(input_file=INPUT_FILE, output_file=OUTPUT_FILE):
+    df = read_cohort(input_file)
+    df = derive_cohort(df)
+    df.to_csv(output_file, index=False, date_format="%Y-%m-%d")
+
+
+if __name__ == "__main__":
+    main(*sys.argv[1:])
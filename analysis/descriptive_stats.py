@@ -0,0 +1,103 @@
+"""
+Outcomes by exposure group.
+
+Python port of section 1 of 000_cr_descriptive_cohort.do, which loops
+over each outcome flag and exposure group with a safecount per cell.
+Here the patients are counted once per outcome sequence code (see
+outcome_sequences.py) and exposure group, in one groupby, and the count
+of each outcome flag is the sum of the counts of the sequences it covers,
+so more outcomes only add rows to a small table of sequences.
+
+Writes output/tables/descriptive_stats.csv as the do-file: numPatients,
+numEvents and propEvents (a percentage, rounded to 0.1) of each outcome
+flag in each exposure group, with counts from 1 to 5 redacted, as
+safecount (see table_1.py).
+
+It also writes the patients with each sequence of outcomes in each
+exposure group, as counts and percentages, to
+output/outcome_sequences.csv, which is for checking the flags and not for
+release. Each group's sequences add up to its size, and each flag is a sum
+of sequences, so a flag count hidden by safecount is the difference of
+published cells of the two tables (e.g. comm_hosp less the patients with
+comm before hosp): the sequence table is a highly sensitive output.
+
+Run from the root of the repository:
+
+    python analysis/descriptive_stats.py [analysis dataset]
+"""
+
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+
+from derive_cohort import LABELS, OUTCOME_FLAGS, OUTCOME_SEQUENCES
+from derive_cohort import OUTPUT_FILE as INPUT_FILE
+from outcome_sequences import count_sequences, sequence_flags, sequence_label
+from table_1 import GROUPS, TABLES_DIR, safecount, stata_round, write_table
+
+OUTPUT_FILE = os.path.join(TABLES_DIR, "descriptive_stats.csv")
+# Not in TABLES_DIR: see above
+SEQUENCES_FILE = os.path.join("output", "outcome_sequences.csv")
+
+
+def _by_group(counts, sizes):
+    groups = list(GROUPS)
+    return counts.reindex(columns=groups, fill_value=0), safecount(
+        sizes.reindex(groups, fill_value=0)
+    )
+
+
+def descriptive_stats(sequence_counts, sizes, flags=OUTCOME_FLAGS):
+    """
+    The do-file's descriptive_stats table from the counts of each sequence
+    code (rows) in each exposure group (columns), and the group sizes.
+    """
+    counts, sizes = _by_group(sequence_counts, sizes)
+    covered = sequence_flags(
+        counts.index, {name: OUTCOME_SEQUENCES[name] for name in flags}
+    )
+    # (flags x sequences) @ (sequences x groups)
+    matrix = np.array([covered[name] for name in flags], dtype="int64")
+    events = safecount(
+        pd.DataFrame(matrix @ counts.to_numpy(), index=flags, columns=counts.columns)
+    )
+    proportions = stata_round(100 * events / sizes.to_numpy())
+    return pd.DataFrame(
+        {
+            "outcome": np.repeat(flags, len(counts.columns)),
+            "treatment": [LABELS["exp"][g] for g in counts.columns] * len(flags),
+            "numPatients": np.tile(sizes.to_numpy(), len(flags)),
+            "numEvents": events.to_numpy().ravel(),
+            "propEvents": proportions.to_numpy().ravel(),
+        }
+    )
+
+
+def sequence_table(sequence_counts, sizes):
+    """Counts and percentages of each outcome sequence by exposure group."""
+    counts, sizes = _by_group(sequence_counts, sizes)
+    counts = safecount(counts.astype("float64"))
+    percentages = stata_round(100 * counts / sizes.to_numpy())
+    columns = {"sequence": [sequence_label(code) for code in counts.index]}
+    for group, name in GROUPS.items():
+        columns[name] = counts[group].to_numpy()
+        columns[f"{name}_perc"] = percentages[group].to_numpy()
+    return pd.DataFrame(columns)
+
+
+def write_descriptive_stats(
+    sequence_counts, sizes, output_file=OUTPUT_FILE, sequences_file=SEQUENCES_FILE
+):
+    write_table(descriptive_stats(sequence_counts, sizes), output_file)
+    write_table(sequence_table(sequence_counts, sizes), sequences_file)
+
+
+def main(input_file=INPUT_FILE):
+    df = pd.read_csv(input_file, usecols=["exp", "outcome_sequence"])
+    write_descriptive_stats(count_sequences(df), df["exp"].value_counts())
+
+
+if __name__ == "__main__":
+    main(*sys.argv[1:])
@@ -0,0 +1,246 @@
+"""
+Drug eras: continuous periods of treatment built from prescription dates.
+
+The study's exposure flags (`metformin_3mths`, `dpp4`, ...) only record
+whether there was any prescription in the 90 days before start_date. An
+era instead treats each prescription as covering `days_supply` days from
+its date, and joins prescriptions into one era while the gaps between
+their supply are at most `grace_period` days. Eras are built for every
+patient (and drug class) at once: the prescriptions are sorted by patient
+and date, a running maximum of the supply end finds where each era starts,
+and a cumulative sum numbers the eras, so the cost is that of the sort.
+
+Against the eras of a reference class (e.g. metformin), a new era of
+another class (e.g. a DPP-4 inhibitor) which starts at day s is an
+
+    add-on  if a reference era began before s and continues to at least
+            s + grace_period, i.e. treatment was intensified;
+    switch  if a reference era began before s and ended within
+            grace_period days either side of s, i.e. it was replaced.
+
+`drug_era` is not a query type cohortextractor knows about, so its
+variables cannot be put in study_definition.py. They are added to the
+processed definitions evaluated by the local extractor instead:
+
+    definitions = add_variables(
+        study.covariate_definitions,
+        dpp4i_add_on_date=drug_era(
+            dpp4i_med_codes,
+            between=["2020-06-03", "2020-09-01"],
+            returning="add_on_date",
+            reference_codelist=metformin_med_codes,
+        ),
+    )
+    LocalExtractor(definitions, tables).extract()
+"""
+
+from collections import namedtuple
+
+import numpy as np
+from cohortextractor.process_covariate_definitions import handle_time_period_options
+
+from event_tables import NULL_DATE
+from medication_codes import DRUG_CLASSES, IntegerCodelists, drug_class_index
+
+# A standard NHS prescription is for 28 days, and a gap of up to 30 days
+# without supply is the usual persistence window for drug eras
+DAYS_SUPPLY = 28
+GRACE_PERIOD = 30
+
+# returning -> column type of the variable
+ERA_RETURNING = {
+    "binary_flag": "bool",
+    "number_of_eras": "int",
+    "era_start_date": "date",
+    "era_end_date": "date",
+    "switch_date": "date",
+    "add_on_date": "date",
+}
+
+# Eras sorted by group and start; `groups` is the patient position, or
+# position * number of classes + class when built for several classes.
+# `ends` is the last day with supply.
+Eras = namedtuple("Eras", ["groups", "starts", "ends"])
+
+
+def build_eras(groups, dates, days_supply=DAYS_SUPPLY, grace_period=GRACE_PERIOD):
+    """The Eras of prescriptions given by group (e.g. patient) and date."""
+    groups = np.asarray(groups, dtype="int64")
+    dates = np.asarray(dates, dtype="int64")
+    present = dates != NULL_DATE
+    groups, dates = groups[present], dates[present]
+    # One sort of (group, date) packed into an int64, rather than a lexsort
+    keys = np.sort((groups << 32) | (dates - NULL_DATE))
+    groups, dates = keys >> 32, (keys & (2**32 - 1)) + NULL_DATE
+    if not len(dates):
+        return Eras(groups, dates.astype("int32"), dates.astype("int32"))
+
+    # First day without supply, made to increase from group to group so
+    # that one running maximum serves all of them
+    supply_ends = dates + days_supply - NULL_DATE
+    running_end = np.maximum.accumulate((groups << 32) | supply_ends) & (2**32 - 1)
+    running_end += NULL_DATE
+
+    starts_era = np.ones(len(dates), dtype=bool)
+    starts_era[1:] = (groups[1:] != groups[:-1]) | (
+        dates[1:] > running_end[:-1] + grace_period
+    )
+    first = np.flatnonzero(starts_era)
+    last = np.append(first[1:] - 1, len(dates) - 1)
+    return Eras(
+        groups[first],
+        dates[first].astype("int32"),
+        (running_end[last] - 1).astype("int32"),
+    )
+
+
+def class_eras(
+    codes, positions, dates, days_supply=DAYS_SUPPLY, grace_period=GRACE_PERIOD
+):
+    """
+    Eras of every DRUG_CLASSES class over a medications table, as
+    (positions, classes, Eras) with classes indexing DRUG_CLASSES. A
+    combination product counts towards each of its classes.
+    """
+    tags = drug_class_index().match(codes)
+    rows, classes = np.nonzero(tags)
+    width = len(DRUG_CLASSES)
+    eras = build_eras(
+        np.asarray(positions, dtype="int64")[rows] * width + classes,
+        np.asarray(dates)[rows],
+        days_supply,
+        grace_period,
+    )
+    return eras.groups // width, eras.groups % width, eras
+
+
+def _at(bound, positions):
+    return bound if np.ndim(bound) == 0 else np.asarray(bound)[positions]
+
+
+def in_period(starts, positions, between):
+    """Which era starts fall in an inclusive window of day numbers."""
+    start, end = between or (None, None)
+    mask = np.ones(len(starts), dtype=bool)
+    for bound, compare in [(start, np.greater_equal), (end, np.less_equal)]:
+        if bound is not None:
+            bound = _at(bound, positions)
+            mask &= compare(starts, bound) & (bound != NULL_DATE)
+    return mask
+
+
+def classify_starts(eras, reference, grace_period=GRACE_PERIOD):
+    """
+    For each era in `eras`, whether it is an add-on to, or a switch from,
+    an era in `reference` (both built by patient position).
+    """
+    keys = (reference.groups << 32) | (reference.starts.astype("int64") - NULL_DATE)
+    starts = eras.starts.astype("int64")
+    # The latest reference era which began before each era
+    found = np.searchsorted(keys, (eras.groups << 32) | (starts - NULL_DATE)) - 1
+    valid = found >= 0
+    found[~valid] = 0
+    if len(keys):
+        valid &= reference.groups[found] == eras.groups
+    reference_end = reference.ends[found].astype("int64") if len(keys) else starts
+    add_on = valid & (reference_end >= starts + grace_period)
+    switch = valid & ~add_on & (reference_end >= starts - grace_period)
+    return add_on, switch
+
+
+def drug_era(
+    codelist,
+    between=None,
+    on_or_before=None,
+    on_or_after=None,
+    returning="era_start_date",
+    find_first_match_in_period=None,
+    find_last_match_in_period=None,
+    reference_codelist=None,
+    days_supply=DAYS_SUPPLY,
+    grace_period=GRACE_PERIOD,
+    date_format="YYYY-MM-DD",
+    hidden=False,
+):
+    """
+    A processed ("drug_era", arguments) definition for covariate_definitions.
+    The window selects eras by their start date; switch_date and add_on_date
+    need a reference_codelist.
+    """
+    if returning not in ERA_RETURNING:
+        raise ValueError(f"drug_era cannot return {returning}")
+    if returning in ("switch_date", "add_on_date") and reference_codelist is None:
+        raise ValueError(f"drug_era returning {returning} needs a reference_codelist")
+    arguments = handle_time_period_options(dict(locals()))
+    arguments["column_type"] = ERA_RETURNING[returning]
+    if arguments["column_type"] != "date":
+        arguments["date_format"] = None
+    return "drug_era", arguments
+
+
+def add_variables(covariate_definitions, **variables):
+    """The definitions with `variables` added, keeping population last."""
+    definitions = {
+        name: definition
+        for name, definition in covariate_definitions.items()
+        if name != "population"
+    }
+    definitions.update(variables)
+    definitions["population"] = covariate_definitions["population"]
+    return definitions
+
+
+def drug_era_query(
+    tables,
+    codelist,
+    between=None,
+    returning="era_start_date",
+    find_first_match_in_period=None,
+    reference_codelist=None,
+    days_supply=DAYS_SUPPLY,
+    grace_period=GRACE_PERIOD,
+    **kwargs,
+):
+    """Evaluate a drug_era definition for the local extractor."""
+    medications = tables["medications"]
+    codelists = IntegerCodelists([codelist, reference_codelist or []])
+    # Eras of the codelist in even groups, and of the reference in odd ones
+    rows, which = np.nonzero(codelists.match(medications["code"].to_numpy()))
+    eras = build_eras(
+        tables.positions("medications")[rows] * 2 + which,
+        medications["date"].to_numpy()[rows],
+        days_supply,
+        grace_period,
+    )
+    is_target = eras.groups % 2 == 0
+    target = Eras(eras.groups[is_target] // 2, *(a[is_target] for a in eras[1:]))
+
+    selected = in_period(target.starts, target.groups, between)
+    if returning in ("switch_date", "add_on_date"):
+        reference = Eras(
+            eras.groups[~is_target] // 2, *(a[~is_target] for a in eras[1:])
+        )
+        add_on, switch = classify_starts(target, reference, grace_period)
+        selected &= add_on if returning == "add_on_date" else switch
+
+    n = len(tables)
+    positions = target.groups[selected]
+    if returning == "binary_flag":
+        out = np.zeros(n, dtype="int8")
+        out[positions] = 1
+        return out
+    if returning == "number_of_eras":
+        return np.bincount(positions, minlength=n).astype("int64")
+
+    dates = target.ends if returning == "era_end_date" else target.starts
+    dates = dates[selected]
+    # Eras are sorted by start within each patient, so keep the first or
+    # last selected era per patient as with other queries' matches
+    keep = np.ones(len(positions), dtype=bool)
+    if find_first_match_in_period:
+        keep[1:] = positions[1:] != positions[:-1]
+    else:
+        keep[:-1] = positions[1:] != positions[:-1]
+    out = np.full(n, NULL_DATE, dtype="int32")
+    out[positions[keep]] = dates[keep]
+    return out
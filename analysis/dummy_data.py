@@ -0,0 +1,524 @@
+"""
+Fast dummy cohorts drawn from the study definition's return_expectations.
+
+Produces a file in the same layout as `generate_cohort` with
+`expectations_population`, following the same rules for each column
+(default_expectations merged with the variable's return_expectations,
+value_from dates sharing their source's incidence, `between` windows
+applied to dates, IMD treated as a category), but every column is drawn as
+a whole numpy array from a seeded generator and rows are written in
+chunks, so tens of millions of rows can be produced in bounded memory.
+
+Rather than drawing every variable independently, rows are made consistent
+with the study's expressions:
+
+  * categorised_as variables (t2dm, exposure, ...) are computed from the
+    drawn values of the variables in their expressions, as the extractor
+    would, unless those include hidden variables which are not output
+  * variables linked by those expressions or by the population expression
+    are drawn jointly: every combination of their states (present or not,
+    or the category/value) is enumerated, weighted by its probability
+    under the independent expectations, restricted to the combinations
+    that satisfy the population expression and reweighted so that the
+    outermost categorised_as variables follow their own category ratios,
+    as do the variables in KEEP_EXPECTATIONS (whose incidence the
+    population would otherwise distort, e.g. the hospital diabetes flags
+    of t2dm) where they are drawn jointly. Rows are then drawn from those
+    combinations, so every row is in the population and no rows are
+    rejected.
+
+Chunk k is drawn from `default_rng([seed, k])`, so a given seed and chunk
+size always produce the same file.
+
+Run from the root of the repository:
+
+    python analysis/dummy_data.py [rows] [output] [seed]
+"""
+
+import functools
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pa_csv
+
+from date_expressions import is_iso_date
+from event_tables import NULL_DATE, to_day
+from expressions import categorise, compile_tree, conjuncts, names_of, parse
+from extraction_plan import required_variables
+
+# Not output/input.csv, which is generate_cohort's
+OUTPUT_FILE = "output/dummy_input.csv"
+CHUNK_SIZE = 1_000_000
+MAX_AGE = 110
+# Largest number of combinations enumerated for a group of variables
+MAX_COMBINATIONS = 1_000_000
+# Passes of iterative proportional fitting to the composites' ratios
+FITTING_PASSES = 20
+# Variables drawn jointly with others which still follow their own
+# return_expectations
+KEEP_EXPECTATIONS = ["t1dm_hospital", "t2dm_hospital"]
+
+# Flags are written from text, which is much faster than formatting ints
+FLAG_TEXT = pa.array(["0", "1"])
+
+
+def merge(defaults, overrides):
+    """Recursively merge return_expectations into default_expectations."""
+    merged = dict(defaults)
+    for key, value in (overrides or {}).items():
+        if isinstance(value, dict) and isinstance(merged.get(key), dict):
+            merged[key] = merge(merged[key], value)
+        else:
+            merged[key] = value
+    return merged
+
+
+@functools.lru_cache(maxsize=None)
+def population_age_weights():
+    """
+    Probability of each age 0..MAX_AGE-1, following the UK population bands
+    cohortextractor uses for `population_ages`.
+    """
+    import cohortextractor
+    import pandas as pd
+
+    bands = pd.read_csv(
+        os.path.join(
+            os.path.dirname(cohortextractor.__file__), "uk_population_bands_2018.csv"
+        ),
+        thousands=",",
+    )
+    ends = bands["band"].str.split("-").str[1].astype(int).to_numpy()
+    counts = bands["range"].to_numpy(dtype="float64")
+    ages = np.arange(MAX_AGE)
+    # Each age takes a fifth of its five-year band (the last band is open)
+    band = np.minimum(np.searchsorted(ends, ages), len(ends) - 1)
+    weights = counts[band] / 5
+    return weights / weights.sum()
+
+
+class ColumnSpec:
+    """
+    How to draw one variable. Values are held as the local extractor holds
+    them: dates as int32 day numbers (NULL_DATE if missing), flags as int8,
+    categories as object arrays ("" if missing) and numbers as int64 or
+    float64 (0 if missing, as cohortextractor's dummy data has it).
+    """
+
+    def __init__(self, name, query_type, arguments, expectations):
+        self.name = name
+        self.query_type = query_type
+        self.arguments = arguments
+        self.expectations = expectations
+        self.column_type = arguments["column_type"]
+        self.kind = self.column_type
+        if (
+            self.column_type == "str"
+            or arguments.get("returning") == "index_of_multiple_deprivation"
+            or (query_type == "categorised_as" and self.column_type == "date")
+        ):
+            # As in cohortextractor, IMD (an int rounded to the nearest 100)
+            # and categorised_as dates are drawn like categories
+            self.kind = "category"
+        # The date column whose missing values this column shares
+        self.date_column = None
+
+    @property
+    def universal(self):
+        return self.expectations.get("rate") == "universal"
+
+    @property
+    def incidence(self):
+        if self.universal:
+            return 1.0
+        incidence = self.expectations.get("incidence")
+        if incidence is None:
+            raise ValueError(f"{self.name}: return_expectations needs an incidence")
+        return incidence
+
+    @property
+    def missing(self):
+        if self.kind == "date":
+            return NULL_DATE
+        if self.kind == "category" and self.column_type == "str":
+            return ""
+        return 0
+
+    def labels(self):
+        """Category labels and their probabilities."""
+        ratios = self.expectations["category"]["ratios"]
+        p = np.array(list(ratios.values()), dtype="float64")
+        if self.column_type == "str":
+            labels = np.array([str(label) for label in ratios], dtype=object)
+        else:
+            labels = np.array([int(label) for label in ratios], dtype="int64")
+        return labels, p / p.sum()
+
+    def sample_days(self, rng, n):
+        """Day numbers drawn from the date expectations, before `between`."""
+        date = self.expectations.get("date") or {}
+        if "earliest" not in date or "latest" not in date:
+            raise ValueError(f"{self.name} must define date earliest and latest")
+        earliest, latest = to_day(date["earliest"]), to_day(date["latest"])
+        elapsed = latest - earliest
+        rate = self.expectations.get("rate", "exponential_increase")
+        u = rng.random(n)
+        if rate == "exponential_increase":
+            # Exponential with scale elapsed/10, truncated to the range
+            scale = elapsed * 0.1
+            offsets = -scale * np.log1p(-u * -np.expm1(-elapsed / scale))
+        elif rate == "uniform":
+            offsets = u * elapsed
+        else:
+            raise ValueError(f"{self.name}: unsupported date rate {rate!r}")
+        return (latest - offsets.astype("int64")).astype("int32")
+
+    def in_window(self, days):
+        keep = np.ones(len(days), dtype=bool)
+        start, end = self.arguments.get("between") or (None, None)
+        for bound, inside in [(start, np.greater_equal), (end, np.less_equal)]:
+            # Bounds relative to other variables are not applied
+            if is_iso_date(bound):
+                keep &= inside(days, to_day(bound))
+        return keep
+
+    def draw(self, rng, n, present=None):
+        """Draw n values; `present` overrides the incidence if given."""
+        if present is None:
+            present = rng.random(n) < self.incidence
+        if self.kind == "date":
+            days = self.sample_days(rng, n)
+            days[~(present & self.in_window(days))] = NULL_DATE
+            return days
+        if self.kind == "bool":
+            return present.astype("int8")
+        if self.kind == "category":
+            labels, p = self.labels()
+            values = labels[rng.choice(len(labels), size=n, p=p)]
+        elif self.kind == "int":
+            spec = self.expectations["int"]
+            distribution = spec["distribution"]
+            if distribution == "population_ages":
+                values = rng.choice(MAX_AGE, size=n, p=population_age_weights())
+            elif distribution == "normal":
+                values = rng.normal(spec["mean"], spec["stddev"], n).astype("int64")
+            elif distribution == "poisson":
+                values = rng.poisson(spec["mean"], n)
+            else:
+                raise ValueError(f"{self.name}: unsupported int {distribution!r}")
+        elif self.kind == "float":
+            spec = self.expectations["float"]
+            if spec["distribution"] != "normal":
+                raise ValueError(f"{self.name}: only normal floats are supported")
+            values = rng.normal(spec["mean"], spec["stddev"], n)
+        else:
+            raise ValueError(f"{self.name}: unsupported column type {self.kind}")
+        return np.where(present, values, self.missing)
+
+    def states(self):
+        """
+        The distinct states of this variable and their probabilities, for
+        drawing it jointly with others. Dates are represented only by
+        whether they are present (within `between`), by a sample date.
+        """
+        incidence = self.incidence
+        if self.kind == "bool":
+            return np.array([0, 1], dtype="int8"), np.array([1 - incidence, incidence])
+        if self.kind == "date":
+            days = self.sample_days(np.random.default_rng(0), 100_000)
+            inside = self.in_window(days)
+            if not inside.any():
+                raise ValueError(f"{self.name}: no expected dates are within range")
+            p = incidence * inside.mean()
+            values = np.array([NULL_DATE, days[inside][0]], dtype="int32")
+            return values, np.array([1 - p, p])
+        if self.kind == "category":
+            labels, p = self.labels()
+            values = np.concatenate([labels, np.array([self.missing], labels.dtype)])
+            return values, np.append(p * incidence, 1 - incidence)
+        if self.kind == "int" and (
+            self.expectations["int"]["distribution"] == "population_ages"
+        ):
+            return np.arange(MAX_AGE), population_age_weights()
+        raise ValueError(
+            f"{self.name}: {self.kind} values cannot be drawn to satisfy expressions"
+        )
+
+    def draw_given(self, rng, values):
+        """Complete values drawn as states(), i.e. draw the actual dates."""
+        if self.kind != "date":
+            return values
+        present = values != NULL_DATE
+        days = np.full(len(values), NULL_DATE, dtype="int32")
+        todo = np.flatnonzero(present)
+        while len(todo):
+            drawn = self.sample_days(rng, len(todo))
+            inside = self.in_window(drawn)
+            days[todo[inside]] = drawn[inside]
+            todo = todo[~inside]
+        return days
+
+    def to_arrow(self, values):
+        if self.column_type == "date" and self.kind == "date":
+            array = pa.array(values, type=pa.date32(), mask=values == NULL_DATE)
+            length = {"YYYY": 4, "YYYY-MM": 7}.get(self.arguments.get("date_format"))
+            if length:
+                array = pc.utf8_slice_codeunits(array.cast(pa.string()), 0, length)
+            return array
+        if self.column_type == "bool":
+            return FLAG_TEXT.take(pa.array((values != 0).astype("int8")))
+        if self.kind == "category" and values.dtype.kind == "O":
+            return pa.array(values, type=pa.string(), mask=values == self.missing)
+        if self.kind == "category":
+            # Numeric categories (IMD) are written as their labels
+            labels = np.unique(values)
+            text = [None if label == self.missing else str(label) for label in labels]
+            codes = np.searchsorted(labels, values)
+            return pa.array(text, type=pa.string()).take(pa.array(codes))
+        return pa.array(values)
+
+
+class JointGroup:
+    """
+    Variables drawn together so that `conditions` (parsed expressions over
+    them) hold, with the composites in `targets` following their ratios.
+    """
+
+    def __init__(self, specs, composites, conditions, targets, definitions):
+        self.specs = specs
+        states = [spec.states() for spec in specs]
+        sizes = [len(values) for values, _ in states]
+        total = int(np.prod(sizes, dtype="float64"))
+        if total > MAX_COMBINATIONS:
+            names = ", ".join(spec.name for spec in specs)
+            raise ValueError(f"Too many combinations to enumerate for {names}")
+        index = np.unravel_index(np.arange(total), sizes)
+        self.combinations = {
+            spec.name: values[i]
+            for spec, (values, _), i in zip(specs, states, index)
+        }
+        weights = np.ones(total)
+        for (_, p), i in zip(states, index):
+            weights *= p[i]
+
+        columns = dict(self.combinations)
+        dates = {spec.name for spec in specs if spec.kind == "date"}
+        for name in composites:
+            arguments = definitions[name][1]
+            columns[name] = categorise(
+                arguments["category_definitions"],
+                columns,
+                dates,
+                total,
+                arguments["column_type"],
+            )
+        for condition in conditions:
+            weights = weights * np.broadcast_to(
+                compile_tree(condition)(columns, dates), total
+            )
+        if not weights.any():
+            raise ValueError("No combination of values satisfies the population")
+
+        # Iterative proportional fitting to each target's category ratios
+        for _ in range(FITTING_PASSES):
+            for name, ratios in targets.items():
+                for category, ratio in ratios.items():
+                    selected = columns[name] == category
+                    mass = weights[selected].sum()
+                    if mass > 0:
+                        weights[selected] *= ratio / mass
+        self.p = weights / weights.sum()
+
+    def draw(self, rng, n):
+        chosen = rng.choice(len(self.p), size=n, p=self.p)
+        return {
+            spec.name: spec.draw_given(rng, self.combinations[spec.name][chosen])
+            for spec in self.specs
+        }
+
+
+class DummyCohort:
+    """The output columns of a StudyDefinition and how to draw them."""
+
+    def __init__(self, study, keep_expectations=KEEP_EXPECTATIONS):
+        defaults = getattr(study, "default_expectations", None) or {}
+        definitions = self.definitions = study.covariate_definitions
+        specs = {}
+        for name, (query_type, arguments) in definitions.items():
+            if name == "population" or arguments.get("hidden"):
+                continue
+            if query_type == "value_from":
+                source = definitions[arguments["source"]][1]
+                expectations = source["return_expectations"]
+            else:
+                expectations = arguments.get("return_expectations")
+            specs[name] = ColumnSpec(
+                name, query_type, arguments, merge(defaults, expectations)
+            )
+        for name, spec in specs.items():
+            if spec.query_type == "value_from":
+                source = specs.get(spec.arguments["source"])
+                if source is not None:
+                    source.date_column = name
+        # Dates first, as generate_cohort does, then patient_id last
+        self.specs = [spec for spec in specs.values() if spec.column_type == "date"]
+        self.specs += [spec for spec in specs.values() if spec.column_type != "date"]
+
+        def leaves(names):
+            return {
+                name
+                for name in required_variables(definitions, names)
+                if definitions[name][0] != "categorised_as"
+            }
+
+        # Composites computed from their inputs, in definition order
+        self.composites = [
+            name
+            for name in specs
+            if specs[name].query_type == "categorised_as"
+            and leaves([name]) <= set(specs)
+        ]
+        conditions = []
+        query_type, arguments = definitions["population"]
+        if query_type == "categorised_as":
+            expressions = [
+                expression
+                for category, expression in arguments["category_definitions"].items()
+                if category == 1
+            ]
+            for expression in expressions[:1]:
+                for term in conjuncts(parse(expression)):
+                    # Terms which need variables that are not output (or not
+                    # computed from their inputs) are ignored
+                    needed = required_variables(definitions, names_of(term))
+                    if all(
+                        name in self.composites
+                        or name in specs
+                        and definitions[name][0] != "categorised_as"
+                        for name in needed
+                    ):
+                        conditions.append(term)
+
+        # Group the variables linked by composites and conditions
+        group_of = {}
+        for linked in [leaves([name]) for name in self.composites] + [
+            leaves(names_of(term)) for term in conditions
+        ]:
+            merged = set(linked)
+            for name in linked:
+                merged |= group_of.get(name, set())
+            for name in merged:
+                group_of[name] = merged
+        groups = []
+        for members in group_of.values():
+            if any(members is group for group in groups):
+                continue
+            groups.append(members)
+
+        self.groups = []
+        for members in groups:
+            composites = [
+                name for name in self.composites if leaves([name]) <= members
+            ]
+            inputs = set()
+            for name in composites:
+                inputs |= required_variables(definitions, [name]) - {name}
+            targets = {
+                name: specs[name].expectations["category"]["ratios"]
+                for name in composites
+                if name not in inputs and "category" in specs[name].expectations
+            }
+            for name in keep_expectations:
+                if name in members:
+                    targets[name] = dict(zip(*specs[name].states()))
+            self.groups.append(
+                JointGroup(
+                    [specs[name] for name in specs if name in members],
+                    composites,
+                    [term for term in conditions if leaves(names_of(term)) <= members],
+                    targets,
+                    definitions,
+                )
+            )
+        self.grouped = set(group_of)
+
+    def draw(self, rng, n, first_patient_id):
+        """Draw a chunk of n rows as an Arrow table."""
+        values = {}
+        for group in self.groups:
+            values.update(group.draw(rng, n))
+        specs = [spec for spec in self.specs if spec.name not in values]
+        # Dates first, since value_from sources share their incidence
+        for spec in sorted(specs, key=lambda spec: spec.kind != "date"):
+            if spec.name in self.composites:
+                continue
+            present = None
+            if spec.date_column is not None:
+                present = values[spec.date_column] != NULL_DATE
+            values[spec.name] = spec.draw(rng, n, present)
+        dates = {spec.name for spec in self.specs if spec.kind == "date"}
+        for name in self.composites:
+            arguments = self.definitions[name][1]
+            values[name] = categorise(
+                arguments["category_definitions"],
+                values,
+                dates,
+                n,
+                arguments["column_type"],
+            )
+
+        columns = {spec.name: spec.to_arrow(values[spec.name]) for spec in self.specs}
+        columns["patient_id"] = pa.array(
+            np.arange(first_patient_id, first_patient_id + n, dtype="int64")
+        )
+        return pa.table(columns)
+
+
+def generate(study, population_size, output_file, seed=0, chunk_size=CHUNK_SIZE):
+    """
+    Write a dummy cohort of `population_size` rows to a CSV file. Each chunk
+    is written on a background thread while the next one is drawn.
+    """
+    cohort = DummyCohort(study)
+    # Quoting every string is slow, so only do it if some label needs it
+    labels = [
+        str(label)
+        for spec in cohort.specs
+        for label in spec.expectations.get("category", {}).get("ratios", {})
+    ]
+    special = any(set(label) & set(',"\r\n') for label in labels)
+    options = pa_csv.WriteOptions(quoting_style="needed" if special else "none")
+    writer = None
+    pending = None
+    with ThreadPoolExecutor(1) as pool:
+        try:
+            for number, start in enumerate(range(0, population_size, chunk_size)):
+                n = min(chunk_size, population_size - start)
+                rng = np.random.default_rng([seed, number])
+                chunk = cohort.draw(rng, n, start + 1)
+                if writer is None:
+                    writer = pa_csv.CSVWriter(
+                        output_file, chunk.schema, write_options=options
+                    )
+                if pending is not None:
+                    pending.result()
+                pending = pool.submit(writer.write_table, chunk)
+            if pending is not None:
+                pending.result()
+        finally:
+            if writer is not None:
+                writer.close()
+
+
+def main(population_size=100_000, output_file=OUTPUT_FILE, seed=0):
+    from study_definition import study
+
+    generate(study, int(population_size), output_file, int(seed))
+
+
+if __name__ == "__main__":
+    main(*sys.argv[1:])
@@ -0,0 +1,214 @@
+"""
+Local stand-in for the backend tables queried by the study definition.
+
+Each table is a DataFrame with the columns listed in TABLES. Dates are held
+as int32 day numbers since 1970-01-01 (NULL_DATE where missing), which is
+what the local extractor compares against, and codes as strings, except
+for dm+d medication codes, which are int64 (-1 where missing or invalid).
+Multi-valued ICD-10 fields (admission diagnoses, causes of death) are
+"||"-separated, as in the TPP schema.
+"""
+
+import hashlib
+import os
+
+import numpy as np
+import pandas as pd
+
+NULL_DATE = np.iinfo("int32").min
+# End date of a registration or address which is still current
+OPEN_DATE = int(np.datetime64("9999-12-31", "D").astype("int64"))
+
+TABLES = {
+    "patients": ["patient_id", "date_of_birth", "sex"],
+    "registrations": ["patient_id", "start_date", "end_date", "region"],
+    "addresses": ["patient_id", "start_date", "end_date", "imd"],
+    "clinical_events": ["patient_id", "date", "code", "numeric_value"],
+    "medications": ["patient_id", "date", "code"],
+    "admissions": ["patient_id", "admission_date", "diagnoses"],
+    "ons_deaths": ["patient_id", "date", "underlying_cause", "causes"],
+    "sgss_tests": ["patient_id", "specimen_date", "pathogen", "result"],
+}
+
+DATE_COLUMNS = {
+    "date_of_birth",
+    "start_date",
+    "end_date",
+    "date",
+    "admission_date",
+    "specimen_date",
+}
+
+STRING_COLUMNS = {
+    "sex",
+    "region",
+    "code",
+    "diagnoses",
+    "underlying_cause",
+    "causes",
+    "pathogen",
+    "result",
+}
+
+# Tables whose "code" column holds dm+d codes, kept as int64
+INTEGER_CODE_TABLES = {"medications"}
+
+# The column each event table is filtered on by `between`
+EVENT_DATE_COLUMN = {
+    "clinical_events": "date",
+    "medications": "date",
+    "admissions": "admission_date",
+    "ons_deaths": "date",
+    "sgss_tests": "specimen_date",
+}
+
+
+def to_day(value):
+    """Convert a YYYY-MM-DD string (or None) to a day number (or None)."""
+    if value is None:
+        return None
+    return int(np.datetime64(value, "D").astype("int64"))
+
+
+def to_days(values):
+    """Convert an array of dates or YYYY-MM-DD strings to int32 day numbers."""
+    values = pd.Series(values)
+    if pd.api.types.is_integer_dtype(values):
+        return values.to_numpy(dtype="int32")
+    if pd.api.types.is_datetime64_any_dtype(values):
+        dates = values.to_numpy().astype("datetime64[D]")
+    else:
+        dates = values.fillna("NaT").to_numpy(dtype=str).astype("datetime64[D]")
+    days = dates.astype("int64")
+    days[np.isnat(dates)] = NULL_DATE
+    return days.astype("int32")
+
+
+def to_int_codes(values):
+    """
+    Convert numeric codes (strings, or None) to int64, with -1 for missing
+    or non-numeric codes. Each distinct code is only parsed once.
+    """
+    if pd.api.types.is_integer_dtype(np.asarray(values).dtype):
+        return np.asarray(values, dtype="int64")
+    ids, distinct = pd.factorize(pd.Series(values, dtype=object))
+    distinct = np.asarray(distinct, dtype=str)
+    # Up to 18 digits always fits in an int64
+    valid = np.char.isdigit(distinct) & (np.char.str_len(distinct) <= 18)
+    codes = np.full(len(distinct) + 1, -1, dtype="int64")
+    codes[:-1][valid] = distinct[valid].astype("int64")
+    # factorize gives missing values the id -1, i.e. the final -1 here
+    return codes[ids]
+
+
+def format_dates(days, date_format=None):
+    """Format day numbers as strings, e.g. for date_format="YYYY-MM"."""
+    length = {"YYYY": 4, "YYYY-MM": 7}.get(date_format, 10)
+    days = np.asarray(days)
+    missing = days == NULL_DATE
+    text = np.where(missing, 0, days).astype("datetime64[D]").astype("<U10")
+    text = text.astype(f"<U{length}")
+    return np.where(missing, "", text).astype(object)
+
+
+class EventTables:
+    """
+    A set of tables plus, for each, the position of every row's patient in
+    the sorted array of patient ids (which is also the row order of every
+    extracted column).
+    """
+
+    def __init__(self, tables):
+        missing = set(TABLES) - set(tables)
+        if missing:
+            raise ValueError(f"Missing tables: {', '.join(sorted(missing))}")
+        self.tables = {}
+        for name, table in tables.items():
+            table = table.copy(deep=False)
+            for column in DATE_COLUMNS & set(table.columns):
+                table[column] = to_days(table[column])
+            if name in INTEGER_CODE_TABLES:
+                table["code"] = to_int_codes(table["code"])
+            self.tables[name] = table
+        self.patient_ids = np.sort(
+            self.tables["patients"]["patient_id"].to_numpy(dtype="int64")
+        )
+        self._positions = {}
+        self._fingerprint = None
+        self._names = list(self.tables)
+        self._restricted_from = None
+
+    def __getitem__(self, name):
+        if name not in self.tables:
+            # The tables of a restriction are only filtered when first used
+            parent, keep, new_positions = self._restricted_from
+            rows = keep[parent.positions(name)]
+            self._positions[name] = new_positions[parent.positions(name)[rows]]
+            self.tables[name] = parent[name][rows].reset_index(drop=True)
+            if len(self.tables) == len(self._names):
+                self._restricted_from = None
+        return self.tables[name]
+
+    def __len__(self):
+        return len(self.patient_ids)
+
+    def positions(self, name):
+        table = self[name]
+        if name not in self._positions:
+            ids = table["patient_id"].to_numpy(dtype="int64")
+            self._positions[name] = np.searchsorted(self.patient_ids, ids)
+        return self._positions[name]
+
+    def restrict(self, keep):
+        """
+        The same tables holding only the patients selected by `keep`, a
+        boolean array aligned with patient_ids.
+        """
+        restricted = EventTables.__new__(EventTables)
+        restricted.tables = {}
+        restricted._names = self._names
+        restricted.patient_ids = self.patient_ids[keep]
+        restricted._positions = {}
+        # Each kept patient's position among the kept patients
+        restricted._restricted_from = (self, keep, np.cumsum(keep) - 1)
+        digest = hashlib.sha1(self.fingerprint().encode())
+        digest.update(np.packbits(keep).tobytes())
+        restricted._fingerprint = digest.hexdigest()
+        return restricted
+
+    def fingerprint(self):
+        """
+        A hash identifying the tables' contents, and so the patients and
+        their order. Tables loaded from a directory are identified by their
+        files' sizes and modification times rather than read again.
+        """
+        if self._fingerprint is None:
+            digest = hashlib.sha1()
+            for name in sorted(self.tables):
+                digest.update(name.encode())
+                hashes = pd.util.hash_pandas_object(self.tables[name], index=False)
+                digest.update(hashes.to_numpy().tobytes())
+            self._fingerprint = digest.hexdigest()
+        return self._fingerprint
+
+    @classmethod
+    def from_directory(cls, directory):
+        """Load <table>.feather or <table>.csv for each table in TABLES."""
+        tables = {}
+        digest = hashlib.sha1()
+        for name in TABLES:
+            path = os.path.join(directory, name)
+            if os.path.exists(f"{path}.feather"):
+                path = f"{path}.feather"
+                tables[name] = pd.read_feather(path)
+            else:
+                path = f"{path}.csv"
+                tables[name] = pd.read_csv(
+                    path, dtype=dict.fromkeys(STRING_COLUMNS, str)
+                )
+            stat = os.stat(path)
+            source = f"{os.path.abspath(path)}:{stat.st_size}:{stat.st_mtime_ns}"
+            digest.update(source.encode())
+        loaded = cls(tables)
+        loaded._fingerprint = digest.hexdigest()
+        return loaded
@@ -0,0 +1,255 @@
+"""
+Parsing of the expressions used by `patients.satisfying` and
+`patients.categorised_as`, e.g. "t1dm_gp AND NOT t2dm_hospital".
+
+Each expression is parsed once into a small tree of tuples and compiled
+into a function which evaluates it over whole columns at a time with numpy
+boolean operations, rather than row by row:
+
+    ("or", a, b, ...)   ("and", a, b, ...)   ("not", a)
+    ("compare", op, left, right)   ("name", name)   ("value", literal)
+
+Missing values follow the extractor's conventions: NULL_DATE for dates,
+NaN for numbers (treated as 0, like the backend) and "" for strings. A
+comparison against a missing date is false.
+"""
+
+import functools
+import operator
+import re
+
+import numpy as np
+import pandas as pd
+
+from event_tables import NULL_DATE, to_day
+
+TOKEN = re.compile(
+    r"""\s*(?:
+        (?P<number>\d+(?:\.\d+)?)
+        |(?P<string>"[^"]*"|'[^']*')
+        |(?P<operator>>=|<=|!=|=|>|<|\(|\))
+        |(?P<name>[A-Za-z_][A-Za-z0-9_]*)
+    )\s*""",
+    re.VERBOSE,
+)
+
+KEYWORDS = {"AND", "OR", "NOT"}
+
+COMPARISONS = {
+    "=": operator.eq,
+    "!=": operator.ne,
+    ">": operator.gt,
+    ">=": operator.ge,
+    "<": operator.lt,
+    "<=": operator.le,
+}
+
+
+def tokenize(expression):
+    """Yield (kind, token) pairs, where kind is a TOKEN group or "keyword"."""
+    position = 0
+    expression = expression.strip()
+    while position < len(expression):
+        match = TOKEN.match(expression, position)
+        if not match or match.end() == position:
+            raise ValueError(f"Could not parse expression: {expression!r}")
+        position = match.end()
+        kind, token = match.lastgroup, match.group(match.lastgroup)
+        if kind == "name" and token.upper() in KEYWORDS:
+            kind, token = "keyword", token.upper()
+        yield kind, token
+
+
+def names_in(expression):
+    """The variables an expression refers to, in order of first use."""
+    if expression.strip() == "DEFAULT":
+        return []
+    names = [token for kind, token in tokenize(expression) if kind == "name"]
+    return list(dict.fromkeys(names))
+
+
+@functools.lru_cache(maxsize=None)
+def parse(expression):
+    """Parse an expression into a tree, with SQL precedence: OR < AND < NOT."""
+    tokens = list(tokenize(expression))
+    position = 0
+
+    def peek():
+        return tokens[position] if position < len(tokens) else (None, None)
+
+    def take(kind=None, token=None):
+        nonlocal position
+        found = peek()
+        if found == (None, None) or (kind, token) not in [(None, None), found]:
+            raise ValueError(f"Could not parse expression: {expression!r}")
+        position += 1
+        return found
+
+    def chain(kind, keyword, operand):
+        operands = [operand()]
+        while peek() == ("keyword", keyword):
+            take()
+            operands.append(operand())
+        return operands[0] if len(operands) == 1 else (kind, *operands)
+
+    def either():
+        return chain("or", "OR", both)
+
+    def both():
+        return chain("and", "AND", negation)
+
+    def negation():
+        if peek() == ("keyword", "NOT"):
+            take()
+            return ("not", negation())
+        return comparison()
+
+    def comparison():
+        left = operand()
+        kind, token = peek()
+        if kind == "operator" and token in COMPARISONS:
+            take()
+            return ("compare", token, left, operand())
+        return left
+
+    def operand():
+        kind, token = take()
+        if kind == "operator" and token == "(":
+            node = either()
+            take("operator", ")")
+            return node
+        if kind == "name":
+            return ("name", token)
+        if kind == "number":
+            return ("value", float(token) if "." in token else int(token))
+        if kind == "string":
+            return ("value", token[1:-1])
+        raise ValueError(f"Could not parse expression: {expression!r}")
+
+    tree = either()
+    if position != len(tokens):
+        raise ValueError(f"Could not parse expression: {expression!r}")
+    return tree
+
+
+def is_true(values, is_date=False):
+    """Truth of a column, e.g. a bare variable name in an expression."""
+    if is_date:
+        return values != NULL_DATE
+    if values.dtype.kind == "O":
+        return pd.notna(values) & (values != "") & (values != 0)
+    if values.dtype.kind == "f":
+        return np.nan_to_num(values) != 0
+    return values != 0
+
+
+def conjuncts(tree):
+    """The terms which must all be true, e.g. [a, b] for "a AND b"."""
+    return list(tree[1:]) if tree[0] == "and" else [tree]
+
+
+def names_of(tree):
+    """The variables a parsed expression refers to."""
+    if tree[0] == "name":
+        return {tree[1]}
+    if tree[0] == "value":
+        return set()
+    children = tree[2:] if tree[0] == "compare" else tree[1:]
+    return set().union(*map(names_of, children))
+
+
+def compile_expression(expression):
+    """
+    Compile an expression into a function of (columns, date_columns) which
+    returns a boolean array, where columns maps each name used to an array
+    aligned by patient and date_columns is the set of those holding dates.
+    """
+    return compile_tree(parse(expression))
+
+
+@functools.lru_cache(maxsize=None)
+def compile_tree(tree):
+    """As compile_expression, for an already parsed expression."""
+
+    def build(node):
+        kind = node[0]
+        if kind in ("or", "and"):
+            combine = np.logical_or if kind == "or" else np.logical_and
+            parts = [build(child) for child in node[1:]]
+            return lambda columns, dates: functools.reduce(
+                combine, (part(columns, dates) for part in parts)
+            )
+        if kind == "not":
+            part = build(node[1])
+            return lambda columns, dates: ~part(columns, dates)
+        if kind == "compare":
+            return build_comparison(*node[1:])
+        if kind == "name":
+            name = node[1]
+            return lambda columns, dates: is_true(columns[name], name in dates)
+        value = np.bool_(node[1])
+        return lambda columns, dates: value
+
+    def build_comparison(op, left, right):
+        compare = COMPARISONS[op]
+
+        def operand(node, other, columns, dates):
+            if node[0] == "value":
+                if isinstance(node[1], str) and other[0] == "name":
+                    if other[1] in dates:
+                        # A date literal compared with a date column
+                        return to_day(node[1])
+                return node[1]
+            column = columns[node[1]]
+            if column.dtype.kind == "O" and other[0] == "value":
+                if not isinstance(other[1], str):
+                    # A string column compared with a number is converted to
+                    # numbers, as by the backend, with "" as 0
+                    column = pd.to_numeric(pd.Series(column).replace("", 0))
+                    column = column.to_numpy()
+            if column.dtype.kind == "f":
+                return np.nan_to_num(column)
+            return column
+
+        def evaluate(columns, dates):
+            result = np.asarray(
+                compare(
+                    operand(left, right, columns, dates),
+                    operand(right, left, columns, dates),
+                )
+            )
+            for node in (left, right):
+                if node[0] == "name" and node[1] in dates:
+                    result = result & (columns[node[1]] != NULL_DATE)
+            return result
+
+        return evaluate
+
+    return build(tree)
+
+
+def categorise(category_definitions, columns, dates, n, column_type=None):
+    """
+    Evaluate a categorised_as variable for n patients: each takes the first
+    category whose expression is true, else the DEFAULT category. The
+    result is int8 for flags, object for strings and numeric otherwise.
+    """
+    default = None
+    trees = []
+    for category, expression in category_definitions.items():
+        if expression.strip() == "DEFAULT":
+            default = category
+        else:
+            trees.append((category, parse(expression)))
+
+    if column_type == "str":
+        out = np.full(n, "" if default is None else default, dtype=object)
+    else:
+        dtype = {"bool": "int8", "float": "float64"}.get(column_type, "int64")
+        out = np.full(n, default or 0, dtype=dtype)
+    unassigned = np.ones(n, dtype=bool)
+    for category, tree in trees:
+        matched = compile_tree(tree)(columns, dates) & unassigned
+        out[matched] = category
+        unassigned &= ~matched
+    return out
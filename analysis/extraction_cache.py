@@ -0,0 +1,115 @@
+"""
+Cache of extracted columns, so that a rerun only computes the variables
+which were added or changed.
+
+Each variable is fingerprinted from everything that decides its values:
+its query type and arguments (with every codelist replaced by a hash of
+its codes), the fingerprints of the variables it reads, and the
+fingerprint of the tables (see EventTables.fingerprint), which also pins
+the patients and their order. Arguments which only affect how a column is
+written, such as date_format, are left out. A column computed with the
+same fingerprint before is loaded from the cache, aligned by patient with
+the rest, instead of being computed again.
+
+Columns are stored one .npy file per fingerprint under CACHE_DIR (output/
+is not checked in). Delete the directory to start afresh.
+"""
+
+import hashlib
+import json
+import os
+import tempfile
+
+import numpy as np
+
+from extraction_plan import inputs_of
+
+CACHE_DIR = os.path.join("output", ".column_cache")
+
+# Bump when a change to the extractor alters the values it computes
+CACHE_VERSION = 1
+
+# Arguments which do not change a variable's values
+IGNORED_ARGUMENTS = {"return_expectations", "hidden", "date_format"}
+
+_codelist_hashes = {}
+
+
+def codelist_hash(codes):
+    """A hash of a codelist's codes (and categories), in any order."""
+    key = id(codes)
+    if key not in _codelist_hashes or _codelist_hashes[key][0] is not codes:
+        entries = sorted(json.dumps(entry) for entry in codes)
+        digest = hashlib.sha1("\n".join(entries).encode()).hexdigest()
+        # Keep the codelist alive, so that its id is not reused
+        _codelist_hashes[key] = (codes, digest)
+    return _codelist_hashes[key][1]
+
+
+def canonical(value):
+    """A JSON-serialisable form of an argument value."""
+    if hasattr(value, "system"):
+        # A cohortextractor Codelist
+        return {"codelist": codelist_hash(value), "system": value.system}
+    if isinstance(value, (list, tuple)):
+        return [canonical(v) for v in value]
+    if isinstance(value, dict):
+        return {str(k): canonical(v) for k, v in sorted(value.items(), key=str)}
+    if isinstance(value, (str, int, float, bool)) or value is None:
+        return value
+    return repr(value)
+
+
+def fingerprint(name, covariate_definitions, data_key, memo):
+    """The fingerprint of variable `name`, memoised (with its inputs) in memo."""
+    if name not in memo:
+        query_type, arguments = covariate_definitions[name]
+        inputs = inputs_of(query_type, arguments)
+        content = {
+            "version": CACHE_VERSION,
+            "data": data_key,
+            "query_type": query_type,
+            "arguments": canonical(
+                {k: v for k, v in arguments.items() if k not in IGNORED_ARGUMENTS}
+            ),
+            "inputs": {
+                source: fingerprint(source, covariate_definitions, data_key, memo)
+                for source in inputs
+            },
+        }
+        memo[name] = hashlib.sha1(
+            json.dumps(content, sort_keys=True).encode()
+        ).hexdigest()
+    return memo[name]
+
+
+class ColumnCache:
+    def __init__(self, directory=CACHE_DIR):
+        self.directory = directory
+        self.hits = []
+        self.misses = []
+
+    def path(self, key):
+        return os.path.join(self.directory, key[:2], f"{key}.npy")
+
+    def load(self, key):
+        """The column stored under key, or None."""
+        try:
+            # Object columns (strings) are pickled by np.save; the cache
+            # only ever holds files this module wrote
+            return np.load(self.path(key), allow_pickle=True)
+        except (OSError, ValueError, EOFError):
+            return None
+
+    def save(self, key, column):
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Write then rename, so an interrupted run leaves no partial file
+        handle, temporary = tempfile.mkstemp(dir=os.path.dirname(path))
+        try:
+            with os.fdopen(handle, "wb") as f:
+                np.save(f, np.asarray(column), allow_pickle=True)
+            os.replace(temporary, path)
+        except BaseException:
+            os.unlink(temporary)
+            raise
@@ -0,0 +1,293 @@
+"""
+Plan how the local extractor evaluates a study definition.
+
+Works on `StudyDefinition.covariate_definitions`, i.e. the processed
+`(query_type, arguments)` pairs in which every window has been normalised
+to `between=(start, end)`.
+
+Variables which read the same event table over the same date window are
+grouped into a single Scan. The extractor filters the table to the window
+once, tags each remaining event with every codelist it matches and
+produces all of the group's columns from that one pass, rather than
+scanning the table again for every variable. Within a scan, variables
+that match the same events and differ only in what they return (such as
+`hospitalised_covid` and `hospitalised_covid_date`) form a single query.
+
+The plan also records which variables each unit of work (a scan, patient
+query, derived or composite variable) reads, so that the extractor can run
+independent units concurrently and start each composite as soon as the
+variables in its expressions are ready.
+"""
+
+from collections import namedtuple
+
+from date_expressions import columns_in, parse_date_expression
+from event_tables import to_day
+from expressions import conjuncts, names_in, names_of, parse
+
+# Query type -> the event table it reads
+EVENT_QUERIES = {
+    "with_these_clinical_events": "clinical_events",
+    "most_recent_bmi": "clinical_events",
+    "with_these_medications": "medications",
+    "admitted_to_hospital": "admissions",
+    "with_these_codes_on_death_certificate": "ons_deaths",
+    "died_from_any_cause": "ons_deaths",
+    "with_test_result_in_sgss": "sgss_tests",
+}
+
+# Patient queries which read a whole event table all the same
+EVENT_PATIENT_QUERIES = {"drug_era": "medications"}
+
+# Arguments of event queries which the local extractor does not implement
+UNSUPPORTED_EVENT_ARGUMENTS = [
+    "ignore_days_where_these_codes_occur",
+    "episode_defined_as",
+]
+
+# Arguments which only change what is returned from the matching events,
+# not which events match
+RETURN_ARGUMENTS = {
+    "returning",
+    "date_format",
+    "find_first_match_in_period",
+    "find_last_match_in_period",
+    "include_date_of_match",
+    "include_month",
+    "return_expectations",
+    "hidden",
+    "column_type",
+}
+
+
+class Scan(namedtuple("Scan", ["table", "window", "queries"])):
+    """
+    One pass over an event table. Each query is a list of variables which
+    match the same events and differ only in what they return, e.g. a flag
+    and the date of the first match.
+    """
+
+    @property
+    def variables(self):
+        return [name for query in self.queries for name in query]
+
+
+# A unit of work: `kind` is "scan", "patient", "derived" or "composite",
+# `item` the Scan or variable name and `inputs` the variables it reads
+Task = namedtuple("Task", ["kind", "item", "inputs"])
+
+
+class ExtractionPlan:
+    def __init__(
+        self, scans, patient_queries, derived, composites, inputs=None, available=()
+    ):
+        self.scans = scans
+        self.patient_queries = patient_queries
+        self.derived = derived
+        self.composites = composites
+        inputs = inputs or {}
+
+        # A scan waits for the variables its windows are relative to
+        self.tasks = []
+        for scan in scans:
+            names = [name for v in scan.variables for name in inputs.get(v, [])]
+            self.tasks.append(Task("scan", scan, list(dict.fromkeys(names))))
+        for kind, names in [
+            ("patient", patient_queries),
+            ("derived", derived),
+            ("composite", composites),
+        ]:
+            self.tasks.extend(Task(kind, name, inputs.get(name, [])) for name in names)
+
+        producer = {}
+        for i, task in enumerate(self.tasks):
+            for name in task.item.variables if task.kind == "scan" else [task.item]:
+                producer[name] = i
+        # Task index -> indexes of the tasks it has to wait for
+        self.dependencies = {}
+        for i, task in enumerate(self.tasks):
+            needed = [name for name in task.inputs if name not in available]
+            unknown = [name for name in needed if name not in producer]
+            if unknown:
+                raise ValueError(
+                    f"{task.item} refers to undefined variables: {', '.join(unknown)}"
+                )
+            self.dependencies[i] = {producer[name] for name in needed}
+        self.order = topological_order(self.dependencies)
+
+    def __repr__(self):
+        lines = []
+        for scan in self.scans:
+            lines.append(
+                f"scan {scan.table} {format_window(scan.window)}: "
+                + ", ".join("+".join(query) for query in scan.queries)
+            )
+        for label, names in [
+            ("patient", self.patient_queries),
+            ("derived", self.derived),
+            ("composite", self.composites),
+        ]:
+            if names:
+                lines.append(f"{label}: " + ", ".join(names))
+        return "\n".join(lines)
+
+
+def window_of(arguments):
+    """
+    The (start, end) window of a query as day numbers, None if open. Bounds
+    relative to another variable are kept as their date expression.
+    """
+    start, end = arguments.get("between") or (None, None)
+    return tuple(
+        to_day(bound) if parse_date_expression(bound) is None else bound
+        for bound in (start, end)
+    )
+
+
+def format_window(window):
+    start, end = window
+    return "[{}, {}]".format(
+        "-" if start is None else start, "-" if end is None else end
+    )
+
+
+def freeze(value):
+    if isinstance(value, (list, tuple)):
+        return tuple(freeze(v) for v in value)
+    if isinstance(value, dict):
+        return tuple(sorted((k, freeze(v)) for k, v in value.items()))
+    return value
+
+
+def match_key(query_type, arguments):
+    """Everything about a query that decides which events it matches."""
+    return (query_type,) + tuple(
+        sorted(
+            (key, freeze(value))
+            for key, value in arguments.items()
+            if key not in RETURN_ARGUMENTS and key != "between"
+        )
+    )
+
+
+def topological_order(dependencies):
+    """Task indexes ordered so that each comes after everything it needs."""
+    order, state = [], {}
+
+    def visit(i, path):
+        if state.get(i) == "done":
+            return
+        if state.get(i) == "visiting":
+            raise ValueError(f"Circular dependency between tasks {path}")
+        state[i] = "visiting"
+        for j in sorted(dependencies[i]):
+            visit(j, path + [j])
+        state[i] = "done"
+        order.append(i)
+
+    for i in sorted(dependencies):
+        visit(i, [i])
+    return order
+
+
+def inputs_of(query_type, arguments):
+    """The variables a query reads."""
+    if query_type == "value_from":
+        return [arguments["source"]]
+    if query_type == "categorised_as":
+        names = []
+        for expression in arguments["category_definitions"].values():
+            names.extend(names_in(expression))
+        return list(dict.fromkeys(names))
+    return list(dict.fromkeys(columns_in(arguments)))
+
+
+def required_variables(covariate_definitions, names):
+    """The given variables plus everything they read, directly or not."""
+    required, pending = set(), list(names)
+    while pending:
+        name = pending.pop()
+        if name not in required:
+            required.add(name)
+            pending.extend(inputs_of(*covariate_definitions[name]))
+    return required
+
+
+def population_stages(covariate_definitions):
+    """
+    Split extraction into stages which narrow down the population before
+    the bulk of the variables are computed.
+
+    Returns a list of (variables, condition) pairs. Each stage computes its
+    variables and then keeps only the patients for whom `condition` (a
+    parsed expression, see expressions.py) holds. The population
+    expression's top-level AND terms are applied first if they need no
+    event table scan (e.g. age, sex, imd), then the rest; the final stage
+    computes every remaining variable for the surviving patients.
+    """
+    query_type, arguments = covariate_definitions["population"]
+    categories = arguments.get("category_definitions", {})
+    expressions = [e for c, e in categories.items() if c == 1 and e != "DEFAULT"]
+    if query_type != "categorised_as" or len(expressions) != 1:
+        return [(list(covariate_definitions), None)]
+
+    def needs_scan(term):
+        return any(
+            covariate_definitions[name][0] in {**EVENT_QUERIES, **EVENT_PATIENT_QUERIES}
+            for name in required_variables(covariate_definitions, names_of(term))
+        )
+
+    terms = conjuncts(parse(expressions[0]))
+    cheap = [term for term in terms if not needs_scan(term)]
+    costly = [term for term in terms if needs_scan(term)]
+
+    stages, done = [], set()
+    for group in [cheap, costly]:
+        if not group:
+            continue
+        names = set().union(*map(names_of, group))
+        variables = required_variables(covariate_definitions, names) - done
+        condition = group[0] if len(group) == 1 else ("and", *group)
+        stages.append(([v for v in covariate_definitions if v in variables], condition))
+        done |= variables
+    stages.append(([v for v in covariate_definitions if v not in done], None))
+    return stages
+
+
+def plan_extraction(covariate_definitions, variables=None, available=()):
+    """
+    Plan the extraction of `variables` (default: all of them), given that
+    the variables in `available` have already been computed.
+    """
+    scans = {}
+    patient_queries = []
+    derived = []
+    composites = []
+    inputs = {}
+
+    for name, (query_type, arguments) in covariate_definitions.items():
+        if variables is not None and name not in variables:
+            continue
+        inputs[name] = inputs_of(query_type, arguments)
+        if query_type in EVENT_QUERIES:
+            key = (EVENT_QUERIES[query_type], window_of(arguments))
+            queries = scans.setdefault(key, {})
+            queries.setdefault(match_key(query_type, arguments), []).append(name)
+        elif query_type == "value_from":
+            derived.append(name)
+        elif query_type == "categorised_as":
+            composites.append(name)
+        else:
+            patient_queries.append(name)
+
+    return ExtractionPlan(
+        [
+            Scan(key[0], key[1], list(queries.values()))
+            for key, queries in scans.items()
+        ],
+        patient_queries,
+        derived,
+        composites,
+        inputs,
+        available,
+    )
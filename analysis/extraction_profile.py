@@ -0,0 +1,189 @@
+"""
+Per-variable profile of a local extraction.
+
+An ExtractionProfile given to LocalExtractor times every task of the plan
+(a scan of an event table, a patient query, a derived or composite
+variable) and records, for each variable:
+
+  seconds              wall time; a scan's shared work (filtering,
+                       tagging and sorting its events) is split evenly
+                       between its variables, on top of each query's own
+  rows_scanned         event table rows the task read (a scan counts the
+                       rows in its window, once per scan)
+  rows_returned        patients for whom the variable is true, i.e. has
+                       a value other than 0, "" or missing
+  peak_memory_bytes    peak of the memory traced by tracemalloc during the
+                       task, above what was in use when it started; with
+                       several workers, tasks running at the same time
+                       share one measurement, so this is approximate
+  cache                "hit" or "miss" when extracting with a ColumnCache
+
+It also records the wall time of each stage of a staged extraction (see
+population_stages in extraction_plan.py), with the number of patients it
+started from.
+
+The command line of local_extractor.py writes the report as JSON to
+logs/ and prints the variables which took longest.
+"""
+
+import json
+import os
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+from datetime import datetime
+
+from expressions import is_true
+
+LOG_DIR = "logs"
+
+
+class ExtractionProfile:
+    def __init__(self):
+        self.started = datetime.now()
+        self.tasks = []
+        self.stages = []
+        self.variables = {}
+        self.seconds = None
+        self.peak_memory = None
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._start = None
+
+    def start(self):
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+        self._start = time.perf_counter()
+
+    def stop(self):
+        self.seconds = time.perf_counter() - self._start
+        self.peak_memory = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+    @contextmanager
+    def measure(self, label, variables):
+        """Time a task producing `variables`, collecting what it records."""
+        task = {
+            "task": label,
+            "variables": list(variables),
+            "rows_scanned": 0,
+            "variable_seconds": dict.fromkeys(variables, 0.0),
+        }
+        self._local.task = task
+        baseline = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+        start = time.perf_counter()
+        try:
+            yield task
+        finally:
+            task["seconds"] = time.perf_counter() - start
+            task["peak_memory_bytes"] = max(
+                tracemalloc.get_traced_memory()[1] - baseline, 0
+            )
+            self._local.task = None
+            with self._lock:
+                self.tasks.append(task)
+
+    @contextmanager
+    def stage(self, variables, patients):
+        """Time a stage computing `variables` for a number of patients."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stages.append(
+                {
+                    "stage": len(self.stages) + 1,
+                    "variables": len(variables),
+                    "patients": patients,
+                    "seconds": time.perf_counter() - start,
+                }
+            )
+
+    def scanned(self, rows):
+        """Count rows read by the current task."""
+        task = getattr(self._local, "task", None)
+        if task is not None:
+            task["rows_scanned"] += rows
+
+    @contextmanager
+    def timing(self, variables):
+        """Time work within the current task done for `variables` alone."""
+        start = time.perf_counter()
+        yield
+        task = getattr(self._local, "task", None)
+        if task is not None:
+            share = (time.perf_counter() - start) / len(variables)
+            for name in variables:
+                task["variable_seconds"][name] += share
+
+    def returned(self, name, column, is_date):
+        """Record how many patients a finished variable has a value for."""
+        count = int(is_true(column, is_date).sum())
+        with self._lock:
+            self.variables.setdefault(name, {})["rows_returned"] = count
+
+    def report(self, cache=None):
+        """The profile as a dict, ready for JSON."""
+        variables = {}
+        for task in self.tasks:
+            names = task["variables"]
+            own = task["variable_seconds"]
+            shared = (task["seconds"] - sum(own.values())) / len(names)
+            for name in names:
+                variables[name] = {
+                    "task": task["task"],
+                    "seconds": own[name] + shared,
+                    "rows_scanned": task["rows_scanned"],
+                    "rows_returned": self.variables.get(name, {}).get("rows_returned"),
+                    "peak_memory_bytes": task["peak_memory_bytes"],
+                    "cache": None,
+                }
+        if cache is not None:
+            for outcome, names in [("hit", cache.hits), ("miss", cache.misses)]:
+                for name in names:
+                    variables.setdefault(name, {"seconds": 0.0})["cache"] = outcome
+        return {
+            "started": self.started.isoformat(timespec="seconds"),
+            "seconds": self.seconds,
+            "peak_memory_bytes": self.peak_memory,
+            "stages": self.stages,
+            "tasks": [
+                {k: v for k, v in task.items() if k != "variable_seconds"}
+                for task in self.tasks
+            ],
+            "variables": variables,
+        }
+
+    def write(self, cache=None, directory=LOG_DIR):
+        """Write the report to a timestamped JSON file; returns its path."""
+        os.makedirs(directory, exist_ok=True)
+        stamp = self.started.strftime("%Y%m%d-%H%M%S")
+        path = os.path.join(directory, f"extraction_profile-{stamp}.json")
+        with open(path, "w") as f:
+            json.dump(self.report(cache), f, indent=2)
+        return path
+
+    def summary(self, cache=None, top=10):
+        """A table of the `top` slowest variables."""
+        variables = self.report(cache)["variables"]
+        slowest = sorted(variables.items(), key=lambda item: -item[1]["seconds"])
+        lines = [
+            f"{'variable':<32} {'seconds':>8} {'scanned':>10} {'returned':>9}"
+            f" {'peak MB':>8} {'cache':>5}"
+        ]
+        for name, stats in slowest[:top]:
+            returned = stats.get("rows_returned")
+            lines.append(
+                f"{name:<32} {stats['seconds']:>8.3f}"
+                f" {stats.get('rows_scanned', 0):>10}"
+                f" {'' if returned is None else returned:>9}"
+                f" {stats.get('peak_memory_bytes', 0) / 2**20:>8.1f}"
+                f" {stats.get('cache') or '':>5}"
+            )
+        lines.append(
+            f"total {self.seconds:.3f}s over {len(variables)} variables,"
+            f" peak traced memory {self.peak_memory / 2**20:.1f} MB"
+        )
+        return "\n".join(lines)
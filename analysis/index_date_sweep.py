@@ -0,0 +1,93 @@
+"""
+Extract the cohort for a series of index dates in one run.
+
+Every date in study_definition.py is fixed relative to `start_date`
+(2020-09-01). For each requested index date the processed variable
+definitions are shifted by the number of days between it and start_date,
+and evaluated by the local extractor. The extractors share one dict of
+Timelines, so each query's matching events are tagged and sorted by
+patient and date once, and every later index date only binary-searches
+its windows in them (see `timeline_window` in local_extractor.py).
+
+Windows are shifted by whole days, so a window of "one year" before
+2020-09-01 (366 days, as 2020 is a leap year) stays 366 days long.
+
+Output files are named like those of `generate_cohort --index-date-range`.
+Run from the root of the repository:
+
+    python analysis/index_date_sweep.py <tables directory> [first] [last] [months]
+
+e.g. `... 2020-03-01 2021-06-01 1` for the first of every month in between.
+"""
+
+import os
+import sys
+
+import numpy as np
+
+from date_expressions import DATE_ARGUMENTS, is_iso_date
+from event_tables import EventTables, to_day
+from local_extractor import LocalExtractor
+
+OUTPUT_DIR = "output"
+
+
+def shift_date(value, days):
+    # Dates relative to another variable move with that variable
+    if not is_iso_date(value):
+        return value
+    return str(np.datetime64(value, "D") + days)
+
+
+def shift_definitions(covariate_definitions, days):
+    """The definitions with every date argument moved by `days` days."""
+    shifted = {}
+    for name, (query_type, arguments) in covariate_definitions.items():
+        arguments = dict(arguments)
+        for key in DATE_ARGUMENTS:
+            value = arguments.get(key)
+            if isinstance(value, (list, tuple)):
+                arguments[key] = type(value)(shift_date(v, days) for v in value)
+            elif value is not None:
+                arguments[key] = shift_date(value, days)
+        shifted[name] = (query_type, arguments)
+    return shifted
+
+
+def monthly(first, last, months=1):
+    """Index dates from `first` to `last` inclusive, every `months` months."""
+    start = np.datetime64(first, "D")
+    day = start - start.astype("datetime64[M]").astype("datetime64[D]")
+    dates = []
+    month = start.astype("datetime64[M]")
+    while month.astype("datetime64[D]") + day <= np.datetime64(last, "D"):
+        dates.append(str(month.astype("datetime64[D]") + day))
+        month += months
+    return dates
+
+
+def sweep(covariate_definitions, tables, index_dates, base_date, workers=None):
+    """Yield (index date, cohort) for each index date."""
+    if not isinstance(tables, EventTables):
+        tables = EventTables(tables)
+    timelines = {}
+    for index_date in index_dates:
+        days = to_day(index_date) - to_day(base_date)
+        definitions = shift_definitions(covariate_definitions, days)
+        extractor = LocalExtractor(definitions, tables, timelines=timelines)
+        yield index_date, extractor.extract(workers)
+
+
+def main(tables_directory, first="2020-03-01", last="2021-06-01", months=1):
+    from study_definition import start_date, study
+
+    tables = EventTables.from_directory(tables_directory)
+    index_dates = monthly(first, last, int(months))
+    for index_date, cohort in sweep(
+        study.covariate_definitions, tables, index_dates, start_date
+    ):
+        cohort.to_csv(os.path.join(OUTPUT_DIR, f"input_{index_date}.csv"), index=False)
+
+
+if __name__ == "__main__":
+    main(*sys.argv[1:])
@@ -0,0 +1,789 @@
+"""
+Evaluate a study definition against local stand-in tables.
+
+This lets us run `study_definition.py` end to end outside the backend,
+against the tables described in event_tables.py, with the same output
+layout as `generate_cohort`. Variables are evaluated following the plan
+built by extraction_plan.py, so event tables are scanned once per
+(table, window) group rather than once per variable. The command line
+runs a staged extraction, which narrows the tables down to the patients
+who meet the population criteria before computing the other variables,
+and loads every variable whose definition and inputs are unchanged since
+an earlier run from the column cache (see extraction_cache.py). It also
+writes a profile of the time and memory each variable took to logs/ (see
+extraction_profile.py).
+
+Run from the root of the repository:
+
+    python analysis/local_extractor.py <tables directory> [output] [workers]
+"""
+
+import os
+import sys
+from collections import namedtuple
+from contextlib import nullcontext
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import numpy as np
+import pandas as pd
+
+from date_expressions import (
+    DATE_ARGUMENTS,
+    evaluate_date_expression,
+    parse_date_expression,
+)
+from drug_eras import drug_era_query
+from event_tables import (
+    EVENT_DATE_COLUMN,
+    NULL_DATE,
+    TABLES,
+    EventTables,
+    format_dates,
+    to_day,
+)
+from expressions import categorise, compile_tree, names_of
+from extraction_cache import ColumnCache, fingerprint
+from extraction_profile import ExtractionProfile
+from extraction_plan import (
+    EVENT_QUERIES,
+    UNSUPPORTED_EVENT_ARGUMENTS,
+    format_window,
+    match_key,
+    plan_extraction,
+    population_stages,
+)
+from medication_codes import IntegerCodelists
+from prefix_index import PrefixIndex
+
+OUTPUT_FILE = "output/input_local.csv"
+
+# CTV3 code for a recorded body mass index
+BMI_CODES = ["22K.."]
+
+# Table-specific names for the generic kinds of value returned
+RETURNING = {"date_admitted": "date", "date_of_death": "date"}
+
+UNSUPPORTED_ADMISSION_ARGUMENTS = [
+    "with_these_primary_diagnoses",
+    "with_these_procedures",
+    "with_admission_method",
+    "with_source_of_admission",
+    "with_discharge_destination",
+    "with_patient_classification",
+    "with_admission_treatment_function_code",
+    "with_administrative_category",
+    "with_at_least_one_day_in_critical_care",
+]
+
+
+def age_in_years(date_of_birth, on):
+    """Whole years between arrays (or scalars) of day numbers."""
+    born = np.asarray(date_of_birth, dtype="int64").astype("datetime64[D]")
+    on = np.broadcast_to(np.asarray(on, dtype="int64"), born.shape)
+    on = on.astype("datetime64[D]")
+
+    def month_day(days):
+        months = days.astype("datetime64[M]")
+        day = (days - months.astype("datetime64[D]")).astype("int64")
+        return (months.astype("int64") % 12) * 32 + day
+
+    years = on.astype("datetime64[Y]").astype("int64") - born.astype(
+        "datetime64[Y]"
+    ).astype("int64")
+    return years - (month_day(on) < month_day(born))
+
+
+def in_window(dates, window):
+    """Indices of the dates that fall within an inclusive (start, end)."""
+    start, end = window
+    mask = dates != NULL_DATE
+    if start is not None:
+        mask &= dates >= start
+    if end is not None:
+        mask &= dates <= end
+    return np.flatnonzero(mask)
+
+
+def first_or_last(positions, last):
+    """
+    Index of the first (or last) row for each patient, given rows sorted by
+    patient position and then date.
+    """
+    if not len(positions):
+        return np.empty(0, dtype="int64")
+    boundaries = np.flatnonzero(np.diff(positions))
+    if last:
+        return np.append(boundaries, len(positions) - 1)
+    return np.insert(boundaries + 1, 0, 0)
+
+
+# The events matching a query, sorted by patient position then date, with
+# `keys` combining the two so that windows can be found by binary search
+Timeline = namedtuple("Timeline", ["rows", "positions", "dates", "keys", "patients"])
+
+
+def make_timeline(rows, positions, dates):
+    """A Timeline from rows already sorted by patient position then date."""
+    keys = (positions.astype("int64") << 32) | (dates.astype("int64") - NULL_DATE)
+    return Timeline(rows, positions, dates, keys, np.unique(positions))
+
+
+def timeline_window(timeline, window):
+    """
+    For each patient with events in an inclusive (start, end) window, their
+    position and the slice [first, stop) of their events in the timeline.
+    Bounds are day numbers, None, or arrays of one per patient; a patient
+    whose bound is missing has no events in the window.
+    """
+    patients = timeline.patients
+    found = np.ones(len(patients), dtype=bool)
+    offsets = []
+    for bound, open_offset in zip(window, [1, 2**32 - 1]):
+        if bound is None:
+            offsets.append(open_offset)
+            continue
+        bound = np.asarray(at_rows(bound, patients), dtype="int64")
+        found &= bound != NULL_DATE
+        offsets.append(bound - NULL_DATE)
+    base = patients.astype("int64") << 32
+    first = np.searchsorted(timeline.keys, base + offsets[0], "left")
+    stop = np.searchsorted(timeline.keys, base + offsets[1], "right")
+    found &= stop > first
+    return patients[found], first[found], stop[found]
+
+
+def latest_per_patient(tables, name, mask, order_column):
+    """Rows selected by `mask`, keeping the latest per patient."""
+    table = tables[name]
+    rows = np.flatnonzero(mask)
+    positions = tables.positions(name)[rows]
+    order = np.lexsort((table[order_column].to_numpy()[rows], positions))
+    rows, positions = rows[order], positions[order]
+    keep = first_or_last(positions, last=True)
+    return rows[keep], positions[keep]
+
+
+def codes_of(query_type, arguments):
+    if query_type == "most_recent_bmi":
+        return BMI_CODES
+    codes = arguments["codelist"]
+    if getattr(codes, "has_categories", False):
+        return [code for code, category in codes]
+    return list(codes)
+
+
+def match_prefixes(fields, codelists):
+    """
+    Tag "||"-separated ICD-10 fields with each codelist whose codes are a
+    prefix of any code in the field. A codelist of None matches every row.
+    """
+    return PrefixIndex(codelists).match_fields(fields)
+
+
+def tag_codes(table, rows, definitions):
+    """Tag each event with every codelist (one per variable) it is in."""
+    codelists = [codes_of(query_type, args) for query_type, args in definitions]
+    all_codes = pd.Index(sorted(set().union(*codelists)))
+    # The extra final row is all False, for codes in no codelist (-1)
+    membership = np.zeros((len(all_codes) + 1, len(codelists)), dtype=bool)
+    for j, codes in enumerate(codelists):
+        membership[all_codes.get_indexer(codes), j] = True
+    code_ids = all_codes.get_indexer(table["code"].to_numpy()[rows])
+    return membership[code_ids]
+
+
+def tag_medications(table, rows, definitions):
+    """As tag_codes, for the integer dm+d codes of the medications table."""
+    codelists = IntegerCodelists(
+        [codes_of(query_type, args) for query_type, args in definitions]
+    )
+    return codelists.match(table["code"].to_numpy()[rows])
+
+
+def tag_admissions(table, rows, definitions):
+    for query_type, args in definitions:
+        unsupported = [a for a in UNSUPPORTED_ADMISSION_ARGUMENTS if args.get(a)]
+        if unsupported:
+            raise NotImplementedError(
+                f"admitted_to_hospital does not support {', '.join(unsupported)}"
+            )
+    return match_prefixes(
+        table["diagnoses"].to_numpy()[rows],
+        [args["with_these_diagnoses"] for query_type, args in definitions],
+    )
+
+
+def tag_deaths(table, rows, definitions):
+    tags = np.ones((len(rows), len(definitions)), dtype=bool)
+    for field, underlying in [("underlying_cause", True), ("causes", False)]:
+        columns = [
+            j
+            for j, (query_type, args) in enumerate(definitions)
+            if query_type == "with_these_codes_on_death_certificate"
+            and bool(args.get("match_only_underlying_cause")) == underlying
+        ]
+        if columns:
+            tags[:, columns] = match_prefixes(
+                table[field].to_numpy()[rows],
+                [definitions[j][1]["codelist"] for j in columns],
+            )
+    return tags
+
+
+def tag_tests(table, rows, definitions):
+    pathogen = table["pathogen"].to_numpy()[rows]
+    result = table["result"].to_numpy()[rows]
+    tags = np.empty((len(rows), len(definitions)), dtype=bool)
+    for j, (query_type, args) in enumerate(definitions):
+        tags[:, j] = pathogen == args["pathogen"]
+        if args["test_result"] != "any":
+            tags[:, j] &= result == args["test_result"]
+    return tags
+
+
+TAGGERS = {
+    "clinical_events": tag_codes,
+    "medications": tag_medications,
+    "admissions": tag_admissions,
+    "ons_deaths": tag_deaths,
+    "sgss_tests": tag_tests,
+}
+
+
+def at_rows(day, positions):
+    """A date argument (one day number, or one per patient) for table rows."""
+    return day if np.ndim(day) == 0 else day[positions]
+
+
+# Patient queries get their date arguments as day numbers, or as arrays of
+# one per patient where they are relative to another variable
+
+
+def age_as_of(tables, reference_date, **kwargs):
+    positions = tables.positions("patients")
+    reference_date = at_rows(reference_date, positions)
+    ages = age_in_years(tables["patients"]["date_of_birth"].to_numpy(), reference_date)
+    out = np.zeros(len(tables), dtype="int64")
+    out[positions] = np.where(reference_date == NULL_DATE, 0, ages)
+    return out
+
+
+def sex(tables, **kwargs):
+    out = np.full(len(tables), "", dtype=object)
+    out[tables.positions("patients")] = tables["patients"]["sex"].fillna("").to_numpy()
+    return out
+
+
+def registered_with_one_practice_between(tables, start_date, end_date, **kwargs):
+    registrations = tables["registrations"]
+    positions = tables.positions("registrations")
+    covered = (
+        registrations["start_date"].to_numpy() <= at_rows(start_date, positions)
+    ) & (registrations["end_date"].to_numpy() >= at_rows(end_date, positions))
+    out = np.zeros(len(tables), dtype="int8")
+    out[tables.positions("registrations")[covered]] = 1
+    return out
+
+
+def date_deregistered_from_all_supported_practices(tables, between, **kwargs):
+    out = np.full(len(tables), NULL_DATE, dtype="int32")
+    np.maximum.at(
+        out,
+        tables.positions("registrations"),
+        tables["registrations"]["end_date"].to_numpy(),
+    )
+    start, end = between or (None, None)
+    if start is not None:
+        out[out < start] = NULL_DATE
+    if end is not None:
+        out[out > end] = NULL_DATE
+    return out
+
+
+def current_on(tables, name, day):
+    table = tables[name]
+    day = at_rows(day, tables.positions(name))
+    return (table["start_date"].to_numpy() <= day) & (
+        table["end_date"].to_numpy() >= day
+    )
+
+
+def registered_practice_as_of(tables, date, returning, **kwargs):
+    if returning != "nuts1_region_name":
+        raise NotImplementedError(f"registered_practice_as_of returning {returning}")
+    mask = current_on(tables, "registrations", date)
+    rows, positions = latest_per_patient(tables, "registrations", mask, "start_date")
+    out = np.full(len(tables), "", dtype=object)
+    out[positions] = tables["registrations"]["region"].fillna("").to_numpy()[rows]
+    return out
+
+
+def address_as_of(tables, date, returning, round_to_nearest=None, **kwargs):
+    if returning != "index_of_multiple_deprivation":
+        raise NotImplementedError(f"address_as_of returning {returning}")
+    mask = current_on(tables, "addresses", date)
+    rows, positions = latest_per_patient(tables, "addresses", mask, "start_date")
+    imd = tables["addresses"]["imd"].to_numpy(dtype="float64")[rows]
+    if round_to_nearest:
+        imd = np.floor(imd / round_to_nearest + 0.5) * round_to_nearest
+    # -1 where the patient has no current address, as in the backend
+    out = np.full(len(tables), -1, dtype="int64")
+    out[positions] = np.nan_to_num(imd, nan=-1)
+    return out
+
+
+PATIENT_QUERIES = {
+    "age_as_of": age_as_of,
+    "sex": sex,
+    "registered_with_one_practice_between": registered_with_one_practice_between,
+    "date_deregistered_from_all_supported_practices": (
+        date_deregistered_from_all_supported_practices
+    ),
+    "registered_practice_as_of": registered_practice_as_of,
+    "address_as_of": address_as_of,
+    "drug_era": drug_era_query,
+}
+
+# The table each patient query reads
+PATIENT_QUERY_TABLES = {
+    "age_as_of": "patients",
+    "sex": "patients",
+    "registered_with_one_practice_between": "registrations",
+    "date_deregistered_from_all_supported_practices": "registrations",
+    "registered_practice_as_of": "registrations",
+    "address_as_of": "addresses",
+    "drug_era": "medications",
+}
+
+
+class LocalExtractor:
+    """
+    With `staged=True`, the population criteria are evaluated first (see
+    population_stages in extraction_plan.py) and every later variable is
+    computed only for the patients who can still be in the population, so
+    the results cover those patients rather than everyone registered.
+    """
+
+    def __init__(
+        self,
+        covariate_definitions,
+        tables,
+        staged=False,
+        timelines=None,
+        cache=None,
+        profile=None,
+    ):
+        if not isinstance(tables, EventTables):
+            tables = EventTables(tables)
+        self.definitions = covariate_definitions
+        self.tables = tables
+        self.staged = staged
+        # If given, a dict in which each query's Timeline is kept (over all
+        # dates) for reuse by other extractors on the same tables
+        self.timelines = timelines
+        # If given, a ColumnCache (see extraction_cache.py) from which
+        # unchanged variables are loaded rather than computed
+        self.cache = cache
+        # If given, an ExtractionProfile (see extraction_profile.py) which
+        # records the time and resources taken by each variable
+        self.profile = profile
+        self.plan = plan_extraction(covariate_definitions)
+        self.results = {}
+        # Date of the event each scanned variable was taken from
+        self.match_dates = {}
+        self._fingerprints = {}
+
+    def run(self, workers=None):
+        if self.profile is None:
+            return self.run_stages(workers)
+        self.profile.start()
+        try:
+            return self.run_stages(workers)
+        finally:
+            self.profile.stop()
+
+    def run_stages(self, workers=None):
+        if not self.staged and self.cache is None:
+            return self.run_plan(self.plan, workers)
+
+        stages = [(list(self.definitions), None)]
+        if self.staged:
+            stages = population_stages(self.definitions)
+        for variables, condition in stages:
+            with self.stage(variables):
+                self.run_stage(variables, condition, workers)
+        return self.results
+
+    def run_stage(self, variables, condition, workers=None):
+        if self.cache is not None:
+            variables = [name for name in variables if not self.load_cached(name)]
+        plan = plan_extraction(self.definitions, variables, set(self.results))
+        self.run_plan(plan, workers)
+        if self.cache is not None:
+            for name in variables:
+                self.save_cached(name)
+        if condition is not None:
+            self.restrict(self.evaluate(condition))
+
+    def stage(self, variables):
+        """Time a stage of the extraction when profiling."""
+        if self.profile is None:
+            return nullcontext()
+        return self.profile.stage(variables, len(self.tables))
+
+    def fingerprint(self, name):
+        return fingerprint(
+            name, self.definitions, self.tables.fingerprint(), self._fingerprints
+        )
+
+    def load_cached(self, name):
+        """Load a variable (and its match dates) from the cache, if there."""
+        key = self.fingerprint(name)
+        column = self.cache.load(key)
+        match_dates = None
+        if column is not None and self.definitions[name][0] in EVENT_QUERIES:
+            match_dates = self.cache.load(f"{key}-match_dates")
+            if match_dates is None:
+                column = None
+        if column is None or len(column) != len(self.tables):
+            self.cache.misses.append(name)
+            return False
+        self.results[name] = column
+        if match_dates is not None:
+            self.match_dates[name] = match_dates
+        self.cache.hits.append(name)
+        return True
+
+    def save_cached(self, name):
+        key = self.fingerprint(name)
+        self.cache.save(key, self.results[name])
+        if name in self.match_dates:
+            self.cache.save(f"{key}-match_dates", self.match_dates[name])
+
+    def restrict(self, keep):
+        """Drop the patients not selected by `keep` from tables and results."""
+        self.tables = self.tables.restrict(keep)
+        # Fingerprints include that of the tables, which has now changed
+        self._fingerprints = {}
+        if self.timelines is not None:
+            # Timelines refer to patient positions in the unrestricted tables
+            self.timelines = {}
+        for columns in [self.results, self.match_dates]:
+            for name, column in columns.items():
+                columns[name] = column[keep]
+
+    def run_plan(self, plan, workers=None):
+        """
+        Evaluate the variables in a plan. Independent tasks run on a pool of
+        `workers` threads (default: one per core); each task is submitted
+        as soon as the tasks it depends on have finished. The heavy
+        numpy/pandas work releases the GIL, and threads share the event
+        tables rather than copying them into each worker.
+        """
+        if not plan.tasks:
+            return self.results
+        if workers is None:
+            workers = os.cpu_count() or 1
+        # Fill the lazily built caches up front rather than from the threads
+        for name in TABLES:
+            self.tables.positions(name)
+
+        if workers == 1:
+            for i in plan.order:
+                self.run_task(plan.tasks[i])
+            return self.results
+
+        waiting = {i: set(needs) for i, needs in plan.dependencies.items()}
+        dependents = {i: [] for i in waiting}
+        for i, needs in waiting.items():
+            for j in needs:
+                dependents[j].append(i)
+
+        with ThreadPoolExecutor(workers) as pool:
+
+            def submit(i):
+                running[pool.submit(self.run_task, plan.tasks[i])] = i
+
+            running = {}
+            for i in plan.order:
+                if not waiting[i]:
+                    submit(i)
+            while running:
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    i = running.pop(future)
+                    future.result()
+                    for j in dependents[i]:
+                        waiting[j].discard(i)
+                        if not waiting[j]:
+                            submit(j)
+        return self.results
+
+    def run_task(self, task):
+        if self.profile is None:
+            self.evaluate_task(task)
+            return
+        if task.kind == "scan":
+            label = f"scan {task.item.table} {format_window(task.item.window)}"
+            variables = task.item.variables
+        else:
+            label, variables = f"{task.kind} {task.item}", [task.item]
+        with self.profile.measure(label, variables):
+            self.evaluate_task(task)
+        for name in variables:
+            is_date = self.definitions[name][1].get("column_type") == "date"
+            self.profile.returned(name, self.results[name], is_date)
+
+    def evaluate_task(self, task):
+        if task.kind == "scan":
+            self.run_scan(task.item)
+            return
+        name = task.item
+        query_type, args = self.definitions[name]
+        if task.kind == "patient":
+            if query_type not in PATIENT_QUERIES:
+                raise NotImplementedError(f"{name}: {query_type} is not supported")
+            if self.profile is not None:
+                table = PATIENT_QUERY_TABLES[query_type]
+                self.profile.scanned(len(self.tables[table]))
+            args = dict(args)
+            for key in DATE_ARGUMENTS:
+                if key in args:
+                    args[key] = self.resolve(args[key])
+            self.results[name] = PATIENT_QUERIES[query_type](self.tables, **args)
+        elif task.kind == "derived":
+            self.results[name] = self.value_from(**args)
+        else:
+            self.results[name] = self.evaluate_composite(name)
+
+    def resolve(self, value):
+        """
+        Day numbers for a date argument or window: a date becomes a day
+        number, and an expression on another variable an array of one per
+        patient. None and day numbers are returned as they are.
+        """
+        if isinstance(value, (list, tuple)):
+            return type(value)(self.resolve(v) for v in value)
+        if not isinstance(value, str):
+            return value
+        expression = parse_date_expression(value)
+        if expression is None:
+            return to_day(value)
+        if self.definitions[expression.column][1].get("column_type") != "date":
+            raise ValueError(f"{value!r} must refer to a date variable")
+        return evaluate_date_expression(expression, self.results[expression.column])
+
+    def run_scan(self, scan):
+        for name in scan.variables:
+            query_type, args = self.definitions[name]
+            unsupported = [a for a in UNSUPPORTED_EVENT_ARGUMENTS if args.get(a)]
+            if unsupported:
+                raise NotImplementedError(
+                    f"{name}: {query_type} does not support {', '.join(unsupported)}"
+                )
+        table = self.tables[scan.table]
+        dates = table[EVENT_DATE_COLUMN[scan.table]].to_numpy()
+        # One timeline per query; its variables differ only in what they return
+        keys = [
+            (scan.table, match_key(*self.definitions[query[0]]))
+            for query in scan.queries
+        ]
+        timelines = {}
+        if self.timelines is not None:
+            timelines = {
+                j: self.timelines[key]
+                for j, key in enumerate(keys)
+                if key in self.timelines
+            }
+        todo = [j for j in range(len(keys)) if j not in timelines]
+
+        if todo:
+            # Shared timelines are reused for other windows, so hold all
+            # dates, and per-patient bounds are only applied per patient
+            window = (None, None)
+            if self.timelines is None:
+                window = [
+                    bound if np.ndim(bound) == 0 else None
+                    for bound in self.resolve(scan.window)
+                ]
+            rows = in_window(dates, window)
+            if self.profile is not None:
+                self.profile.scanned(len(rows))
+            definitions = [self.definitions[scan.queries[j][0]] for j in todo]
+            tags = TAGGERS[scan.table](table, rows, definitions)
+
+            # Only events matching some variable need ordering
+            matched = tags.any(axis=1)
+            rows, tags = rows[matched], tags[matched]
+            positions = self.tables.positions(scan.table)[rows]
+            order = np.lexsort((dates[rows], positions))
+            rows, tags, positions = rows[order], tags[order], positions[order]
+
+            for column, j in enumerate(todo):
+                selected = tags[:, column]
+                timelines[j] = self.timeline(
+                    scan.queries[j], table, rows[selected], positions[selected], dates
+                )
+                if self.timelines is not None:
+                    self.timelines[keys[j]] = timelines[j]
+
+        window = self.resolve(scan.window)
+        for j, query in enumerate(scan.queries):
+            with self.timing(query):
+                self.summarise(query, table, timelines[j], window)
+
+    def timing(self, variables):
+        """Attribute the time of a block to `variables` when profiling."""
+        if self.profile is None:
+            return nullcontext()
+        return self.profile.timing(variables)
+
+    def timeline(self, query, table, rows, positions, dates):
+        """
+        The Timeline of a query's matching events (sorted by patient and
+        date), after the filters which don't depend on the window.
+        """
+        query_type, args = self.definitions[query[0]]
+        if query_type == "most_recent_bmi":
+            date_of_birth = np.full(len(self.tables), NULL_DATE, dtype="int32")
+            date_of_birth[self.tables.positions("patients")] = self.tables["patients"][
+                "date_of_birth"
+            ].to_numpy()
+            old_enough = age_in_years(
+                date_of_birth[positions], dates[rows]
+            ) >= args.get("minimum_age_at_measurement", 16)
+            rows, positions = rows[old_enough], positions[old_enough]
+        if args.get("ignore_missing_values"):
+            present = ~np.isnan(table["numeric_value"].to_numpy(dtype="float64")[rows])
+            rows, positions = rows[present], positions[present]
+        return make_timeline(rows, positions, dates[rows])
+
+    def summarise(self, query, table, timeline, window):
+        """
+        Compute every variable of a query from its events in the window. The
+        first/last event per patient is found once, by binary search in the
+        timeline, and shared by all the variables that need it.
+        """
+        query_type = self.definitions[query[0]][0]
+        n = len(self.tables)
+        patients, first, stop = timeline_window(timeline, window)
+
+        picks = {}
+        for name in query:
+            args = self.definitions[name][1]
+            last = not args.get("find_first_match_in_period")
+            if last not in picks:
+                picked = stop - 1 if last else first
+                match_dates = np.full(n, NULL_DATE, dtype="int32")
+                match_dates[patients] = timeline.dates[picked]
+                picks[last] = (timeline.rows[picked], match_dates)
+            picked_rows, match_dates = picks[last]
+            self.match_dates[name] = match_dates
+
+            if query_type == "most_recent_bmi":
+                returning = "numeric_value"
+            else:
+                returning = RETURNING.get(args["returning"], args["returning"])
+            if returning == "binary_flag":
+                out = np.zeros(n, dtype="int8")
+                out[patients] = 1
+            elif returning == "date":
+                out = match_dates
+            elif returning == "number_of_matches_in_period":
+                out = np.zeros(n, dtype="int64")
+                out[patients] = stop - first
+            elif returning == "numeric_value":
+                out = np.full(n, np.nan)
+                values = table["numeric_value"].to_numpy(dtype="float64")
+                out[patients] = values[picked_rows]
+            elif returning == "category":
+                categories = dict(args["codelist"])
+                out = np.full(n, "", dtype=object)
+                codes = pd.Series(table["code"].to_numpy()[picked_rows])
+                out[patients] = codes.map(categories)
+            elif returning == "underlying_cause":
+                out = np.full(n, "", dtype=object)
+                out[patients] = table["underlying_cause"].to_numpy()[picked_rows]
+            else:
+                raise NotImplementedError(
+                    f"{name}: returning={returning} is not supported"
+                )
+            self.results[name] = out
+
+    def value_from(self, source, returning, **kwargs):
+        if returning != "date":
+            raise NotImplementedError(f"value_from returning {returning}")
+        return self.match_dates[source]
+
+    def evaluate(self, tree):
+        """Evaluate a parsed expression for every patient."""
+        names = names_of(tree)
+        columns = {column: self.results[column] for column in names}
+        dates = {
+            column
+            for column in names
+            if self.definitions[column][1].get("column_type") == "date"
+        }
+        return np.broadcast_to(compile_tree(tree)(columns, dates), len(self.tables))
+
+    def evaluate_composite(self, name):
+        args = self.definitions[name][1]
+        dates = {
+            column
+            for column in self.results
+            if self.definitions[column][1].get("column_type") == "date"
+        }
+        return categorise(
+            args["category_definitions"],
+            self.results,
+            dates,
+            len(self.tables),
+            args.get("column_type"),
+        )
+
+    def to_frame(self):
+        """The population, in the layout written by generate_cohort."""
+        if not self.results:
+            self.run()
+        population = self.results["population"] == 1
+        columns = {}
+        for name, (query_type, args) in self.definitions.items():
+            if name == "population" or args.get("hidden"):
+                continue
+            column = self.results[name][population]
+            column_type = args.get("column_type")
+            if column_type == "date":
+                column = format_dates(column, args.get("date_format"))
+            elif column_type == "bool":
+                column = (pd.notna(column) & (column != 0)).astype("int8")
+            elif column_type == "str":
+                column = np.asarray(
+                    ["" if value is None else value for value in column], dtype=object
+                )
+            columns[name] = column
+        columns["patient_id"] = self.tables.patient_ids[population]
+        return pd.DataFrame(columns)
+
+    def extract(self, workers=None):
+        self.run(workers)
+        return self.to_frame()
+
+
+def main(tables_directory, output_file=OUTPUT_FILE, workers=None):
+    from study_definition import study
+
+    tables = EventTables.from_directory(tables_directory)
+    cache, profile = ColumnCache(), ExtractionProfile()
+    extractor = LocalExtractor(
+        study.covariate_definitions, tables, staged=True, cache=cache, profile=profile
+    )
+    if workers is not None:
+        workers = int(workers)
+    extractor.extract(workers).to_csv(output_file, index=False)
+    path = profile.write(cache)
+    print(profile.summary(cache))
+    print(f"Profile of each variable written to {path}")
+
+
+if __name__ == "__main__":
+    main(*sys.argv[1:])
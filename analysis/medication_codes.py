@@ -0,0 +1,92 @@
+"""
+Integer-encoded dm+d medication codelists.
+
+dm+d codes are numbers of up to 18 digits, so the medications table holds
+them as int64 (see event_tables.py) and the codelists are compiled here
+into one sorted int64 array of every code they contain, with a row of
+flags per code saying which codelists include it. Classifying a column of
+prescriptions is then a hash of its int64 codes and a `searchsorted` of
+the distinct ones over that array, whatever the number of codelists,
+rather than hashing each row's code string per scan.
+
+DRUG_CLASSES are the study's antidiabetic drug classes. `drug_classes`
+gives each prescription a single class id: a bitmask with bit j set if its
+code is in the j-th class, so that combination products (such as
+metformin with sitagliptin) keep both of their classes.
+"""
+
+import functools
+
+import numpy as np
+import pandas as pd
+
+from event_tables import to_int_codes
+
+# Class name -> codelist in codelists.py. Every oral antidiabetic is also
+# in "antidiabetic", including those with no class of their own.
+DRUG_CLASSES = {
+    "metformin": "metformin_med_codes",
+    "dpp4i": "dpp4i_med_codes",
+    "sglt2i": "sglt2i_med_codes",
+    "sulfonylurea": "sulfs_med_codes",
+    "insulin": "insulin_med_codes",
+    "antidiabetic": "oad_med_codes",
+}
+
+
+class IntegerCodelists:
+    """Several codelists of numeric codes, compiled for membership tests."""
+
+    def __init__(self, codelists):
+        self.width = len(codelists)
+        compiled = [to_int_codes(list(codes)) for codes in codelists]
+        self.codes = np.unique(np.concatenate([np.empty(0, "int64")] + compiled))
+        # One row per code, plus an all-False row for codes in no codelist
+        self.members = np.zeros((len(self.codes) + 1, self.width), dtype=bool)
+        for j, codes in enumerate(compiled):
+            self.members[np.searchsorted(self.codes, codes[codes >= 0]), j] = True
+
+    def lookup(self, codes):
+        """Each code's row in `members`."""
+        # A table holds far fewer distinct codes than rows, and hashing the
+        # rows is cheaper than binary-searching each of them
+        ids, distinct = pd.factorize(to_int_codes(codes))
+        found = np.searchsorted(self.codes, distinct)
+        found[found == len(self.codes)] = 0
+        if len(self.codes):
+            found[self.codes[found] != distinct] = len(self.codes)
+        return found[ids]
+
+    def match(self, codes):
+        """A (codes, codelists) boolean array: which codelists contain each."""
+        return np.take(self.members, self.lookup(codes), axis=0)
+
+    def bitmasks(self, codes):
+        """Per code, an integer with bit j set if codelist j contains it."""
+        if self.width > 64:
+            raise ValueError("Bitmasks are limited to 64 codelists")
+        dtype = next(f"uint{bits}" for bits in (8, 16, 32, 64) if self.width <= bits)
+        weights = np.left_shift(np.uint64(1), np.arange(self.width, dtype="uint64"))
+        masks = (self.members.astype("uint64") * weights).sum(axis=1).astype(dtype)
+        return masks[self.lookup(codes)]
+
+
+@functools.lru_cache(maxsize=None)
+def drug_class_index():
+    import codelists
+
+    return IntegerCodelists(
+        [getattr(codelists, name) for name in DRUG_CLASSES.values()]
+    )
+
+
+def drug_classes(codes):
+    """The DRUG_CLASSES bitmask (uint8, 0 for none) of each medication code."""
+    return drug_class_index().bitmasks(codes)
+
+
+def class_names(bitmask):
+    """The names of the classes in one bitmask, e.g. "metformin+dpp4i"."""
+    return "+".join(
+        name for j, name in enumerate(DRUG_CLASSES) if int(bitmask) >> j & 1
+    )
@@ -0,0 +1,123 @@
+"""
+Sequences of outcomes, such as community COVID-19, hospitalisation and
+death, classified for every patient at once.
+
+Each patient's outcomes are ranked by date with one argsort over a
+(patients x outcomes) array. Outcomes on the same date share a rank, one
+which happened without a date comes after every dated one (as missing
+dates sort in Stata) and one which did not happen has rank 0. The ranks
+of k outcomes are packed into a single code,
+
+    code = sum over outcomes j of rank_j * (k + 1) ** j
+
+so each order, with ties, of each set of outcomes has its own code, 0
+being no outcome at all. sequence_label decodes a code as the outcomes in
+order joined by "_", with "=" between those on the same date (e.g.
+"comm=hosp_death").
+
+Another outcome (ICU admission, ventilation) is another entry in the
+outcomes given to outcome_sequence, and a flag for a particular sequence
+is derived from the codes with sequence_flags rather than written by hand.
+"""
+
+import numpy as np
+import pandas as pd
+
+# name: (date column, flag column); an outcome with no flag column
+# happened if its date is not missing
+SEQUENCE_OUTCOMES = {
+    "comm": ("first_comm_covid_date", "first_comm_covid"),
+    "hosp": ("hospitalised_covid_date", "hospitalised_covid"),
+    "death": ("died_date_ons_date", None),
+}
+
+# Sort keys of an outcome which happened on an unknown date, and of one
+# which did not happen
+_UNDATED = np.iinfo("int64").max - 1
+_ABSENT = np.iinfo("int64").max
+
+
+def outcome_ranks(df, outcomes=SEQUENCE_OUTCOMES):
+    """
+    The rank of each outcome by date for each patient, as a (patients x
+    outcomes) array: 1 for the earliest, equal for outcomes on the same
+    date, and 0 for those which did not happen.
+    """
+    keys = np.empty((len(df), len(outcomes)), dtype="int64")
+    for j, (date_column, flag_column) in enumerate(outcomes.values()):
+        dates = df[date_column]
+        undated = dates.isna().to_numpy()
+        if flag_column is None:
+            happened = ~undated
+        else:
+            happened = (df[flag_column] == 1).to_numpy()
+        days = dates.to_numpy(dtype="datetime64[ns]").view("int64")
+        keys[:, j] = np.where(happened, np.where(undated, _UNDATED, days), _ABSENT)
+
+    order = np.argsort(keys, axis=1, kind="stable")
+    ordered = np.take_along_axis(keys, order, axis=1)
+    # Dense ranks: one more at each change of date along the sorted row
+    changes = np.ones(ordered.shape, dtype="int64")
+    changes[:, 1:] = ordered[:, 1:] != ordered[:, :-1]
+    dense = np.where(ordered == _ABSENT, 0, np.cumsum(changes, axis=1))
+    ranks = np.empty_like(dense)
+    np.put_along_axis(ranks, order, dense, axis=1)
+    return ranks
+
+
+def sequence_codes(ranks):
+    """Pack each row of outcome_ranks into one integer code."""
+    k = ranks.shape[1]
+    if (k + 1) ** k >= 2**63:
+        raise ValueError(f"Too many outcomes ({k}) to code in 64 bits")
+    return ranks @ (k + 1) ** np.arange(k, dtype="int64")
+
+
+def outcome_sequence(df, outcomes=SEQUENCE_OUTCOMES):
+    """The sequence code of each patient's outcomes."""
+    codes = sequence_codes(outcome_ranks(df, outcomes))
+    return pd.Series(codes, index=df.index, name="outcome_sequence")
+
+
+def decode(code, k):
+    """The ranks of k outcomes packed in a sequence code."""
+    ranks = []
+    for _ in range(k):
+        code, rank = divmod(int(code), k + 1)
+        ranks.append(rank)
+    return ranks
+
+
+def sequence_label(code, names=tuple(SEQUENCE_OUTCOMES)):
+    """A sequence code as e.g. "comm_hosp=death", or "none"."""
+    ranks = decode(code, len(names))
+    if not any(ranks):
+        return "none"
+    return "_".join(
+        "=".join(name for name, rank in zip(names, ranks) if rank == r)
+        for r in range(1, max(ranks) + 1)
+    )
+
+
+def sequence_flags(codes, sequences, names=tuple(SEQUENCE_OUTCOMES)):
+    """
+    For each of `sequences` (name: list of outcome names), whether each
+    code is of exactly those outcomes, each on or after the date of the
+    one before it. Evaluated once per distinct code.
+    """
+    positions, uniques = pd.factorize(np.asarray(codes))
+    decoded = [dict(zip(names, decode(code, len(names)))) for code in uniques]
+    flags = {}
+    for name, sequence in sequences.items():
+        matches = [
+            {outcome for outcome, rank in ranks.items() if rank} == set(sequence)
+            and all(ranks[a] <= ranks[b] for a, b in zip(sequence, sequence[1:]))
+            for ranks in decoded
+        ]
+        flags[name] = np.array(matches, dtype=bool)[positions]
+    return flags
+
+
+def count_sequences(df, by="exp", column="outcome_sequence"):
+    """Patients with each sequence code (rows) in each group (columns)."""
+    return df.groupby([column, by]).size().unstack(by, fill_value=0)
@@ -0,0 +1,77 @@
+"""
+Prefix matching of ICD-10 codes against several codelists at once.
+
+In hospital admissions and death certificates a codelist entry matches any
+recorded code it is a prefix of ("E11" matches "E119"), which the backend
+evaluates as one LIKE scan per code per field. PrefixIndex compiles the
+codelists into one sorted array of their codes, with a row of flags saying
+which codelists each code belongs to. A recorded code is then matched
+against every codelist by truncating it to each distinct code length in
+the index and binary-searching for the truncation, i.e. a handful of
+`searchsorted` calls over arrays rather than a string comparison per pair.
+
+Fields repeat heavily (the same diagnoses, the same causes of death), so
+match_fields only matches the distinct codes of the distinct fields and
+maps the result back to the rows.
+"""
+
+import numpy as np
+import pandas as pd
+
+# Separator of the codes in a multi-valued field, as in the TPP schema
+SEPARATOR = "||"
+
+
+class PrefixIndex:
+    """
+    The codes of several codelists, compiled for prefix matching. A codelist
+    of None matches every code.
+    """
+
+    def __init__(self, codelists):
+        self.width = len(codelists)
+        self.match_all = np.array([codes is None for codes in codelists])
+        codes = pd.Index(
+            sorted({code for codes in codelists if codes is not None for code in codes})
+        )
+        self.codes = codes.to_numpy(dtype=str)
+        # One row per code, plus an all-False row for "not found"
+        self.members = np.zeros((len(self.codes) + 1, self.width), dtype=bool)
+        for j, codelist in enumerate(codelists):
+            if codelist is not None:
+                self.members[codes.get_indexer(list(codelist)), j] = True
+        self.lengths = np.unique(np.char.str_len(self.codes)) if len(codes) else []
+
+    def match(self, codes):
+        """A (codes, codelists) boolean array: which codelists match each code."""
+        codes = np.asarray(codes, dtype=str)
+        tags = np.zeros((len(codes), self.width), dtype=bool)
+        tags[:, self.match_all] = True
+        for length in self.lengths:
+            if length == 0:
+                # An empty code is a prefix of everything
+                tags |= self.members[np.searchsorted(self.codes, "")]
+                continue
+            truncated = codes.astype(f"<U{length}")
+            found = np.searchsorted(self.codes, truncated)
+            found[found == len(self.codes)] = len(self.codes) - 1
+            found[self.codes[found] != truncated] = len(self.codes)
+            tags |= self.members[found]
+        return tags
+
+    def match_fields(self, fields):
+        """
+        As `match`, for fields holding SEPARATOR-separated codes (or None),
+        where a field matches a codelist if any of its codes does.
+        """
+        field_ids, distinct = pd.factorize(pd.Series(fields, dtype=object).fillna(""))
+        if not len(distinct):
+            return np.zeros((len(field_ids), self.width), dtype=bool)
+        exploded = pd.Series(distinct, dtype=object).str.split(SEPARATOR, regex=False)
+        code_ids, codes = pd.factorize(exploded.explode().to_numpy(dtype=str))
+        code_tags = self.match(codes)[code_ids]
+        # Each field's codes are consecutive in the exploded list
+        counts = exploded.str.len().to_numpy()
+        starts = np.concatenate([[0], np.cumsum(counts)[:-1]])
+        field_tags = np.logical_or.reduceat(code_tags, starts, axis=0)
+        return field_tags[field_ids]
@@ -0,0 +1,322 @@
+"""
+Propensity scores and weights for the exposure groups.
+
+Python port of the propensity score model in archive/derive_ps.do, which
+fits `mlogit exposure i.male age1 age2 age3 $varlist, base(1)` and takes
+inverse probability of treatment (ATE) weights from it. Here:
+
+  * the design matrix is sparse: an intercept, a one-hot column for every
+    level but the first of each categorical covariate (as i.var) and the
+    continuous covariates, standardised while fitting
+  * the multinomial logit is fitted by Newton-Raphson, as mlogit, with
+    exposure 1 as the base: the gradient X'(P - Y) and each block
+    X' diag(p_a (1[a = b] - p_b)) X of the Hessian are sparse products,
+    and the Hessian is only as large as (columns x exposures)^2, so each
+    step is cheap and a fit takes a handful of them
+  * the main specification is fitted first, then every sensitivity
+    specification in SPECIFICATIONS starts from its coefficients (on the
+    columns they share) rather than from zero, in parallel processes
+  * patients missing a covariate of a specification get no score from it,
+    as mlogit drops them
+
+No outcome models are fitted here, in parallel or otherwise: the Cox
+models of ps_model.do per outcome (died_covid, hospitalised_covid) are not
+ported, and only the propensity specifications run in the process pool.
+
+The scores (p1 to p5, the probability of each exposure, of which only
+those present are fitted) and weights (ipw, 1 / the probability of the
+exposure received) of each specification are written to
+output/propensity_scores.feather with cohort_io.write_cohort, keyed by
+patient_id, so that outcome models can read them without deriving the
+cohort again. The standardised differences weighted by the main weights
+are written next to the unweighted ones (see standardised_differences.py).
+
+Run from the root of the repository:
+
+    python analysis/propensity_scores.py [analysis dataset] [workers]
+"""
+
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+from aggregates import Aggregates
+from cohort_io import write_cohort
+from derive_cohort import OUTPUT_FILE as INPUT_FILE
+from standardised_differences import CATEGORICAL, CONTINUOUS
+from standardised_differences import OUTPUT_FILE as DIFFERENCES_FILE
+from standardised_differences import standardised_differences
+from table_1 import write_table
+
+OUTPUT_FILE = os.path.join("output", "propensity_scores.feather")
+WEIGHTED_DIFFERENCES_FILE = DIFFERENCES_FILE.replace(".csv", "_weighted.csv")
+
+EXPOSURE = "exp"
+
+MAIN = {
+    "categorical": [
+        "male",
+        "ethnicity",
+        "imd",
+        "smoke_nomiss",
+        "obese4cat",
+        "diabcat",
+        "chronic_cardiac_disease",
+        "hypertension",
+        "chronic_respiratory_disease",
+        "chronic_liver_disease",
+        "cancer_exhaem_cat",
+        "cancer_haem_cat",
+        "other_immunosuppression",
+        "spleen",
+        "ra_sle_psoriasis",
+        "other_neuro",
+        "dementia",
+    ],
+    "continuous": ["age1", "age2", "age3"],
+}
+
+# Sensitivity specifications, as changes to MAIN
+SPECIFICATIONS = {
+    "main": MAIN,
+    "age_groups": {
+        "categorical": MAIN["categorical"] + ["agegroup"],
+        "continuous": [],
+    },
+    "region": {
+        "categorical": MAIN["categorical"] + ["region_7"],
+        "continuous": MAIN["continuous"],
+    },
+    "diabetes_medication": {
+        "categorical": MAIN["categorical"] + ["metformin_3mths", "insulin_meds_3mths"],
+        "continuous": MAIN["continuous"],
+    },
+}
+
+MAX_ITERATIONS = 100
+# The fit stops once g'H^-1 g, for the gradient g and Hessian H of the log
+# likelihood, is below this, as mlogit's nrtolerance()
+TOLERANCE = 1e-5
+
+
+def design_matrix(df, categorical, continuous):
+    """
+    The sparse design matrix of the rows of df, its column names and the
+    rows used (those with every covariate). Continuous columns are
+    standardised over the rows used.
+    """
+    complete = df[categorical + continuous].notna().all(axis=1).to_numpy()
+    df = df[complete]
+    n = len(df)
+
+    names = ["_cons"]
+    rows, columns = [np.arange(n)], [np.zeros(n, dtype="int64")]
+    for name in categorical:
+        codes, levels = pd.factorize(df[name], sort=True)
+        # The first level is the base
+        coded = codes > 0
+        rows.append(np.flatnonzero(coded))
+        columns.append(len(names) + codes[coded] - 1)
+        names += [f"{level}.{name}" for level in levels[1:]]
+    rows, columns = np.concatenate(rows), np.concatenate(columns)
+    indicators = sparse.csr_matrix(
+        (np.ones(len(rows)), (rows, columns)), shape=(n, len(names))
+    )
+
+    values = df[continuous].to_numpy(dtype="float64")
+    scale = values.std(axis=0)
+    values = (values - values.mean(axis=0)) / np.where(scale > 0, scale, 1)
+    design = sparse.hstack([indicators, sparse.csr_matrix(values)], format="csr")
+    return design, names + continuous, complete
+
+
+def log_probabilities(design, coefficients):
+    """The log probability of each exposure, as (patients x exposures)."""
+    # The base exposure has a linear predictor of 0
+    eta = np.zeros((design.shape[0], coefficients.shape[1] + 1))
+    eta[:, 1:] = design @ coefficients
+    return eta - np.logaddexp.reduce(eta, axis=1, keepdims=True)
+
+
+def log_likelihood(design, outcome, coefficients):
+    log_p = log_probabilities(design, coefficients)
+    return log_p[np.arange(len(outcome)), outcome].sum()
+
+
+def derivatives(design, outcome, coefficients):
+    """
+    The log likelihood and its gradient and Hessian with respect to the
+    coefficients, flattened as coefficients.ravel().
+    """
+    columns, k = coefficients.shape
+    log_p = log_probabilities(design, coefficients)
+    rows = np.arange(len(outcome))
+    value = log_p[rows, outcome].sum()
+    p = np.exp(log_p[:, 1:])
+    residual = -p
+    chosen = outcome > 0
+    residual[rows[chosen], outcome[chosen] - 1] += 1
+    gradient = np.asarray(design.T @ residual)
+
+    # Each block X' diag(w) X is a sparse product, so that the design is
+    # never dense; the blocks themselves are only columns x columns
+    hessian = np.empty((columns, k, columns, k))
+    for a in range(k):
+        for b in range(a, k):
+            weight = p[:, a] * ((a == b) - p[:, b])
+            block = (design.T @ design.multiply(weight[:, None])).toarray()
+            hessian[:, a, :, b] = -block
+            hessian[:, b, :, a] = -block.T
+    size = columns * k
+    return value, gradient.ravel(), hessian.reshape(size, size)
+
+
+class PropensityModel:
+    def __init__(self, specification, columns, exposures):
+        self.specification = specification
+        self.columns = columns
+        # The exposures with patients, the first being the base
+        self.exposures = exposures
+        self.coefficients = np.zeros((len(columns), len(exposures) - 1))
+        self.log_likelihood = None
+        self.iterations = None
+        self.converged = None
+        self.seconds = None
+
+    def start_from(self, other):
+        """Warm start from the coefficients of the columns `other` shares."""
+        if other is None or list(other.exposures) != list(self.exposures):
+            return
+        position = {name: i for i, name in enumerate(other.columns)}
+        for i, name in enumerate(self.columns):
+            if name in position:
+                self.coefficients[i] = other.coefficients[position[name]]
+
+    def fit(self, design, outcome):
+        """
+        Newton-Raphson, halving any step which lowers the likelihood. If 30
+        halvings of a step still lower it, the fit stops, not converged.
+        """
+        start = time.perf_counter()
+        coefficients = self.coefficients
+        self.converged = False
+        for iteration in range(MAX_ITERATIONS):
+            value, gradient, hessian = derivatives(design, outcome, coefficients)
+            # The Hessian is negative definite unless columns are collinear
+            step = np.linalg.lstsq(-hessian, gradient, rcond=None)[0]
+            if gradient @ step < TOLERANCE:
+                self.converged = True
+                break
+            step = step.reshape(coefficients.shape)
+            for _ in range(30):
+                proposed = coefficients + step
+                if log_likelihood(design, outcome, proposed) >= value:
+                    break
+                step = step / 2
+            else:
+                break
+            coefficients = proposed
+        self.coefficients = coefficients
+        self.log_likelihood = value
+        self.iterations = iteration
+        self.seconds = time.perf_counter() - start
+        return self
+
+    def predict(self, design):
+        """The probability of each exposure, as (patients x exposures)."""
+        return np.exp(log_probabilities(design, self.coefficients))
+
+
+def fit_specification(df, name, specification, warm_start=None):
+    """
+    Fit one specification; returns the model and a frame of its scores
+    and weights, aligned with df.
+    """
+    design, columns, complete = design_matrix(
+        df,
+        [c for c in specification["categorical"] if c in df],
+        [c for c in specification["continuous"] if c in df],
+    )
+    received = df[EXPOSURE][complete]
+    exposures = np.sort(received.unique())
+    outcome = np.searchsorted(exposures, received.to_numpy())
+    model = PropensityModel(name, columns, exposures)
+    model.start_from(warm_start)
+    model.fit(design, outcome)
+
+    probabilities = model.predict(design)
+    scores = pd.DataFrame(index=df.index)
+    for j, exposure in enumerate(exposures):
+        scores[f"{name}_p{int(exposure)}"] = np.nan
+        scores.loc[complete, f"{name}_p{int(exposure)}"] = probabilities[:, j]
+    scores[f"{name}_ipw"] = np.nan
+    scores.loc[complete, f"{name}_ipw"] = (
+        1 / probabilities[np.arange(len(outcome)), outcome]
+    )
+    return model, scores
+
+
+def propensity_scores(df, specifications=SPECIFICATIONS, workers=None):
+    """
+    Fit every specification, the first alone and the rest in parallel
+    starting from it; returns the models and the scores of each patient.
+    """
+    df = df[df[EXPOSURE].notna()].reset_index(drop=True)
+    (first, specification), *others = specifications.items()
+    main, scores = fit_specification(df, first, specification)
+    models, frames = [main], [scores]
+    with ProcessPoolExecutor(workers) as pool:
+        futures = [
+            pool.submit(fit_specification, df, name, specification, main)
+            for name, specification in others
+        ]
+        for future in futures:
+            model, scores = future.result()
+            models.append(model)
+            frames.append(scores)
+    scores = pd.concat([df[["patient_id", EXPOSURE]]] + frames, axis=1)
+    return models, scores
+
+
+def summary(models):
+    lines = [
+        f"{'specification':<24} {'columns':>7} {'log likelihood':>15}"
+        f" {'iterations':>10} {'seconds':>8}"
+    ]
+    for model in models:
+        note = "" if model.converged else " (not converged)"
+        lines.append(
+            f"{model.specification:<24} {len(model.columns):>7}"
+            f" {model.log_likelihood:>15.3f} {model.iterations:>10}"
+            f" {model.seconds:>8.3f}{note}"
+        )
+    return "\n".join(lines)
+
+
+def main(input_file=INPUT_FILE, workers=None):
+    df = pd.read_csv(input_file)
+    models, scores = propensity_scores(
+        df, workers=None if workers is None else int(workers)
+    )
+    write_cohort(scores, OUTPUT_FILE)
+    print(summary(models))
+
+    # Balance in the population weighted by the main specification
+    weighted = df.merge(scores[["patient_id", f"{models[0].specification}_ipw"]])
+    aggregates = Aggregates.of(
+        weighted,
+        EXPOSURE,
+        categorical=[c for c in CATEGORICAL if c in weighted],
+        continuous=[c for c in CONTINUOUS if c in weighted],
+        weights=f"{models[0].specification}_ipw",
+    )
+    write_table(standardised_differences(aggregates), WEIGHTED_DIFFERENCES_FILE)
+
+
+if __name__ == "__main__":
+    main(*sys.argv[1:])
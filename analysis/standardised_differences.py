@@ -0,0 +1,137 @@
+"""
+Standardised differences of covariates between every pair of exposure
+groups.
+
+Replaces calls to stddiff (ado/stddiff.ado and _stddiff.ado), which
+compare two groups and one variable at a time, so that the 5 exposure
+groups need 10 calls per variable. Here one Aggregates.of pass collects,
+for every group, the sufficient statistics (counts of each category, and
+n, sum and sum of squares of continuous variables), and the differences
+for all pairs come from those:
+
+  continuous   (m_a - m_b) / sqrt((v_a + v_b) / 2), with v the sample
+               variance, as stddiff (signed, unless absolute)
+  categorical  sqrt((p_a - p_b)' S^-1 (p_a - p_b)), where p are the
+               proportions in each category bar the first and S the mean
+               of the two groups' multinomial covariances, diag(p) - pp',
+               as stddiff's categorical option (Yang and Dalton, 2012).
+               A binary variable gets |p_a - p_b| / sqrt((p_a(1 - p_a) +
+               p_b(1 - p_b)) / 2)
+
+With weights (e.g. inverse probability of treatment weights) the
+statistics are weighted as in "Weighted STDs.do", which passes them to
+tabstat and tab as [fw = wts].
+
+The table has a row per variable and a column per pair of groups. Run
+from the root of the repository:
+
+    python analysis/standardised_differences.py [analysis dataset] [weights column]
+"""
+
+import os
+import sys
+from itertools import combinations
+
+import numpy as np
+import pandas as pd
+
+from aggregates import Aggregates
+from derive_cohort import OUTPUT_FILE as INPUT_FILE
+from table_1 import GROUPS, TABLES_DIR, VARIABLES, write_table
+
+OUTPUT_FILE = os.path.join(TABLES_DIR, "standardised_differences.csv")
+
+CATEGORICAL = VARIABLES
+CONTINUOUS = ["age", "egfr"]
+
+
+def group_pairs(groups=GROUPS):
+    return list(combinations(groups, 2))
+
+
+def continuous_differences(aggregates, pairs):
+    """Signed standardised differences of means, variables x pairs."""
+    groups = sorted({g for pair in pairs for g in pair})
+    mean = aggregates.mean().reindex(columns=groups)
+    variance = (aggregates.sd() ** 2).reindex(columns=groups)
+    a = [groups.index(first) for first, _ in pairs]
+    b = [groups.index(second) for _, second in pairs]
+    m, v = mean.to_numpy(), variance.to_numpy()
+    differences = (m[:, a] - m[:, b]) / np.sqrt((v[:, a] + v[:, b]) / 2)
+    return pd.DataFrame(differences, index=mean.index, columns=pairs)
+
+
+def categorical_differences(aggregates, pairs):
+    """Standardised differences of category proportions, variables x pairs."""
+    groups = sorted({g for pair in pairs for g in pair})
+    a = [groups.index(first) for first, _ in pairs]
+    b = [groups.index(second) for _, second in pairs]
+    rows = {}
+    for name, counts in aggregates.counts.groupby(level="variable", sort=False):
+        counts = counts.reindex(columns=groups, fill_value=0).to_numpy("float64")
+        totals = counts.sum(axis=0)
+        # Proportions in each category bar the first: (groups x categories)
+        p = (counts / np.where(totals > 0, totals, np.nan))[1:].T
+        covariance = p[:, :, None] * np.eye(p.shape[1]) - p[:, :, None] * p[:, None, :]
+        result = np.full(len(pairs), np.nan)
+        # Only pairs of groups with a value of the variable
+        valid = (totals[a] > 0) & (totals[b] > 0)
+        if p.shape[1] == 0:
+            result[valid] = 0
+        elif valid.any():
+            a_, b_ = np.array(a)[valid], np.array(b)[valid]
+            d = p[a_] - p[b_]
+            # The pseudo-inverse, as a category absent from both groups
+            # makes S singular
+            inverse = np.linalg.pinv((covariance[a_] + covariance[b_]) / 2)
+            result[valid] = np.sqrt(np.einsum("pi,pij,pj->p", d, inverse, d))
+        rows[name] = result
+    return pd.DataFrame.from_dict(rows, orient="index", columns=pairs)
+
+
+def standardised_differences(
+    aggregates,
+    groups=GROUPS,
+    categorical=CATEGORICAL,
+    continuous=CONTINUOUS,
+    absolute=False,
+):
+    """
+    The standardised difference of each of the variables summarised in
+    `aggregates` (by exposure) between every pair of `groups`.
+    """
+    pairs = group_pairs(groups)
+    means = continuous_differences(aggregates, pairs)
+    if absolute:
+        means = means.abs()
+    proportions = categorical_differences(aggregates, pairs)
+    table = pd.concat(
+        [
+            means[means.index.isin(continuous)].assign(type="continuous"),
+            proportions[proportions.index.isin(categorical)].assign(
+                type="categorical"
+            ),
+        ]
+    )
+    table.columns = [
+        column if column == "type" else f"{groups[column[0]]} v {groups[column[1]]}"
+        for column in table.columns
+    ]
+    table.index.name = "variable"
+    return table[["type"] + [c for c in table.columns if c != "type"]].reset_index()
+
+
+def main(input_file=INPUT_FILE, weights=None, output_file=OUTPUT_FILE):
+    df = pd.read_csv(input_file)
+    aggregates = Aggregates.of(
+        df,
+        "exp",
+        categorical=[c for c in CATEGORICAL if c in df],
+        continuous=[c for c in CONTINUOUS if c in df],
+        weights=weights,
+    )
+    write_table(standardised_differences(aggregates), output_file)
+
+
+if __name__ == "__main__":
+    main(*sys.argv[1:])
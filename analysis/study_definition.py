@@ -6,7 +6,40 @@ from cohortextractor import (
     codelist_from_csv,
     filter_codes_by_category,
 )
-from codelists import *
+from codelists import (
+    aplastic_codes,
+    chronic_cardiac_disease_codes,
+    chronic_liver_disease_codes,
+    chronic_respiratory_disease_codes,
+    clear_smoking_codes,
+    covid_codelist,
+    dementia_codes,
+    diabetes_t1_codes,
+    diabetes_t1_codes_hospital,
+    diabetes_t2_codes,
+    diabetes_unknown_codes,
+    dpp4i_med_codes,
+    ethnicity_codes,
+    haem_cancer_codes,
+    hba1c_new_codes,
+    hba1c_old_codes,
+    hiv_codes,
+    hypertension_codes,
+    insulin_med_codes,
+    lung_cancer_codes,
+    metformin_med_codes,
+    oad_med_codes,
+    organ_transplant_codes,
+    other_cancer_codes,
+    other_neuro_codes,
+    permanent_immune_codes,
+    ra_sle_psoriasis_codes,
+    sglt2i_med_codes,
+    sickle_cell_codes,
+    spleen_codes,
+    sulfs_med_codes,
+    temp_immune_codes,
+)
 
 start_date  = "2020-09-01"
 
@@ -0,0 +1,168 @@
+"""
+Table 1: characteristics of the cohort by exposure group.
+
+Python port of section 2 of 000_cr_descriptive_cohort.do. Rather than one
+safecount per (variable, category, exposure) cell, every cell comes from
+one Aggregates.of pass over the analysis dataset (a bincount per
+variable), or from the merged Aggregates of chunked_pipeline.py, and the
+redaction and rounding are applied to the whole table at once:
+
+  * safecount: a count of 1 to SMALL_COUNT is redacted (missing), and so
+    is every percentage of a redacted count or of a redacted group size
+  * safetab (with redact_tables=True): all of a variable's counts are
+    redacted if any of them is
+  * percentages are of the group size, rounded to 0.1 as Stata's round()
+
+The rows are those of the do-file: the group sizes, a header row per
+section, then a row per category of each variable (bar category 0, so
+binary variables have a single row), with the variable named on its
+category 1 row only. Categories are labelled as in the do-file, which
+labels agegroup 3 and 4 "60-<60" and "70-<60"; here they are "60-<70"
+and "70-<80", as in derive_cohort.LABELS.
+
+Run from the root of the repository:
+
+    python analysis/table_1.py [analysis dataset] [output]
+"""
+
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+
+from aggregates import Aggregates
+from derive_cohort import LABELS, stata_round
+from derive_cohort import OUTPUT_FILE as INPUT_FILE
+
+# Not output/tabfig, where the do-file writes its tables of the same names
+TABLES_DIR = os.path.join("output", "tables")
+OUTPUT_FILE = os.path.join(TABLES_DIR, "table_1.csv")
+
+# Counts from 1 to SMALL_COUNT are redacted
+SMALL_COUNT = 5
+
+SECTIONS = {
+    "Demographics": [
+        "agegroup",
+        "male",
+        "ethnicity",
+        "imd",
+        "smoke_nomiss",
+        "obese4cat",
+    ],
+    "Diabetes": ["diabcat", "metformin_3mths", "insulin_meds_3mths"],
+    "Clinical characteristics": [
+        "chronic_cardiac_disease",
+        "hypertension",
+        "chronic_respiratory_disease",
+        "chronic_liver_disease",
+        "cancer_exhaem_cat",
+        "cancer_haem_cat",
+        "permanent_immunodeficiency",
+        "other_immunosuppression",
+        "dysplenia",
+        "sickle_cell",
+        "spleen",
+        "hiv",
+        "ra_sle_psoriasis",
+        "other_neuro",
+        "dementia",
+    ],
+}
+VARIABLES = [name for names in SECTIONS.values() for name in names]
+
+# The column of each exposure group
+GROUPS = {1: "SGLT2i", 2: "DPP4i", 3: "Sulfs", 4: "Three", 5: "Four"}
+
+# Variables whose categories the do-file labels
+LABELLED = [
+    "agegroup",
+    "ethnicity",
+    "imd",
+    "smoke_nomiss",
+    "obese4cat",
+    "diabcat",
+    "cancer_exhaem_cat",
+    "cancer_haem_cat",
+]
+
+
+def safecount(counts):
+    """Counts with those from 1 to SMALL_COUNT redacted, as safecount."""
+    return counts.mask((counts > 0) & (counts <= SMALL_COUNT))
+
+
+def safetab(counts, by):
+    """
+    Counts with every count of a crosstab redacted where any is, as
+    safetab; `by` labels the rows of each crosstab (e.g. the variable
+    level of the index).
+    """
+    small = ((counts > 0) & (counts <= SMALL_COUNT)).any(axis=1)
+    redacted = small.groupby(by, sort=False).transform("any").to_numpy()
+    return counts.mask(np.broadcast_to(redacted[:, None], counts.shape))
+
+
+def _rows(variables, categories, values):
+    index = pd.MultiIndex.from_arrays(
+        [variables, categories], names=["variable", "category"]
+    )
+    return pd.DataFrame(values, index=index, columns=list(GROUPS), dtype="float64")
+
+
+def table_1(aggregates, sections=SECTIONS, redact_tables=False):
+    """Table 1 as a DataFrame, from Aggregates by "exp" of its variables."""
+    groups = list(GROUPS)
+    sizes = safecount(aggregates.sizes.reindex(groups, fill_value=0))
+
+    variables = [name for names in sections.values() for name in names]
+    counts = aggregates.counts.reindex(columns=groups, fill_value=0)
+    counts = counts[counts.index.get_level_values("variable").isin(variables)]
+    if redact_tables:
+        counts = safetab(counts, counts.index.get_level_values("variable"))
+    # Category 0 is only that of binary variables
+    counts = safecount(counts[counts.index.get_level_values("category") != 0])
+    summarised = set(counts.index.get_level_values("variable"))
+
+    blocks = [_rows(["N"], [" - "], [sizes.to_numpy()])]
+    for section, names in sections.items():
+        blocks.append(_rows([section], [""], np.nan))
+        for name in names:
+            if name not in summarised:
+                continue
+            rows = counts.xs(name, level="variable")
+            labels = LABELS[name] if name in LABELLED else {}
+            blocks.append(
+                _rows(
+                    np.where(rows.index == 1, name, ""),
+                    [labels.get(c, "") for c in rows.index],
+                    rows.to_numpy(),
+                )
+            )
+    table = pd.concat(blocks)
+
+    percentages = stata_round(100 * table / sizes.to_numpy())
+    columns = {}
+    for group, name in GROUPS.items():
+        columns[name] = table[group]
+        columns[f"{name}_perc"] = percentages[group]
+    return pd.DataFrame(columns).reset_index()
+
+
+def write_table(table, output_file=OUTPUT_FILE):
+    directory = os.path.dirname(output_file)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    # %g, so counts are written as integers and missing values left blank
+    table.to_csv(output_file, index=False, float_format="%.10g")
+
+
+def main(input_file=INPUT_FILE, output_file=OUTPUT_FILE):
+    df = pd.read_csv(input_file)
+    aggregates = Aggregates.of(df, "exp", categorical=[c for c in VARIABLES if c in df])
+    write_table(table_1(aggregates), output_file)
+
+
+if __name__ == "__main__":
+    main(*sys.argv[1:])
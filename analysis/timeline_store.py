@@ -0,0 +1,272 @@
+"""
+Memory-mapped store of patient timelines for the codelist-based queries.
+
+`with_these_clinical_events`, `with_these_medications` and
+`admitted_to_hospital` all ask whether a patient has an event with one of a
+set of codes in a date window, and return its first or last date, value or
+category, or a count. The build step writes each of those event tables once
+in compressed sparse row (CSR) layout, sorted by patient and then date:
+
+    <store>/patient_ids.npy         int64, sorted; the row order of results
+    <store>/<table>/offsets.npy     int64, patient i's events are
+                                    offsets[i]:offsets[i + 1]
+    <store>/<table>/dates.npy       int32 day numbers
+    <store>/<table>/codes.npy       int32 ids into vocabulary.npy
+    <store>/<table>/vocabulary.npy  the distinct codes, sorted (int64 for
+                                    dm+d medication codes)
+    <store>/<table>/values.npy      float64 numeric values (clinical events)
+
+For admissions the "code" is the whole "||"-separated diagnoses field, so
+ICD-10 prefixes are matched against the distinct fields rather than every
+admission.
+
+TimelineStore opens the arrays read-only with np.load(mmap_mode="r"), so
+only the pages a query touches are read, and repeated extractions during
+development cost a lookup over the code ids rather than parsing and
+sorting the source tables again. Results follow the local extractor's
+conventions (see local_extractor.py) and are aligned with patient_ids.
+
+Run from the root of the repository to build a store:
+
+    python analysis/timeline_store.py <tables directory> [store directory]
+"""
+
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+from cohortextractor.process_covariate_definitions import process_arguments
+
+from event_tables import NULL_DATE, EventTables, format_dates, to_day, to_int_codes
+from extraction_plan import UNSUPPORTED_EVENT_ARGUMENTS
+from local_extractor import (
+    RETURNING,
+    UNSUPPORTED_ADMISSION_ARGUMENTS,
+    make_timeline,
+    match_prefixes,
+    timeline_window,
+)
+
+# Query type -> (table, argument holding its codes)
+STORE_QUERIES = {
+    "with_these_clinical_events": ("clinical_events", "codelist"),
+    "with_these_medications": ("medications", "codelist"),
+    "admitted_to_hospital": ("admissions", "with_these_diagnoses"),
+}
+
+# Table -> (date column, code column, value column or None)
+STORE_TABLES = {
+    "clinical_events": ("date", "code", "numeric_value"),
+    "medications": ("date", "code", None),
+    "admissions": ("admission_date", "diagnoses", None),
+}
+
+
+def build_store(tables, directory):
+    """Write the CSR timelines of the event tables in STORE_TABLES."""
+    if not isinstance(tables, EventTables):
+        tables = EventTables(tables)
+    os.makedirs(directory, exist_ok=True)
+    np.save(os.path.join(directory, "patient_ids.npy"), tables.patient_ids)
+
+    for name, (date_column, code_column, value_column) in STORE_TABLES.items():
+        table = tables[name]
+        positions = tables.positions(name)
+        dates = table[date_column].to_numpy()
+        # Events without a date can never fall in a window
+        rows = np.flatnonzero(dates != NULL_DATE)
+        rows = rows[np.lexsort((dates[rows], positions[rows]))]
+        codes = table[code_column].to_numpy()[rows]
+        code_ids, vocabulary = pd.factorize(pd.Series(codes).fillna(""), sort=True)
+
+        path = os.path.join(directory, name)
+        os.makedirs(path, exist_ok=True)
+        counts = np.bincount(positions[rows], minlength=len(tables))
+        offsets = np.concatenate([[0], np.cumsum(counts)]).astype("int64")
+        np.save(os.path.join(path, "offsets.npy"), offsets)
+        np.save(os.path.join(path, "dates.npy"), dates[rows].astype("int32"))
+        np.save(os.path.join(path, "codes.npy"), code_ids.astype("int32"))
+        vocabulary = vocabulary.to_numpy()
+        if vocabulary.dtype == object:
+            vocabulary = vocabulary.astype(str)
+        np.save(os.path.join(path, "vocabulary.npy"), vocabulary)
+        if value_column is not None:
+            values = table[value_column].to_numpy(dtype="float64")[rows]
+            np.save(os.path.join(path, "values.npy"), values)
+
+
+class StoredTable:
+    """The memory-mapped arrays of one table in a store."""
+
+    def __init__(self, path):
+        def load(name):
+            return np.load(os.path.join(path, f"{name}.npy"), mmap_mode="r")
+
+        self.offsets = load("offsets")
+        self.dates = load("dates")
+        self.codes = load("codes")
+        self.vocabulary = load("vocabulary")
+        self.values = None
+        if os.path.exists(os.path.join(path, "values.npy")):
+            self.values = load("values")
+
+    def code_mask(self, codes, prefixes=False):
+        """
+        Which vocabulary entries are in `codes`, or start with one of them.
+        A codelist of None matches everything.
+        """
+        if prefixes or codes is None:
+            vocabulary = np.asarray(self.vocabulary, dtype=object)
+            return match_prefixes(vocabulary, [codes])[:, 0]
+        if self.vocabulary.dtype.kind == "i":
+            return np.isin(self.vocabulary, to_int_codes(codes))
+        return np.isin(self.vocabulary, np.asarray(codes, dtype=str))
+
+
+class TimelineStore:
+    """
+    Queries over a store written by build_store. Timelines are cached per
+    set of codes, so variables sharing a codelist find its events once.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.patient_ids = np.load(
+            os.path.join(directory, "patient_ids.npy"), mmap_mode="r"
+        )
+        self.tables = {
+            name: StoredTable(os.path.join(directory, name)) for name in STORE_TABLES
+        }
+        self._timelines = {}
+
+    def __len__(self):
+        return len(self.patient_ids)
+
+    def timeline(self, name, codes, ignore_missing_values=False):
+        """The Timeline of the events in table `name` with one of `codes`."""
+        if codes is not None:
+            codes = frozenset(codes)
+        key = (name, codes, ignore_missing_values)
+        if key not in self._timelines:
+            table = self.tables[name]
+            mask = table.code_mask(
+                None if codes is None else sorted(codes), prefixes=name == "admissions"
+            )
+            rows = np.flatnonzero(mask[table.codes])
+            if ignore_missing_values:
+                rows = rows[~np.isnan(table.values[rows])]
+            positions = np.searchsorted(table.offsets, rows, "right") - 1
+            self._timelines[key] = make_timeline(rows, positions, table.dates[rows])
+        return self._timelines[key]
+
+    def query(self, query_type, arguments):
+        """
+        Evaluate one processed definition, as in `covariate_definitions`.
+        Window bounds may be YYYY-MM-DD, day numbers or, for bounds that
+        differ by patient, arrays of day numbers aligned with patient_ids.
+        Dates are returned as int32 day numbers.
+        """
+        if query_type not in STORE_QUERIES:
+            raise NotImplementedError(f"{query_type} is not held in the store")
+        unsupported = [
+            a
+            for a in UNSUPPORTED_EVENT_ARGUMENTS + UNSUPPORTED_ADMISSION_ARGUMENTS
+            if arguments.get(a)
+        ]
+        if unsupported:
+            raise NotImplementedError(
+                f"{query_type} does not support {', '.join(unsupported)} in the store"
+            )
+        name, codes_argument = STORE_QUERIES[query_type]
+        codelist = arguments.get(codes_argument)
+        if getattr(codelist, "has_categories", False):
+            codes = [code for code, category in codelist]
+        else:
+            codes = None if codelist is None else list(codelist)
+        table = self.tables[name]
+        timeline = self.timeline(
+            name, codes, bool(arguments.get("ignore_missing_values"))
+        )
+        window = tuple(
+            to_day(bound) if isinstance(bound, str) else bound
+            for bound in arguments.get("between") or (None, None)
+        )
+        patients, first, stop = timeline_window(timeline, window)
+        picked = first if arguments.get("find_first_match_in_period") else stop - 1
+        picked_rows = timeline.rows[picked]
+
+        n = len(self)
+        returning = arguments.get("returning", "binary_flag")
+        returning = RETURNING.get(returning, returning)
+        if returning == "binary_flag":
+            out = np.zeros(n, dtype="int8")
+            out[patients] = 1
+        elif returning == "date":
+            out = np.full(n, NULL_DATE, dtype="int32")
+            out[patients] = timeline.dates[picked]
+        elif returning == "number_of_matches_in_period":
+            out = np.zeros(n, dtype="int64")
+            out[patients] = stop - first
+        elif returning == "numeric_value" and table.values is not None:
+            out = np.full(n, np.nan)
+            out[patients] = table.values[picked_rows]
+        elif returning == "category":
+            categories = dict(codelist)
+            labels = np.array(
+                [categories.get(code, "") for code in table.vocabulary], dtype=object
+            )
+            out = np.full(n, "", dtype=object)
+            out[patients] = labels[table.codes[picked_rows]]
+        else:
+            raise NotImplementedError(
+                f"{query_type} returning={returning} is not supported"
+            )
+        return out
+
+    def variables(self, covariate_definitions):
+        """Evaluate every definition the store can answer, by name."""
+        return {
+            name: self.query(query_type, arguments)
+            for name, (query_type, arguments) in covariate_definitions.items()
+            if query_type in STORE_QUERIES
+        }
+
+    # The `patients.*` functions with the same arguments, returning columns
+    # as written by generate_cohort, e.g. "YYYY-MM" dates with include_month
+
+    def _patients_query(self, query_type, codes_argument, codes, arguments):
+        arguments = process_arguments(
+            {codes_argument: codes, "between": None, **arguments}
+        )
+        out = self.query(query_type, arguments)
+        if out.dtype == "int32":
+            return format_dates(out, arguments.get("date_format"))
+        return out
+
+    def with_these_clinical_events(self, codelist, **arguments):
+        return self._patients_query(
+            "with_these_clinical_events", "codelist", codelist, arguments
+        )
+
+    def with_these_medications(self, codelist, **arguments):
+        return self._patients_query(
+            "with_these_medications", "codelist", codelist, arguments
+        )
+
+    def admitted_to_hospital(self, with_these_diagnoses=None, **arguments):
+        return self._patients_query(
+            "admitted_to_hospital",
+            "with_these_diagnoses",
+            with_these_diagnoses,
+            {"returning": "binary_flag", **arguments},
+        )
+
+
+def main(tables_directory, store_directory=None):
+    tables = EventTables.from_directory(tables_directory)
+    build_store(tables, store_directory or os.path.join(tables_directory, "timelines"))
+
+
+if __name__ == "__main__":
+    main(*sys.argv[1:])
@@ -0,0 +1,79 @@
+"""
+Fixtures shared by the tests: the study definition, a small set of the
+synthetic tables written by benchmark.generate_tables and a dummy cohort.
+
+The analysis scripts import each other as flat modules and read paths
+relative to the root of the repository, as when run from it, so the tests
+do the same.
+"""
+
+import logging
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, "analysis"))
+os.chdir(ROOT)
+logging.disable(logging.CRITICAL)
+
+# Clinical event rows of the synthetic tables (5000 patients)
+CLINICAL_EVENTS = 200_000
+# Rows of the dummy cohort
+COHORT_ROWS = 20_000
+
+
+@pytest.fixture(scope="session")
+def study():
+    from study_definition import study
+
+    return study
+
+
+@pytest.fixture(scope="session")
+def table_directory(tmp_path_factory):
+    from benchmark import generate_tables
+
+    directory = tmp_path_factory.mktemp("tables")
+    generate_tables(str(directory), CLINICAL_EVENTS)
+    return str(directory)
+
+
+@pytest.fixture(scope="session")
+def tables(table_directory):
+    from event_tables import EventTables
+
+    return EventTables.from_directory(table_directory)
+
+
+@pytest.fixture(scope="session")
+def extracted(study, tables):
+    """The results of a plain (serial, unstaged, uncached) extraction."""
+    from local_extractor import LocalExtractor
+
+    return LocalExtractor(study.covariate_definitions, tables).run(1)
+
+
+@pytest.fixture(scope="session")
+def cohort_file(study, tmp_path_factory):
+    """A dummy cohort in the layout of generate_cohort's input.csv."""
+    from dummy_data import generate
+
+    path = str(tmp_path_factory.mktemp("cohort") / "input.csv")
+    generate(study, COHORT_ROWS, path, seed=3)
+    return path
+
+
+@pytest.fixture(scope="session")
+def analysis_dataset(cohort_file, tmp_path_factory):
+    """The dummy cohort's analysis dataset, as read back from its CSV."""
+    import pandas as pd
+
+    from cohort_io import read_cohort
+    from derive_cohort import derive_cohort
+
+    path = tmp_path_factory.mktemp("analysis") / "analysis_dataset.csv"
+    df = derive_cohort(read_cohort(cohort_file))
+    df.to_csv(path, index=False, date_format="%Y-%m-%d")
+    return pd.read_csv(path)
@@ -0,0 +1,68 @@
+"""
+The synthetic tables of the benchmark, and one run of it.
+"""
+
+import json
+import os
+
+import pandas as pd
+import pytest
+
+from benchmark import (
+    CODELIST_SHARE,
+    generate_tables,
+    plain_codes,
+    run_once,
+    study_codelists,
+)
+from event_tables import TABLES
+from local_extractor import LocalExtractor
+
+
+@pytest.fixture(scope="module")
+def rows(table_directory):
+    with open(os.path.join(table_directory, "rows.json")) as f:
+        return json.load(f)
+
+
+def read(directory, name):
+    return pd.read_feather(os.path.join(directory, f"{name}.feather"))
+
+
+def test_tables(table_directory, rows):
+    assert set(rows) == set(TABLES)
+    patients = read(table_directory, "patients")["patient_id"]
+    assert patients.is_unique
+    for name in TABLES:
+        table = read(table_directory, name)
+        assert len(table) == rows[name]
+        assert table["patient_id"].isin(patients).all(), name
+
+
+def test_codelist_shares(study, table_directory):
+    codelists = study_codelists(study.covariate_definitions)
+    for name in ["clinical_events", "medications"]:
+        codes = set().union(*codelists[name])
+        share = read(table_directory, name)["code"].isin(codes).mean()
+        assert share == pytest.approx(CODELIST_SHARE[name], abs=0.02), name
+    hypertension = study.covariate_definitions["hypertension"][1]["codelist"]
+    assert sorted(set(plain_codes(hypertension))) in codelists["clinical_events"]
+
+
+def test_seed_gives_the_same_tables(table_directory, rows, tmp_path):
+    generate_tables(str(tmp_path / "again"), rows["clinical_events"])
+    generate_tables(str(tmp_path / "other"), rows["clinical_events"], seed=1)
+    for name in TABLES:
+        table = read(table_directory, name)
+        assert read(tmp_path / "again", name).equals(table), name
+    other = read(tmp_path / "other", "clinical_events")
+    assert not other.equals(read(table_directory, "clinical_events"))
+
+
+def test_run_once(study, tables, table_directory):
+    stages, population, profile = run_once(study, table_directory, 1)
+    extracted = LocalExtractor(study.covariate_definitions, tables).extract()
+    assert population == len(extracted)
+    assert "load" in stages and "to_frame" in stages
+    assert any(name.startswith("extraction stage") for name in stages)
+    assert set(profile.report()["variables"]) == set(study.covariate_definitions)
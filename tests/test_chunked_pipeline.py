@@ -0,0 +1,108 @@
+"""
+The chunked pipeline against extracting and deriving the whole cohort at
+once and summarising the analysis dataset with each script's main().
+"""
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import standardised_differences
+import table_1
+from chunked_pipeline import add_counts, run_pipeline
+from cohort_io import cohort_schema, read_cohort, write_cohort
+from derive_cohort import cut_point_counts, cut_points, derive_cohort
+from descriptive_stats import write_descriptive_stats
+from local_extractor import LocalExtractor
+from outcome_sequences import count_sequences
+
+CHUNKS = 3
+
+
+def read(path):
+    with open(path) as f:
+        return f.read()
+
+
+def as_csv(df):
+    return df.reset_index(drop=True).to_csv(index=False, date_format="%Y-%m-%d")
+
+
+@pytest.fixture(scope="module")
+def outputs(table_directory, tmp_path_factory):
+    directory = tmp_path_factory.mktemp("pipeline")
+    files = {
+        "output_file": directory / "analysis_dataset.csv",
+        "aggregates_dir": directory / "aggregates",
+        "table_1_file": directory / "table_1.csv",
+        "descriptive_stats_files": (
+            directory / "descriptive_stats.csv",
+            directory / "sequences.csv",
+        ),
+        "differences_file": directory / "differences.csv",
+        "chunk_dir": directory / "chunks",
+    }
+    files = {
+        key: tuple(map(str, value)) if isinstance(value, tuple) else str(value)
+        for key, value in files.items()
+    }
+    _, report = run_pipeline(table_directory, chunks=CHUNKS, **files)
+    assert report["chunks"] == CHUNKS
+    return files
+
+
+@pytest.fixture(scope="module")
+def reference(study, tables, tmp_path_factory):
+    """The whole cohort's analysis dataset, written as derive_cohort would."""
+    directory = tmp_path_factory.mktemp("whole")
+    df = LocalExtractor(study.covariate_definitions, tables, staged=True).extract()
+    write_cohort(
+        df,
+        str(directory / "input.feather"),
+        cohort_schema(study.covariate_definitions),
+    )
+    df = derive_cohort(read_cohort(str(directory / "input.feather")))
+    assert len(df) > 0
+    path = str(directory / "analysis_dataset.csv")
+    df.to_csv(path, index=False, date_format="%Y-%m-%d")
+    return path
+
+
+def test_analysis_dataset_equals_the_whole(outputs, reference):
+    assert read(outputs["output_file"]) == read(reference)
+
+
+def test_summaries_equal_the_whole(outputs, reference, tmp_path):
+    table_1.main(reference, str(tmp_path / "table_1.csv"))
+    assert read(outputs["table_1_file"]) == read(tmp_path / "table_1.csv")
+
+    df = pd.read_csv(reference)
+    write_descriptive_stats(
+        count_sequences(df),
+        df["exp"].value_counts(),
+        str(tmp_path / "descriptive_stats.csv"),
+        str(tmp_path / "sequences.csv"),
+    )
+    for got, name in zip(
+        outputs["descriptive_stats_files"], ["descriptive_stats.csv", "sequences.csv"]
+    ):
+        assert read(got) == read(tmp_path / name)
+
+    # Float sums added up over chunks may differ in the last bits
+    standardised_differences.main(reference, output_file=str(tmp_path / "sd.csv"))
+    got = pd.read_csv(outputs["differences_file"])
+    expected = pd.read_csv(tmp_path / "sd.csv")
+    pd.testing.assert_frame_equal(got, expected, rtol=1e-9)
+
+
+def test_cuts_from_chunks_equal_the_whole(cohort_file):
+    df = read_cohort(cohort_file)
+    chunks = np.array_split(np.arange(len(df)), CHUNKS)
+    parts = [df.iloc[rows] for rows in chunks]
+    cuts = cut_points(add_counts([cut_point_counts(part) for part in parts]))
+    whole = cut_points(cut_point_counts(df))
+    for name in whole:
+        np.testing.assert_array_equal(cuts[name], whole[name])
+
+    derived = pd.concat([derive_cohort(part, cuts) for part in parts])
+    assert as_csv(derived) == as_csv(derive_cohort(df))
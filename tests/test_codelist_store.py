@@ -0,0 +1,55 @@
+"""
+The compiled codelist store against reading each CSV with cohortextractor.
+"""
+
+import os
+
+import pytest
+from cohortextractor import codelist_from_csv
+
+import codelist_store
+from codelist_store import load_codelist
+from codelists import CSV_CODELISTS
+
+
+@pytest.fixture
+def store(tmp_path, monkeypatch):
+    directory = str(tmp_path / ".compiled")
+    monkeypatch.setattr(codelist_store, "STORE_DIR", directory)
+    monkeypatch.setattr(codelist_store, "_interned", {})
+    return directory
+
+
+def as_list(codes):
+    return [tuple(code) if isinstance(code, tuple) else code for code in codes]
+
+
+def test_compiled_codelists_equal_the_csvs(store):
+    for name, arguments in CSV_CODELISTS.items():
+        expected = codelist_from_csv(**arguments)
+        compiled = load_codelist(**arguments)
+        assert as_list(compiled) == as_list(expected), name
+        assert compiled.system == expected.system
+        assert compiled.has_categories == expected.has_categories
+    assert len(os.listdir(store)) == len(
+        {tuple(arguments.items()) for arguments in CSV_CODELISTS.values()}
+    )
+
+    # Read back from the store rather than from the CSVs
+    codelist_store._interned.clear()
+    for name, arguments in CSV_CODELISTS.items():
+        stored = load_codelist(**arguments)
+        assert as_list(stored) == as_list(codelist_from_csv(**arguments)), name
+    assert load_codelist(**arguments) is stored
+
+
+def test_changed_file_is_compiled_again(store, tmp_path):
+    path = tmp_path / "codes.csv"
+    path.write_text("code,category\nA,1\nB,2\n")
+    first = load_codelist(str(path), "ctv3", category_column="category")
+    assert as_list(first) == [("A", "1"), ("B", "2")]
+
+    path.write_text("code,category\nA,1\nC,3\n")
+    changed = load_codelist(str(path), "ctv3", category_column="category")
+    assert as_list(changed) == [("A", "1"), ("C", "3")]
+    assert len(os.listdir(store)) == 2
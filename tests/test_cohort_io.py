@@ -0,0 +1,115 @@
+"""
+The compact cohort file: every way of reading a cohort gives the same
+derived dataset, and each column's type follows the study definition
+rather than its values.
+"""
+
+import pandas as pd
+import pyarrow.feather as feather
+import pytest
+
+import cohort_io
+from cohort_io import (
+    ARROW_TYPES,
+    cohort_schema,
+    load_cohort,
+    read_cohort,
+    write_cohort,
+)
+from derive_cohort import derive_cohort
+
+
+def as_csv(df):
+    return df.reset_index(drop=True).to_csv(index=False, date_format="%Y-%m-%d")
+
+
+@pytest.fixture(scope="module")
+def compact_file(study, cohort_file, tmp_path_factory):
+    path = str(tmp_path_factory.mktemp("compact") / "input.feather")
+    cohort_io.main(cohort_file, path)
+    return path
+
+
+def test_derived_from_csv_and_feather_are_equal(study, cohort_file, compact_file):
+    from_csv = derive_cohort(read_cohort(cohort_file))
+    from_feather = derive_cohort(read_cohort(compact_file))
+    loaded = derive_cohort(load_cohort(cohort_file, study.covariate_definitions))
+    assert len(from_csv) > 0
+    assert as_csv(from_feather) == as_csv(from_csv)
+    assert as_csv(loaded) == as_csv(from_csv)
+
+
+def test_types_follow_the_schema(study, cohort_file, compact_file, tmp_path):
+    schema = cohort_schema(study.covariate_definitions)
+    types = feather.read_table(compact_file).schema
+    assert set(types.names) == set(schema)
+    for name, (kind, categories) in schema.items():
+        assert types.field(name).type == ARROW_TYPES[kind], name
+
+    # A few rows in which dates are all missing and flags all 0 are
+    # stored with the same types
+    rows = pd.read_csv(cohort_file, nrows=5, dtype=str, keep_default_na=False)
+    for name, (kind, categories) in schema.items():
+        if kind in ("date", "month"):
+            rows[name] = ""
+        elif kind == "flag":
+            rows[name] = "0"
+    rows.to_csv(tmp_path / "rows.csv", index=False)
+    cohort_io.main(str(tmp_path / "rows.csv"), str(tmp_path / "rows.feather"))
+    assert feather.read_table(tmp_path / "rows.feather").schema.types == types.types
+
+
+def test_month_dates_are_read_mid_month(study, cohort_file, compact_file):
+    schema = cohort_schema(study.covariate_definitions)
+    months = [name for name, (kind, _) in schema.items() if kind == "month"]
+    assert months
+    raw = pd.read_csv(cohort_file, usecols=months, dtype=str)
+    compact = read_cohort(compact_file, columns=months)
+    for name in months:
+        expected = pd.to_datetime(raw[name] + "-15")
+        pd.testing.assert_series_equal(compact[name], expected, check_dtype=False)
+
+
+def test_write_cohort_without_a_schema(tmp_path):
+    df = pd.DataFrame(
+        {
+            "patient_id": [1, 2, 3],
+            "small": [0, 1, 200],
+            "score": [0.5, 1.0, float("nan")],
+            "date": ["2020-01-02", None, "2021-12-31"],
+            "label": ["a", None, "b"],
+        }
+    )
+    path = str(tmp_path / "scores.feather")
+    write_cohort(df, path)
+    types = feather.read_table(path).schema
+    assert str(types.field("small").type) == "int16"
+    assert str(types.field("score").type) == "double"
+    assert str(types.field("date").type) == "date32[day]"
+    back = read_cohort(path)
+    assert back["date"].isna().tolist() == [False, True, False]
+    assert back["label"].isna().tolist() == [False, True, False]
+    assert list(back["label"].cat.categories) == ["a", "b"]
+
+
+def test_load_cohort_in_small_blocks(study, cohort_file):
+    whole = load_cohort(cohort_file, study.covariate_definitions)
+    blocks = load_cohort(cohort_file, study.covariate_definitions, block_size=2**16)
+    pd.testing.assert_frame_equal(blocks, whole)
+
+
+def test_load_cohort_types(study, cohort_file):
+    schema = cohort_schema(study.covariate_definitions)
+    df = load_cohort(cohort_file, study.covariate_definitions)
+    for name, (kind, categories) in schema.items():
+        if kind in ("date", "month"):
+            assert df[name].dtype == "int32", name
+        elif kind == "flag":
+            assert df[name].dtype == "int8", name
+        elif kind == "category":
+            assert df[name].dtype == "category", name
+            # Categories the definition allows come first, in its order
+            head = list(df[name].cat.categories[: len(categories or [])])
+            assert head == list(categories or []), name
+        elif kind == "int":
+            assert df[name].dtype in ("int8", "int16"), name
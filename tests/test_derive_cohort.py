@@ -0,0 +1,107 @@
+"""
+Derivations which follow Stata commands of the do-file: _pctile, egen
+cut(), group() and mkspline ..., cubic.
+"""
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from derive_cohort import (
+    AGE_KNOT_PERCENTILES,
+    derive_demographics,
+    derive_hba1c,
+    stata_pctile,
+    stata_pctile_counts,
+)
+
+
+def demographics(imd, age=None):
+    n = len(imd)
+    return pd.DataFrame(
+        {
+            "exposure": ["DPP4i"] * n,
+            "sex": ["M", "F"] * (n // 2) + ["M"] * (n % 2),
+            "imd": imd,
+            "smoking_status": ["N"] * n,
+            "ethnicity": ["1"] * n,
+            "age": np.arange(40, 40 + n) if age is None else age,
+        }
+    )
+
+
+def test_stata_pctile():
+    # _pctile takes the mean of two order statistics where n * p / 100 is
+    # whole, and otherwise the next one up
+    x = np.arange(1, 11)
+    np.testing.assert_array_equal(stata_pctile(x, [25, 50, 95]), [3, 5.5, 10])
+    np.testing.assert_array_equal(stata_pctile([np.nan, 2, 1], [50]), [1.5])
+    assert np.isnan(stata_pctile([], [50])).all()
+
+
+def test_stata_pctile_counts_equals_stata_pctile():
+    rng = np.random.default_rng(0)
+    values = rng.integers(0, 30, 1001).astype("float64")
+    counts = pd.Series(values).value_counts()
+    percentiles = [5, 20, 35, 40, 60, 65, 80, 95]
+    np.testing.assert_array_equal(
+        stata_pctile_counts(counts, percentiles), stata_pctile(values, percentiles)
+    )
+
+
+def test_imd_as_egen_cut_group_5_icodes():
+    # Breaks over every value, -1 included: 100, 250, 300 and 450. Groups
+    # are closed on the left, so 100 and 300 are in the group above their
+    # break; -1 is then set missing and its patient dropped
+    imd = [-1, 100, 100, 200, 300, 300, 300, 400, 500, 600]
+    df = derive_demographics(demographics(imd))
+    quintiles = {100: 2, 200: 2, 300: 4, 400: 4, 500: 5, 600: 5}
+    expected = [6 - quintiles[value] for value in imd[1:]]
+    assert df["imd"].tolist() == expected
+    assert df["imd"].dtype == "int8"
+
+
+def test_given_cuts_are_used():
+    imd = [100, 200, 300, 400, 500, 600]
+    cuts = {"imd": np.array([150, 250, 350, 450]), "age": np.array([41, 42, 43, 44])}
+    df = derive_demographics(demographics(imd), cuts)
+    assert df["imd"].tolist() == [5, 4, 3, 2, 1, 1]
+
+
+def test_age_spline_is_restricted_cubic():
+    age = np.arange(18, 101)
+    df = derive_demographics(demographics([100] * len(age), age))
+    knots = stata_pctile(age, AGE_KNOT_PERCENTILES)
+    assert df["age1"].tolist() == age.tolist()
+    for term in ["age2", "age3"]:
+        # 0 below the first knot, and linear beyond the last
+        assert (df[term][age <= knots[0]] == 0).all()
+        beyond = df[term][age >= knots[-1]].to_numpy()
+        np.testing.assert_allclose(np.diff(beyond, 2), 0, atol=1e-9)
+        assert (np.diff(df[term]) >= 0).all()
+
+
+def test_sex_must_be_known():
+    df = demographics([100, 200])
+    df.loc[0, "sex"] = "U"
+    with pytest.raises(ValueError, match="sex"):
+        derive_demographics(df)
+
+
+def test_hba1c_rounds_halves_up():
+    # round(hba1c_pct, 0.1) puts 6.45 and 7.45 in the category above
+    percentage = [6.45, 7.45, 6.449, 7.55, 6.35]
+    day = pd.Timestamp("2020-08-01")
+    df = pd.DataFrame(
+        {
+            "indexdate": pd.Timestamp("2020-09-01"),
+            "hba1c_percentage": percentage,
+            "hba1c_percentage_date": day,
+            "hba1c_mmol_per_mol": np.nan,
+            "hba1c_mmol_per_mol_date": pd.NaT,
+        }
+    )
+    df = derive_hba1c(df)
+    assert df["hba1c_pct"].tolist() == [6.5, 7.5, 6.4, 7.6, 6.4]
+    assert df["hba1ccat"].tolist() == [1, 2, 0, 2, 0]
+    assert df["diabcat"].tolist() == [1, 2, 1, 2, 1]
@@ -0,0 +1,138 @@
+"""
+The released outcome counts: no count safecount redacts can be rebuilt
+from the cells which are released.
+"""
+
+from itertools import product
+
+import numpy as np
+import pandas as pd
+import pytest
+import yaml
+
+from derive_cohort import LABELS, OUTCOME_FLAGS, OUTCOME_SEQUENCES, derive_outcomes
+from descriptive_stats import OUTPUT_FILE, SEQUENCES_FILE, descriptive_stats
+from outcome_sequences import (
+    SEQUENCE_OUTCOMES,
+    count_sequences,
+    sequence_codes,
+    sequence_flags,
+)
+from table_1 import GROUPS, safecount
+
+
+def all_sequence_codes(k=len(SEQUENCE_OUTCOMES)):
+    """The code of every order, with ties, of every set of k outcomes."""
+    ranks = [
+        r
+        for r in product(range(k + 1), repeat=k)
+        if set(r) - {0} == set(range(1, max(r) + 1))
+    ]
+    return sequence_codes(np.array(ranks))
+
+
+def recoverable(published, sequences=None):
+    """
+    (flag, group) of the redacted counts which follow from the released
+    ones, and from the counts of each sequence (rows) by group (columns)
+    if those are released too. Each released count is a sum of the unknown
+    counts of some sequences, and a group size the sum of all of them; a
+    count of 0 shows that each sequence it covers has none. A redacted
+    count is recovered if it is a linear combination of the released ones.
+    """
+    codes = all_sequence_codes()
+    covered = sequence_flags(codes, OUTCOME_SEQUENCES)
+    found = []
+    for group in GROUPS:
+        rows = published[published["treatment"] == LABELS["exp"][group]]
+        events = rows.set_index("outcome")["numEvents"]
+        released = []
+        if rows["numPatients"].notna().all():
+            released.append((np.ones(len(codes), dtype=bool), rows["numPatients"]))
+        released += [(covered[f], events[f]) for f in OUTCOME_FLAGS]
+        if sequences is not None:
+            counts = sequences.reindex(index=codes, columns=[group], fill_value=0)
+            released += [(codes == c, n) for c, n in zip(codes, counts[group])]
+        released = [(sums, n) for sums, n in released if not np.all(np.isnan(n))]
+
+        zero = np.zeros(len(codes), dtype=bool)
+        for sums, n in released:
+            if np.all(n == 0):
+                zero |= sums
+        if zero.all():
+            continue
+        known = np.array([sums[~zero] for sums, _ in released], dtype=float)
+        rank = np.linalg.matrix_rank(known)
+        for flag in OUTCOME_FLAGS:
+            if np.isnan(events[flag]):
+                target = covered[flag][~zero].astype(float)
+                if np.linalg.matrix_rank(np.vstack([known, target])) == rank:
+                    found.append((flag, group))
+    return found
+
+
+def outcomes(patients):
+    """A cohort with `patients` of each (exposure, comm day, hosp day)."""
+    rows = []
+    for (exposure, comm, hosp), n in patients.items():
+        day = pd.Timestamp("2020-09-01")
+        rows += [
+            {
+                "exp": exposure,
+                "first_comm_covid": int(comm is not None),
+                "first_comm_covid_date": day + pd.Timedelta(days=comm or 0),
+                "hospitalised_covid": int(hosp is not None),
+                "hospitalised_covid_date": day + pd.Timedelta(days=hosp or 0),
+                "died_date_ons_date": pd.NaT,
+            }
+        ] * n
+    df = pd.DataFrame(rows)
+    df.loc[df["first_comm_covid"] == 0, "first_comm_covid_date"] = pd.NaT
+    df.loc[df["hospitalised_covid"] == 0, "hospitalised_covid_date"] = pd.NaT
+    return derive_outcomes(df)
+
+
+def published(df):
+    return descriptive_stats(count_sequences(df), df["exp"].value_counts())
+
+
+def test_sequence_table_is_not_released():
+    with open("project.yaml") as f:
+        project = yaml.safe_load(f)
+    released = [
+        path
+        for action in project["actions"].values()
+        for path in action["outputs"].get("moderately_sensitive", {}).values()
+    ]
+    assert OUTPUT_FILE in released
+    assert SEQUENCES_FILE not in released
+
+
+def test_redacted_count_is_not_recovered():
+    # 3 patients with comm and hosp on the same day are counted by both
+    # comm_hosp (13) and hosp_comm (3, redacted)
+    df = outcomes({(1, 0, 0): 3, (1, 0, 2): 10, (1, None, None): 100})
+    table = published(df).set_index(["outcome", "treatment"])["numEvents"]
+    assert table["comm_hosp"].max() == 13
+    assert table["hosp_comm"].isna().any()
+    assert recoverable(published(df)) == []
+
+    # It could be, were the counts of each sequence released as well
+    sequences = safecount(count_sequences(df).astype("float64"))
+    assert recoverable(published(df), sequences) == [("hosp_comm", 1)]
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_no_redacted_count_is_recovered(seed):
+    rng = np.random.default_rng(seed)
+    days = [None, 0, 1, 2]
+    patients = {
+        (exposure, comm, hosp): int(rng.integers(0, 3))
+        for exposure in GROUPS
+        for comm in days
+        for hosp in days
+    }
+    df = outcomes(patients)
+    table = published(df)
+    assert table["numEvents"].isna().any()
+    assert recoverable(table) == []
@@ -0,0 +1,141 @@
+"""
+Drug eras against building them with a loop over each patient's
+prescriptions.
+"""
+
+import os
+
+import pandas as pd
+import pytest
+
+from codelists import dpp4i_med_codes, metformin_med_codes, sglt2i_med_codes
+from drug_eras import DAYS_SUPPLY, GRACE_PERIOD, add_variables, drug_era
+from event_tables import NULL_DATE, to_day
+from local_extractor import LocalExtractor
+
+WINDOW = ["2019-09-01", "2020-09-01"]
+
+CODELISTS = {
+    "metformin": metformin_med_codes,
+    "dpp4i": dpp4i_med_codes,
+    "sglt2i": sglt2i_med_codes,
+}
+
+VARIABLES = dict(
+    metformin_start=drug_era(
+        metformin_med_codes, between=WINDOW, find_first_match_in_period=True
+    ),
+    metformin_end=drug_era(
+        metformin_med_codes, between=WINDOW, returning="era_end_date"
+    ),
+    metformin_eras=drug_era(
+        metformin_med_codes, between=WINDOW, returning="number_of_eras"
+    ),
+    metformin_any=drug_era(
+        metformin_med_codes, between=WINDOW, returning="binary_flag"
+    ),
+    dpp4i_add_on=drug_era(
+        dpp4i_med_codes,
+        between=WINDOW,
+        returning="add_on_date",
+        reference_codelist=metformin_med_codes,
+        find_first_match_in_period=True,
+    ),
+    sglt2i_switch=drug_era(
+        sglt2i_med_codes,
+        between=WINDOW,
+        returning="switch_date",
+        reference_codelist=metformin_med_codes,
+    ),
+    dpp4i_after_metformin=drug_era(
+        dpp4i_med_codes,
+        between=["metformin_start + 10 days", WINDOW[1]],
+        returning="era_start_date",
+        find_first_match_in_period=True,
+    ),
+)
+
+
+def loop_eras(medications, codes):
+    """Each patient's eras as [start, end] day numbers, one at a time."""
+    medications = medications[medications["code"].isin([str(c) for c in codes])]
+    medications = medications.sort_values(["patient_id", "day"], kind="stable")
+    eras = {}
+    for patient_id, days in medications.groupby("patient_id")["day"]:
+        patient_eras = []
+        for day in days:
+            if patient_eras and day <= patient_eras[-1][1] + 1 + GRACE_PERIOD:
+                patient_eras[-1][1] = max(patient_eras[-1][1], day + DAYS_SUPPLY - 1)
+            else:
+                patient_eras.append([day, day + DAYS_SUPPLY - 1])
+        eras[patient_id] = patient_eras
+    return eras
+
+
+def classify(era, reference):
+    """Whether an era is an add-on to or switch from the reference eras."""
+    start = era[0]
+    before = [other for other in reference if other[0] < start]
+    if not before:
+        return None
+    end = before[-1][1]
+    if end >= start + GRACE_PERIOD:
+        return "add_on"
+    if end >= start - GRACE_PERIOD:
+        return "switch"
+    return None
+
+
+def loop_variables(medications, patient_ids):
+    eras = {name: loop_eras(medications, codes) for name, codes in CODELISTS.items()}
+    first, last = to_day(WINDOW[0]), to_day(WINDOW[1])
+    expected = {name: [] for name in VARIABLES}
+    for patient_id in patient_ids:
+        metformin = eras["metformin"].get(patient_id, [])
+        dpp4i = eras["dpp4i"].get(patient_id, [])
+        sglt2i = eras["sglt2i"].get(patient_id, [])
+        current = [era for era in metformin if first <= era[0] <= last]
+        start = current[0][0] if current else NULL_DATE
+        add_ons = [
+            era
+            for era in dpp4i
+            if first <= era[0] <= last and classify(era, metformin) == "add_on"
+        ]
+        switches = [
+            era
+            for era in sglt2i
+            if first <= era[0] <= last and classify(era, metformin) == "switch"
+        ]
+        after = [
+            era for era in dpp4i if start != NULL_DATE and start + 10 <= era[0] <= last
+        ]
+        expected["metformin_start"].append(start)
+        expected["metformin_end"].append(current[-1][1] if current else NULL_DATE)
+        expected["metformin_eras"].append(len(current))
+        expected["metformin_any"].append(int(bool(current)))
+        expected["dpp4i_add_on"].append(add_ons[0][0] if add_ons else NULL_DATE)
+        expected["sglt2i_switch"].append(switches[-1][0] if switches else NULL_DATE)
+        expected["dpp4i_after_metformin"].append(after[0][0] if after else NULL_DATE)
+    return expected
+
+
+@pytest.fixture(scope="module")
+def definitions(study):
+    return add_variables(study.covariate_definitions, **VARIABLES)
+
+
+def test_drug_eras_equal_a_loop(definitions, tables, table_directory):
+    results = LocalExtractor(definitions, tables).run(1)
+    medications = pd.read_feather(os.path.join(table_directory, "medications.feather"))
+    days = medications["date"].to_numpy().astype("datetime64[D]").astype("int64")
+    medications["day"] = days
+    expected = loop_variables(medications, tables.patient_ids)
+    for name in VARIABLES:
+        assert len(set(expected[name])) > 1, name
+        assert list(results[name]) == expected[name], name
+
+
+def test_staged_drug_eras(definitions, tables):
+    unstaged = LocalExtractor(definitions, tables).extract(1)
+    staged = LocalExtractor(definitions, tables, staged=True).extract(3)
+    assert staged.equals(unstaged)
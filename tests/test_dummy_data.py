@@ -0,0 +1,94 @@
+"""
+The dummy cohort: every row is in the population, the categorised_as
+columns follow from the others, the expectations kept jointly are met and
+a seed always gives the same file.
+"""
+
+import filecmp
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from dummy_data import KEEP_EXPECTATIONS, DummyCohort, generate
+from event_tables import NULL_DATE, to_days
+from expressions import categorise
+
+ROWS = 50_000
+CHUNK_SIZE = 20_000
+
+
+@pytest.fixture(scope="module")
+def dummy_file(study, tmp_path_factory):
+    path = str(tmp_path_factory.mktemp("dummy") / "dummy_input.csv")
+    generate(study, ROWS, path, seed=1, chunk_size=CHUNK_SIZE)
+    return path
+
+
+@pytest.fixture(scope="module")
+def dummy(dummy_file):
+    return pd.read_csv(dummy_file, keep_default_na=False, na_values=[""])
+
+
+def as_extracted(df, definitions):
+    """The columns as the extractor holds them, for evaluating expressions."""
+    columns = {}
+    for name in df:
+        column_type = definitions.get(name, ("", {}))[1].get("column_type")
+        if column_type == "date":
+            columns[name] = to_days(df[name])
+        elif column_type == "str":
+            columns[name] = df[name].fillna("").astype(str).to_numpy(dtype=object)
+        else:
+            columns[name] = df[name].fillna(0).to_numpy()
+    return columns
+
+
+def test_every_row_is_in_the_population(dummy):
+    assert len(dummy) == ROWS
+    assert dummy["age"].between(18, 110).all()
+    assert dummy["sex"].isin(["M", "F"]).all()
+    assert (dummy["imd"] > 0).all()
+    assert (dummy["t2dm"] == 1).all()
+    assert (dummy["exposure"] != "none").all()
+
+
+def test_composites_follow_from_their_inputs(study, dummy):
+    definitions = study.covariate_definitions
+    columns = as_extracted(dummy, definitions)
+    dates = {
+        name
+        for name in columns
+        if definitions.get(name, ("", {}))[1].get("column_type") == "date"
+    }
+    composites = DummyCohort(study).composites
+    assert composites
+    for name in composites:
+        arguments = definitions[name][1]
+        expected = categorise(
+            arguments["category_definitions"],
+            columns,
+            dates,
+            len(dummy),
+            arguments["column_type"],
+        )
+        assert [str(value) for value in columns[name]] == [
+            str(value) for value in expected
+        ]
+
+
+@pytest.mark.parametrize("name", KEEP_EXPECTATIONS)
+def test_kept_expectations_match_an_independent_draw(study, dummy, name):
+    spec = {spec.name: spec for spec in DummyCohort(study).specs}[name]
+    independent = spec.draw(np.random.default_rng(0), ROWS)
+    expected = np.mean(independent != NULL_DATE)
+    assert dummy[name].notna().mean() == pytest.approx(expected, abs=0.005)
+
+
+def test_seed_gives_the_same_file(study, dummy_file, tmp_path):
+    again = str(tmp_path / "again.csv")
+    generate(study, ROWS, again, seed=1, chunk_size=CHUNK_SIZE)
+    assert filecmp.cmp(dummy_file, again, shallow=False)
+    other = str(tmp_path / "other.csv")
+    generate(study, ROWS, other, seed=2, chunk_size=CHUNK_SIZE)
+    assert not filecmp.cmp(dummy_file, other, shallow=False)
@@ -0,0 +1,123 @@
+"""
+Compiled expressions against the backend's own: each categorised_as
+variable is also evaluated as the CASE expression cohortextractor builds
+from it, in SQLite over the extracted columns.
+"""
+
+import sqlite3
+
+import numpy as np
+import pandas as pd
+import pytest
+from cohortextractor.expressions import format_expression
+
+from event_tables import format_dates
+from expressions import categorise
+
+EMPTY_VALUES = {"date": "", "str": "", "bool": 0, "int": 0, "float": 0.0}
+
+# Expressions beyond the study's, for the comparisons it does not make
+EXTRA_EXPRESSIONS = [
+    "first_comm_covid_date <= hospitalised_covid_date OR age >= 90",
+    "NOT (imd = 1000 OR sex != 'F')",
+    "hba1c_mmol_per_mol > 48 OR hba1c_percentage >= 6.5",
+    "died_date_ons OR (ethnicity = 1 AND NOT hypertension)",
+    "region = 'London' AND (age < 40 OR age > 80)",
+]
+
+
+def as_stored(values, column_type):
+    """
+    A column as the backend holds it: dates as text (NULL where missing) and
+    no missing numbers.
+    """
+    if column_type == "date":
+        return pd.Series(format_dates(values)).replace("", None).to_numpy()
+    if column_type in ("int", "float", "bool"):
+        return pd.Series(values, dtype="float64").fillna(0).to_numpy()
+    return values
+
+
+def case_expression(category_definitions, names):
+    """The CASE expression of cohortextractor's get_case_expression."""
+    clauses = []
+    default = None
+    for category, expression in category_definitions.items():
+        if expression.strip() == "DEFAULT":
+            default = category
+            continue
+        formatted, _ = format_expression(
+            expression, {name: name for name in names}, names
+        )
+        clauses.append(f"WHEN ({formatted}) THEN {quote(category)}")
+    return f"CASE {' '.join(clauses)} ELSE {quote(default)} END"
+
+
+def quote(value):
+    return f"'{value}'" if isinstance(value, str) else str(value)
+
+
+class Backend:
+    """The extracted columns in an SQLite table, one row per patient."""
+
+    def __init__(self, definitions, results):
+        self.connection = sqlite3.connect(":memory:")
+        self.empty_values = {}
+        columns = {}
+        for name, (query_type, args) in definitions.items():
+            if query_type != "categorised_as":
+                column_type = args["column_type"]
+                columns[name] = as_stored(results[name], column_type)
+                self.empty_values[name] = EMPTY_VALUES[column_type]
+        pd.DataFrame(columns).to_sql("patients", self.connection)
+
+    def categorise(self, name, category_definitions, column_type):
+        sql = case_expression(category_definitions, self.empty_values)
+        values = [
+            row[0]
+            for row in self.connection.execute(
+                f"SELECT {sql} FROM patients ORDER BY rowid"
+            )
+        ]
+        self.connection.execute(f"ALTER TABLE patients ADD COLUMN {name}")
+        self.connection.executemany(
+            f"UPDATE patients SET {name} = ? WHERE rowid = ?",
+            [(value, rowid) for rowid, value in enumerate(values, start=1)],
+        )
+        self.empty_values[name] = EMPTY_VALUES[column_type]
+        return values
+
+
+@pytest.fixture(scope="module")
+def backend(study, extracted):
+    return Backend(study.covariate_definitions, extracted)
+
+
+def test_categorised_as_matches_backend(study, extracted, backend):
+    categorised = [
+        (name, args)
+        for name, (query_type, args) in study.covariate_definitions.items()
+        if query_type == "categorised_as"
+    ]
+    assert categorised
+    for name, args in categorised:
+        expected = backend.categorise(
+            name, args["category_definitions"], args["column_type"]
+        )
+        got = extracted[name]
+        assert [str(value) for value in got] == [str(value) for value in expected]
+
+
+@pytest.mark.parametrize("expression", EXTRA_EXPRESSIONS)
+def test_expression_matches_backend(study, extracted, backend, expression):
+    definitions = {1: expression, 0: "DEFAULT"}
+    dates = {
+        name
+        for name, (query_type, args) in study.covariate_definitions.items()
+        if args.get("column_type") == "date"
+    }
+    got = categorise(definitions, extracted, dates, len(extracted["age"]), "bool")
+    expected = backend.categorise("extra", definitions, "bool")
+    backend.connection.execute("ALTER TABLE patients DROP COLUMN extra")
+    assert 0 < np.sum(got) < len(got)
+    np.testing.assert_array_equal(got, expected)
@@ -0,0 +1,61 @@
+"""
+Every way of running the local extractor gives the same cohort as a plain
+serial run.
+"""
+
+import pytest
+
+from extraction_cache import ColumnCache
+from extraction_plan import required_variables
+from local_extractor import LocalExtractor
+
+
+@pytest.fixture(scope="module")
+def serial(study, tables):
+    return LocalExtractor(study.covariate_definitions, tables).extract(1)
+
+
+def test_threaded_equals_serial(study, tables, serial):
+    threaded = LocalExtractor(study.covariate_definitions, tables).extract(4)
+    assert threaded.equals(serial)
+
+
+@pytest.mark.parametrize("workers", [1, 4])
+def test_staged_equals_serial(study, tables, serial, workers):
+    staged = LocalExtractor(study.covariate_definitions, tables, staged=True)
+    assert staged.extract(workers).equals(serial)
+
+
+def changed_window(definitions, name, start):
+    query_type, args = definitions[name]
+    definitions = dict(definitions)
+    definitions[name] = (query_type, dict(args, between=[start, args["between"][1]]))
+    return definitions
+
+
+@pytest.mark.parametrize("staged", [False, True])
+def test_cached_equals_serial(study, tables, serial, tmp_path, staged):
+    definitions = study.covariate_definitions
+    first = ColumnCache(str(tmp_path))
+    extracted = LocalExtractor(definitions, tables, staged=staged, cache=first)
+    assert extracted.extract(1).equals(serial)
+    assert first.misses and not first.hits
+
+    again = ColumnCache(str(tmp_path))
+    extracted = LocalExtractor(definitions, tables, staged=staged, cache=again)
+    assert extracted.extract(4).equals(serial)
+    assert again.hits and not again.misses
+
+    # Only the changed variable and those computed from it are extracted
+    changed = changed_window(definitions, "hypertension", "2020-01-01")
+    dependents = {
+        name
+        for name in changed
+        if "hypertension" in required_variables(changed, [name])
+    }
+    cache = ColumnCache(str(tmp_path))
+    cached = LocalExtractor(changed, tables, staged=staged, cache=cache).extract(1)
+    assert "hypertension" in cache.misses
+    assert set(cache.misses) <= dependents
+    assert cached.equals(LocalExtractor(changed, tables, staged=staged).extract(1))
+    assert not cached.equals(serial)
@@ -0,0 +1,63 @@
+"""
+Variables which match the same events and differ only in what they return
+are one query of a scan, and give the same columns as when each is
+extracted on its own.
+"""
+
+import numpy as np
+import pytest
+
+from extraction_plan import plan_extraction
+from local_extractor import LocalExtractor
+
+SIBLINGS = [
+    ["hospitalised_covid", "hospitalised_covid_date"],
+    ["first_comm_covid", "first_comm_covid_date"],
+    ["hba1c_mmol_per_mol", "hba1c_flag", "hba1c_last_date"],
+]
+
+
+@pytest.fixture(scope="module")
+def definitions(study):
+    definitions = dict(study.covariate_definitions)
+    query_type, arguments = definitions["hba1c_mmol_per_mol"]
+    definitions["hba1c_flag"] = (
+        query_type,
+        dict(arguments, returning="binary_flag", column_type="bool"),
+    )
+    definitions["hba1c_last_date"] = (
+        query_type,
+        dict(
+            arguments,
+            returning="date",
+            date_format="YYYY-MM-DD",
+            include_date_of_match=False,
+            column_type="date",
+        ),
+    )
+    return definitions
+
+
+def queries(plan):
+    return [query for scan in plan.scans for query in scan.queries]
+
+
+@pytest.mark.parametrize("names", SIBLINGS)
+def test_siblings_are_one_query(definitions, names):
+    assert names in queries(plan_extraction(definitions))
+
+
+@pytest.mark.parametrize("names", SIBLINGS)
+def test_shared_query_equals_each_alone(definitions, tables, names):
+    shared = LocalExtractor({n: definitions[n] for n in names}, tables)
+    assert queries(shared.plan) == [names]
+    together = shared.run(1)
+    kinds = set()
+    for name in names:
+        alone = LocalExtractor({name: definitions[name]}, tables)
+        assert queries(alone.plan) == [[name]]
+        expected = alone.run(1)[name]
+        np.testing.assert_array_equal(together[name], expected)
+        assert len(np.unique(expected)) > 1, name
+        kinds.add(definitions[name][1]["returning"])
+    assert len(kinds) == len(names)
@@ -0,0 +1,45 @@
+"""
+A profiled extraction gives the same cohort and accounts for every
+variable.
+"""
+
+import json
+
+import numpy as np
+
+from expressions import is_true
+from extraction_profile import ExtractionProfile
+from local_extractor import LocalExtractor
+
+
+def test_profile_accounts_for_every_variable(study, tables, extracted, tmp_path):
+    definitions = study.covariate_definitions
+    profile = ExtractionProfile()
+    extractor = LocalExtractor(definitions, tables, profile=profile)
+    results = extractor.run(1)
+    for name in definitions:
+        np.testing.assert_array_equal(results[name], extracted[name], err_msg=name)
+
+    with open(profile.write(directory=str(tmp_path))) as f:
+        report = json.load(f)
+    assert set(report["variables"]) == set(definitions)
+    assert report["seconds"] > 0
+    for name, stats in report["variables"].items():
+        is_date = definitions[name][1].get("column_type") == "date"
+        returned = int(is_true(np.asarray(results[name]), is_date).sum())
+        assert stats["rows_returned"] == returned, name
+        assert stats["seconds"] >= 0
+    rows = len(tables["clinical_events"])
+    scanned = report["variables"]["hypertension"]["rows_scanned"]
+    assert 0 < scanned <= rows
+
+
+def test_staged_profile_records_stages(study, tables, tmp_path):
+    definitions = study.covariate_definitions
+    profile = ExtractionProfile()
+    unprofiled = LocalExtractor(definitions, tables, staged=True).extract(1)
+    staged = LocalExtractor(definitions, tables, staged=True, profile=profile)
+    assert staged.extract(1).equals(unprofiled)
+    stages = profile.report()["stages"]
+    assert len(stages) > 1
+    assert "total" in profile.summary()
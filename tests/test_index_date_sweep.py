@@ -0,0 +1,49 @@
+"""
+A sweep over index dates, which shares each query's timeline between
+them, against a separate extraction at each date.
+"""
+
+import numpy as np
+
+from index_date_sweep import monthly, shift_definitions, sweep
+from local_extractor import LocalExtractor
+
+BASE_DATE = "2020-09-01"
+
+
+def test_sweep_equals_separate_extractions(study, tables):
+    definitions = study.covariate_definitions
+    index_dates = ["2020-06-01", BASE_DATE, "2021-01-15"]
+    swept = dict(sweep(definitions, tables, index_dates, BASE_DATE))
+    assert list(swept) == index_dates
+    assert swept[BASE_DATE].equals(LocalExtractor(definitions, tables).extract())
+    for index_date in index_dates:
+        days = np.datetime64(index_date) - np.datetime64(BASE_DATE)
+        shifted = shift_definitions(definitions, days.astype(int))
+        separate = LocalExtractor(shifted, tables).extract()
+        assert swept[index_date].equals(separate), index_date
+    assert not swept["2020-06-01"].equals(swept[BASE_DATE])
+
+
+def test_shift_definitions_moves_fixed_dates_only():
+    definitions = {
+        "fixed": ("with_these_medications", {"between": ["2020-06-03", "2020-09-01"]}),
+        "relative": (
+            "with_these_clinical_events",
+            {"between": ["fixed - 1 year", "fixed"]},
+        ),
+        "age": ("age_as_of", {"reference_date": "2020-09-01"}),
+    }
+    shifted = shift_definitions(definitions, -31)
+    assert shifted["fixed"][1]["between"] == ["2020-05-03", "2020-08-01"]
+    assert shifted["relative"][1]["between"] == ["fixed - 1 year", "fixed"]
+    assert shifted["age"][1]["reference_date"] == "2020-08-01"
+
+
+def test_monthly():
+    assert monthly("2020-11-15", "2021-03-14", 2) == ["2020-11-15", "2021-01-15"]
+    assert monthly("2020-03-01", "2020-05-01") == [
+        "2020-03-01",
+        "2020-04-01",
+        "2020-05-01",
+    ]
@@ -0,0 +1,320 @@
+"""
+The local extractor against a naive reference: each variable computed on
+its own from the raw feather tables with pandas, one filter at a time.
+"""
+
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from event_tables import NULL_DATE, TABLES, EventTables
+from local_extractor import BMI_CODES, LocalExtractor
+from prefix_index import SEPARATOR
+
+
+@pytest.fixture(scope="module")
+def raw(table_directory):
+    return {
+        name: pd.read_feather(os.path.join(table_directory, f"{name}.feather"))
+        for name in TABLES
+    }
+
+
+@pytest.fixture(scope="module")
+def raw_with_bmi(study, raw):
+    """
+    The raw tables with the synthetic hypertension codes recorded as body
+    mass index, which the generator does not draw.
+    """
+    query_type, args = study.covariate_definitions["hypertension"]
+    events = raw["clinical_events"].copy()
+    events.loc[events["code"].isin(list(args["codelist"])), "code"] = BMI_CODES[0]
+    return dict(raw, clinical_events=events)
+
+
+def days(dates):
+    """Day numbers of a datetime Series, NULL_DATE where missing."""
+    out = dates.to_numpy().astype("datetime64[D]").astype("int64")
+    return np.where(dates.isna(), NULL_DATE, out)
+
+
+def in_window(events, column, between):
+    start, end = between or (None, None)
+    keep = events[column].notna()
+    if start is not None:
+        keep &= events[column] >= pd.Timestamp(start)
+    if end is not None:
+        keep &= events[column] <= pd.Timestamp(end)
+    return events[keep]
+
+
+def has_prefix(fields, prefixes):
+    """Whether any "||"-separated code of each field starts with a prefix."""
+    return fields.map(
+        lambda field: any(
+            code.startswith(tuple(prefixes)) for code in field.split(SEPARATOR)
+        )
+    ).astype(bool)
+
+
+def years_between(born, on):
+    before_birthday = on.month * 32 + on.day < born.month * 32 + born.day
+    return on.year - born.year - before_birthday
+
+
+def pick(events, column, args, patient_ids):
+    """The first or last matching event of each patient, by patient id."""
+    events = events.sort_values(["patient_id", column], kind="stable")
+    grouped = events.groupby("patient_id")
+    if args.get("find_first_match_in_period"):
+        picked = grouped.head(1)
+    else:
+        picked = grouped.tail(1)
+    return picked.set_index("patient_id").reindex(patient_ids)
+
+
+def returned(picked, column, args, returning=None):
+    returning = returning or args["returning"]
+    if returning == "binary_flag":
+        return picked[column].notna().astype(int).to_numpy()
+    if returning in ("date", "date_admitted", "date_of_death"):
+        return days(picked[column])
+    if returning == "numeric_value":
+        return picked["numeric_value"].to_numpy()
+    if returning == "category":
+        return picked["code"].map(dict(args["codelist"])).fillna("").to_numpy()
+    raise NotImplementedError(returning)
+
+
+def plain_codes(codelist):
+    if getattr(codelist, "has_categories", False):
+        return [code for code, category in codelist]
+    return list(codelist)
+
+
+def clinical_events(raw, args, patient_ids):
+    events = in_window(raw["clinical_events"], "date", args["between"])
+    events = events[events["code"].isin(plain_codes(args["codelist"]))]
+    if args.get("ignore_missing_values"):
+        events = events[events["numeric_value"].notna()]
+    return returned(pick(events, "date", args, patient_ids), "date", args)
+
+
+def medications(raw, args, patient_ids):
+    events = in_window(raw["medications"], "date", args["between"])
+    events = events[events["code"].isin([str(code) for code in args["codelist"]])]
+    return returned(pick(events, "date", args, patient_ids), "date", args)
+
+
+def admissions(raw, args, patient_ids):
+    events = in_window(raw["admissions"], "admission_date", args["between"])
+    events = events[has_prefix(events["diagnoses"], args["with_these_diagnoses"])]
+    picked = pick(events, "admission_date", args, patient_ids)
+    return returned(picked, "admission_date", args)
+
+
+def death_codes(raw, args, patient_ids):
+    events = in_window(raw["ons_deaths"], "date", args["between"])
+    if args.get("match_only_underlying_cause"):
+        field = "underlying_cause"
+    else:
+        field = "causes"
+    events = events[has_prefix(events[field], args["codelist"])]
+    return returned(pick(events, "date", args, patient_ids), "date", args)
+
+
+def deaths(raw, args, patient_ids):
+    events = in_window(raw["ons_deaths"], "date", args["between"])
+    return returned(pick(events, "date", args, patient_ids), "date", args)
+
+
+def bmi_measurements(raw, args, patient_ids):
+    events = in_window(raw["clinical_events"], "date", args["between"])
+    events = events[events["code"].isin(BMI_CODES)]
+    born = raw["patients"].set_index("patient_id")["date_of_birth"]
+    born = pd.DatetimeIndex(events["patient_id"].map(born))
+    age = years_between(born, pd.DatetimeIndex(events["date"]))
+    events = events[age >= args.get("minimum_age_at_measurement", 16)]
+    return pick(events, "date", {}, patient_ids)
+
+
+def age_as_of(raw, args, patient_ids):
+    patients = raw["patients"].set_index("patient_id").reindex(patient_ids)
+    on = pd.Timestamp(args["reference_date"])
+    born = pd.DatetimeIndex(patients["date_of_birth"])
+    return np.asarray(years_between(born, on))
+
+
+def sex(raw, args, patient_ids):
+    patients = raw["patients"].set_index("patient_id").reindex(patient_ids)
+    return patients["sex"].fillna("").to_numpy()
+
+
+def current(raw, name, day):
+    spells = raw[name]
+    day = pd.Timestamp(day)
+    spells = spells[(spells["start_date"] <= day) & (spells["end_date"] >= day)]
+    return spells.sort_values(["patient_id", "start_date"], kind="stable")
+
+
+def registered_practice_as_of(raw, args, patient_ids):
+    spells = current(raw, "registrations", args["date"])
+    picked = spells.groupby("patient_id").tail(1).set_index("patient_id")
+    return picked["region"].reindex(patient_ids).fillna("").to_numpy()
+
+
+def address_as_of(raw, args, patient_ids):
+    spells = current(raw, "addresses", args["date"])
+    picked = spells.groupby("patient_id").tail(1).set_index("patient_id")
+    imd = picked["imd"].reindex(patient_ids)
+    nearest = args["round_to_nearest"]
+    imd = np.floor(imd / nearest + 0.5) * nearest
+    return imd.fillna(-1).astype(int).to_numpy()
+
+
+def registered_with_one_practice_between(raw, args, patient_ids):
+    spells = raw["registrations"]
+    covered = spells[
+        (spells["start_date"] <= pd.Timestamp(args["start_date"]))
+        & (spells["end_date"] >= pd.Timestamp(args["end_date"]))
+    ]
+    return np.isin(patient_ids, covered["patient_id"]).astype(int)
+
+
+REFERENCES = {
+    "with_these_clinical_events": clinical_events,
+    "with_these_medications": medications,
+    "admitted_to_hospital": admissions,
+    "with_these_codes_on_death_certificate": death_codes,
+    "died_from_any_cause": deaths,
+    "age_as_of": age_as_of,
+    "sex": sex,
+    "registered_practice_as_of": registered_practice_as_of,
+    "address_as_of": address_as_of,
+    "registered_with_one_practice_between": registered_with_one_practice_between,
+}
+
+
+def assert_same(got, expected):
+    if np.asarray(expected).dtype == object:
+        assert list(np.asarray(got, dtype=object)) == list(expected)
+    else:
+        np.testing.assert_array_equal(
+            np.asarray(got, dtype="float64"), np.asarray(expected, dtype="float64")
+        )
+
+
+def referenced_variables():
+    from study_definition import study
+
+    return [
+        name
+        for name, (query_type, args) in study.covariate_definitions.items()
+        if query_type in REFERENCES
+    ]
+
+
+@pytest.mark.parametrize("name", referenced_variables())
+def test_matches_naive_reference(study, tables, extracted, raw, name):
+    query_type, args = study.covariate_definitions[name]
+    expected = REFERENCES[query_type](raw, args, tables.patient_ids)
+    assert_same(extracted[name], expected)
+
+
+def test_most_recent_bmi_and_its_date(study, raw_with_bmi):
+    definitions = {
+        name: study.covariate_definitions[name] for name in ["bmi", "bmi_date_measured"]
+    }
+    tables = EventTables(raw_with_bmi)
+    results = LocalExtractor(definitions, tables).run(1)
+    query_type, args = definitions["bmi"]
+    picked = bmi_measurements(raw_with_bmi, args, tables.patient_ids)
+    assert picked["numeric_value"].notna().any()
+    assert_same(results["bmi"], picked["numeric_value"].to_numpy())
+    assert_same(results["bmi_date_measured"], days(picked["date"]))
+
+
+def test_extract_keeps_the_population(study, tables, extracted):
+    population = LocalExtractor(study.covariate_definitions, tables).extract(1)
+    in_population = extracted["population"].astype(bool)
+    assert list(population["patient_id"]) == list(tables.patient_ids[in_population])
+
+
+@pytest.mark.parametrize(
+    "argument",
+    [
+        ("ignore_days_where_these_codes_occur", ["XaIqq"]),
+        ("episode_defined_as", "series_ended_date - 14 days"),
+    ],
+)
+def test_refuses_unsupported_event_arguments(study, tables, argument):
+    definitions = dict(study.covariate_definitions)
+    query_type, args = definitions["hypertension"]
+    definitions["hypertension"] = (query_type, dict(args, **dict([argument])))
+    with pytest.raises(NotImplementedError, match=argument[0]):
+        LocalExtractor(definitions, tables).run(1)
+
+
+def test_windows_relative_to_another_variable(study, tables, raw):
+    from cohortextractor import StudyDefinition, patients
+
+    definitions = study.covariate_definitions
+    metformin = definitions["metformin_3mths"][1]["codelist"]
+    hypertension = definitions["hypertension"][1]["codelist"]
+    relative = StudyDefinition(
+        default_expectations={"date": {"earliest": "1900-01-01", "latest": "today"}},
+        index_date="2020-09-01",
+        population=patients.registered_with_one_practice_between(
+            "2019-09-01", "2020-09-01"
+        ),
+        met_date=patients.with_these_medications(
+            metformin,
+            between=["2020-01-01", "index_date"],
+            returning="date",
+            find_first_match_in_period=True,
+            date_format="YYYY-MM-DD",
+        ),
+        htn=patients.with_these_clinical_events(
+            hypertension,
+            between=["met_date - 1 year", "met_date"],
+            returning="number_of_matches_in_period",
+        ),
+        htn_last=patients.with_these_clinical_events(
+            hypertension,
+            between=["first_day_of_month(met_date) - 3 months", "met_date + 10 days"],
+            returning="date",
+            find_last_match_in_period=True,
+            date_format="YYYY-MM-DD",
+        ),
+        age_at_met=patients.age_as_of("met_date"),
+    )
+    results = LocalExtractor(relative.covariate_definitions, tables).run(1)
+
+    ids = tables.patient_ids
+    medications = in_window(raw["medications"], "date", ["2020-01-01", "2020-09-01"])
+    medications = medications[medications["code"].isin(map(str, metformin))]
+    met_date = medications.groupby("patient_id")["date"].min().rename("met_date")
+    events = raw["clinical_events"]
+    events = events[events["code"].isin(list(hypertension))].merge(
+        met_date, left_on="patient_id", right_index=True
+    )
+    in_year = (events["date"] >= events["met_date"] - pd.DateOffset(years=1)) & (
+        events["date"] <= events["met_date"]
+    )
+    count = events[in_year].groupby("patient_id").size().reindex(ids, fill_value=0)
+    start = events["met_date"].dt.to_period("M").dt.to_timestamp()
+    in_months = (events["date"] >= start - pd.DateOffset(months=3)) & (
+        events["date"] <= events["met_date"] + pd.Timedelta(days=10)
+    )
+    last = events[in_months].groupby("patient_id")["date"].max().reindex(ids)
+    born = raw["patients"].set_index("patient_id")["date_of_birth"].reindex(ids)
+    on = met_date.reindex(ids).fillna(born)
+    age = years_between(pd.DatetimeIndex(born), pd.DatetimeIndex(on))
+
+    assert count.sum() > 0
+    assert_same(results["met_date"], days(met_date.reindex(ids)))
+    assert_same(results["htn"], count.to_numpy())
+    assert_same(results["htn_last"], days(last))
+    assert_same(results["age_at_met"], np.where(met_date.reindex(ids).isna(), 0, age))
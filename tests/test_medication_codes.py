@@ -0,0 +1,55 @@
+"""
+Integer dm+d codelists against matching the code strings with isin.
+"""
+
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import codelists as study_codelists
+from medication_codes import DRUG_CLASSES, IntegerCodelists, class_names, drug_classes
+
+
+@pytest.fixture(scope="module")
+def codes(table_directory):
+    medications = pd.read_feather(os.path.join(table_directory, "medications.feather"))
+    # Missing, non-numeric and too long codes are in no codelist
+    extra = [None, "", "not a code", "1" * 19]
+    return pd.Series(list(medications["code"]) + extra, dtype=object)
+
+
+def isin_reference(codes, codelists):
+    return np.column_stack(
+        [codes.isin([str(code) for code in codelist]) for codelist in codelists]
+    )
+
+
+def test_match_equals_isin(study, codes):
+    medication_codelists = [
+        args["codelist"]
+        for query_type, args in study.covariate_definitions.values()
+        if query_type == "with_these_medications"
+    ] + [[]]
+    expected = isin_reference(codes, medication_codelists)
+    assert expected.any()
+    got = IntegerCodelists(medication_codelists).match(codes.to_numpy())
+    np.testing.assert_array_equal(got, expected)
+
+
+def test_drug_classes_are_bitmasks_of_the_classes(codes):
+    classes = [getattr(study_codelists, name) for name in DRUG_CLASSES.values()]
+    members = isin_reference(codes, classes)
+    masks = drug_classes(codes.to_numpy())
+    assert masks.dtype == "uint8"
+    for j in range(len(DRUG_CLASSES)):
+        np.testing.assert_array_equal((masks >> j & 1).astype(bool), members[:, j])
+
+
+def test_class_names():
+    assert class_names(0) == ""
+    assert class_names(0b11) == "metformin+dpp4i"
+    assert class_names(1 << list(DRUG_CLASSES).index("antidiabetic")) == (
+        "antidiabetic"
+    )
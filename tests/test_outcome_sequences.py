@@ -0,0 +1,104 @@
+"""
+Outcome sequences against ordering each patient's outcomes one row at a
+time.
+"""
+
+import math
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from derive_cohort import OUTCOME_SEQUENCES, derive_outcomes
+from outcome_sequences import (
+    SEQUENCE_OUTCOMES,
+    outcome_sequence,
+    sequence_codes,
+    sequence_label,
+)
+
+ROWS = 5000
+
+
+def random_outcomes(rng, outcomes):
+    """Outcomes on a few dates, so that many are on the same one."""
+    df = pd.DataFrame(index=range(ROWS))
+    for date_column, flag_column in outcomes.values():
+        days = pd.to_timedelta(rng.integers(0, 4, ROWS), unit="D")
+        dates = pd.Series(pd.Timestamp("2020-09-01") + days)
+        df[date_column] = dates.where(rng.random(ROWS) < 0.5)
+        if flag_column is not None:
+            # Flags with no date, and dates with no flag
+            flag = df[date_column].notna() | (rng.random(ROWS) < 0.1)
+            flag[rng.random(ROWS) < 0.05] = False
+            df[flag_column] = flag.astype("int8")
+    return df
+
+
+def row_outcomes(row, outcomes):
+    """name: sort key of each outcome the row had, undated ones last."""
+    had = {}
+    for name, (date_column, flag_column) in outcomes.items():
+        date = row[date_column]
+        if flag_column is None and pd.isna(date):
+            continue
+        if flag_column is not None and row[flag_column] != 1:
+            continue
+        had[name] = math.inf if pd.isna(date) else date.value
+    return had
+
+
+def row_label(had):
+    if not had:
+        return "none"
+    keys = sorted(set(had.values()))
+    return "_".join(
+        "=".join(name for name in had if had[name] == key) for key in keys
+    )
+
+
+def is_sequence(had, sequence):
+    """Whether the row had just these outcomes, each on or after the last."""
+    if set(had) != set(sequence):
+        return False
+    return all(had[a] <= had[b] for a, b in zip(sequence, sequence[1:]))
+
+
+@pytest.fixture(scope="module")
+def outcomes():
+    return random_outcomes(np.random.default_rng(1), SEQUENCE_OUTCOMES)
+
+
+def test_sequences_equal_ordering_each_row(outcomes):
+    codes = outcome_sequence(outcomes)
+    for (_, row), code in zip(outcomes.iterrows(), codes):
+        assert sequence_label(code) == row_label(row_outcomes(row, SEQUENCE_OUTCOMES))
+    # Every order, with ties, of every set of the three outcomes
+    assert codes.nunique() == 1 + 3 * 1 + 3 * 3 + 13
+
+
+def test_another_outcome(outcomes):
+    more = dict(SEQUENCE_OUTCOMES, icu=("icu_date", None))
+    df = outcomes.copy()
+    icu = random_outcomes(np.random.default_rng(2), {"icu": more["icu"]})
+    df["icu_date"] = icu["icu_date"]
+    names = tuple(more)
+    codes = outcome_sequence(df, more)
+    for (_, row), code in zip(df.iterrows(), codes):
+        assert sequence_label(code, names) == row_label(row_outcomes(row, more))
+
+
+def test_outcome_flags_equal_ordering_each_row(outcomes):
+    df = derive_outcomes(outcomes.copy())
+    for name, sequence in OUTCOME_SEQUENCES.items():
+        expected = []
+        for _, row in outcomes.iterrows():
+            had = row_outcomes(row, SEQUENCE_OUTCOMES)
+            expected.append(int(is_sequence(had, sequence)))
+        assert sum(expected) > 0, name
+        assert df[name].tolist() == expected, name
+
+
+def test_too_many_outcomes():
+    with pytest.raises(ValueError, match="outcomes"):
+        sequence_codes(np.zeros((1, 20), dtype="int64"))
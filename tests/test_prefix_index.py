@@ -0,0 +1,80 @@
+"""
+The ICD-10 prefix index against matching each code with str.startswith.
+"""
+
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from prefix_index import SEPARATOR, PrefixIndex
+
+LETTERS = list("ABCEIJUZ")
+
+CODELISTS = [
+    ["E11", "E110", "E119"],
+    ["U071", "U072"],
+    None,
+    ["I", "J4"],
+    ["A0", "Z999", "B12"],
+    [],
+    [""],
+]
+
+
+def startswith_reference(fields, codelists):
+    tags = np.ones((len(fields), len(codelists)), dtype=bool)
+    codes = pd.Series(fields, dtype=object).fillna("")
+    codes = codes.str.split(SEPARATOR, regex=False).explode()
+    for j, prefixes in enumerate(codelists):
+        if prefixes is None:
+            continue
+        matched = codes.str.startswith(tuple(prefixes)).fillna(False).astype(bool)
+        tags[:, j] = (
+            matched.groupby(level=0).any().reindex(range(len(fields)), fill_value=False)
+        )
+    return tags
+
+
+def random_fields(n, seed=0):
+    """n fields of 1 to 5 codes of three or four characters, and edge cases."""
+    rng = np.random.default_rng(seed)
+    pool = [
+        f"{letter}{number:02d}{'' if fourth < 0 else fourth}"
+        for letter, number, fourth in zip(
+            rng.choice(LETTERS, 3000),
+            rng.integers(0, 100, 3000),
+            rng.integers(-10, 10, 3000),
+        )
+    ]
+    codes = rng.choice(pool, (n, 5))
+    lengths = rng.integers(1, 6, n)
+    fields = [SEPARATOR.join(row[:length]) for row, length in zip(codes, lengths)]
+    return fields + [None, "", "U071"]
+
+
+def test_matches_startswith():
+    fields = random_fields(20_000)
+    expected = startswith_reference(fields, CODELISTS)
+    assert expected[:, 0].any() and not expected[:, 0].all()
+    np.testing.assert_array_equal(PrefixIndex(CODELISTS).match_fields(fields), expected)
+
+
+def test_admissions_with_the_study_codelists(study, table_directory):
+    admissions = pd.read_feather(os.path.join(table_directory, "admissions.feather"))
+    fields = list(admissions["diagnoses"])
+    codelists = [
+        list(args["with_these_diagnoses"])
+        for query_type, args in study.covariate_definitions.values()
+        if query_type == "admitted_to_hospital"
+    ]
+    expected = startswith_reference(fields, codelists)
+    assert expected.any()
+    np.testing.assert_array_equal(PrefixIndex(codelists).match_fields(fields), expected)
+
+
+@pytest.mark.parametrize("fields", [[], [None]])
+def test_shape(fields):
+    tags = PrefixIndex([["E11"], None]).match_fields(fields)
+    assert tags.shape == (len(fields), 2)
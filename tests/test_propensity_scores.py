@@ -0,0 +1,135 @@
+"""
+Propensity scores against a dense multinomial logit fitted by plain
+Newton-Raphson in double precision.
+"""
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import propensity_scores
+from propensity_scores import (
+    EXPOSURE,
+    MAIN,
+    SPECIFICATIONS,
+    PropensityModel,
+    derivatives,
+    design_matrix,
+    fit_specification,
+)
+
+
+def dense_mlogit(design, outcome, k):
+    """The probability of each of k outcomes, the first being the base."""
+    x = design.toarray()
+    n, d = x.shape
+    y = np.eye(k)[outcome]
+    beta = np.zeros((d, k - 1))
+    for _ in range(50):
+        eta = np.column_stack([np.zeros(n), x @ beta])
+        p = np.exp(eta - np.logaddexp.reduce(eta, axis=1, keepdims=True))
+        gradient = (x.T @ (p - y)[:, 1:]).ravel()
+        hessian = np.zeros((d * (k - 1), d * (k - 1)))
+        for a in range(k - 1):
+            for b in range(k - 1):
+                weight = p[:, a + 1] * ((a == b) - p[:, b + 1])
+                hessian[a :: k - 1, b :: k - 1] = (x * weight[:, None]).T @ x
+        step = np.linalg.solve(hessian, gradient).reshape(d, k - 1)
+        beta -= step
+        if np.abs(step).max() < 1e-12:
+            break
+    eta = np.column_stack([np.zeros(n), x @ beta])
+    return np.exp(eta - np.logaddexp.reduce(eta, axis=1, keepdims=True))
+
+
+@pytest.fixture(scope="module")
+def df(analysis_dataset):
+    df = analysis_dataset
+    return df[df[EXPOSURE].notna()].reset_index(drop=True)
+
+
+def test_design_matrix_is_one_hot(df):
+    categorical = ["male", "ethnicity", "imd"]
+    design, columns, complete = design_matrix(df, categorical, ["age1"])
+    used = df[complete]
+    dummies = pd.get_dummies(used[categorical].astype("Int64").astype(str))
+    expected = dummies.drop(
+        columns=[f"{name}_{min(used[name].dropna()):g}" for name in categorical]
+    )
+    dense = design.toarray()
+    np.testing.assert_array_equal(dense[:, 0], 1)
+    np.testing.assert_array_equal(dense[:, 1:-1], expected.to_numpy(dtype=float))
+    age = used["age1"].to_numpy()
+    np.testing.assert_allclose(dense[:, -1], (age - age.mean()) / age.std())
+    assert columns[0] == "_cons" and columns[-1] == "age1"
+    assert complete.sum() == df[categorical + ["age1"]].notna().all(axis=1).sum()
+
+
+def test_main_equals_a_dense_fit(df):
+    model, scores = fit_specification(df, "main", MAIN)
+    assert model.converged
+    categorical = [c for c in MAIN["categorical"] if c in df]
+    design, _, complete = design_matrix(df, categorical, MAIN["continuous"])
+    exposures = np.sort(df[EXPOSURE][complete].unique())
+    outcome = np.searchsorted(exposures, df[EXPOSURE][complete].to_numpy())
+    expected = dense_mlogit(design, outcome, len(exposures))
+
+    got = scores[[f"main_p{int(e)}" for e in exposures]].to_numpy()
+    assert np.isnan(got[~complete]).all()
+    np.testing.assert_allclose(got[complete], expected, atol=1e-6)
+    ipw = scores["main_ipw"].to_numpy()[complete]
+    np.testing.assert_allclose(
+        ipw, 1 / expected[np.arange(len(outcome)), outcome], rtol=1e-5
+    )
+
+
+def test_warm_starts_reach_the_same_fit(df):
+    main, _ = fit_specification(df, "main", MAIN)
+    for name, specification in list(SPECIFICATIONS.items())[1:]:
+        cold, cold_scores = fit_specification(df, name, specification)
+        warm, warm_scores = fit_specification(df, name, specification, main)
+        assert cold.converged and warm.converged, name
+        assert warm.log_likelihood == pytest.approx(cold.log_likelihood), name
+        # Each fit stops once within TOLERANCE of the maximum
+        pd.testing.assert_frame_equal(warm_scores, cold_scores, rtol=1e-4)
+
+
+def test_propensity_scores(df):
+    models, scores = propensity_scores.propensity_scores(df, workers=2)
+    assert [model.specification for model in models] == list(SPECIFICATIONS)
+    assert scores["patient_id"].tolist() == df["patient_id"].tolist()
+    for model in models:
+        p = scores.filter(regex=f"^{model.specification}_p").to_numpy()
+        scored = ~np.isnan(p).any(axis=1)
+        assert scored.any()
+        np.testing.assert_allclose(p[scored].sum(axis=1), 1)
+
+
+def test_hessian_equals_dense_products(df):
+    design, _, complete = design_matrix(df, ["male", "imd"], ["age1"])
+    outcome = np.searchsorted([1, 2, 3, 4], df[EXPOSURE][complete].to_numpy())
+    coefficients = np.random.default_rng(0).normal(0, 0.1, (design.shape[1], 3))
+    _, _, hessian = derivatives(design, outcome, coefficients)
+
+    x = design.toarray()
+    eta = np.column_stack([np.zeros(len(x)), x @ coefficients])
+    p = np.exp(eta - np.logaddexp.reduce(eta, axis=1, keepdims=True))[:, 1:]
+    d = x.shape[1]
+    for a in range(3):
+        for b in range(3):
+            weight = p[:, a] * ((a == b) - p[:, b])
+            np.testing.assert_allclose(
+                hessian.reshape(d, 3, d, 3)[:, a, :, b],
+                -(x * weight[:, None]).T @ x,
+                atol=1e-8,
+            )
+
+
+def test_fit_stops_where_no_step_raises_the_likelihood(df, monkeypatch):
+    design, columns, complete = design_matrix(df, ["male", "imd"], ["age1"])
+    outcome = np.searchsorted([1, 2, 3, 4], df[EXPOSURE][complete].to_numpy())
+    monkeypatch.setattr(propensity_scores, "log_likelihood", lambda *args: -np.inf)
+    model = PropensityModel("main", columns, [1, 2, 3, 4]).fit(design, outcome)
+    assert not model.converged
+    assert model.iterations == 0
+    np.testing.assert_array_equal(model.coefficients, 0)
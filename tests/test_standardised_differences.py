@@ -0,0 +1,85 @@
+"""
+Standardised differences against computing each pair of groups directly
+from its patients, as stddiff does.
+"""
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from aggregates import Aggregates
+from standardised_differences import (
+    CATEGORICAL,
+    CONTINUOUS,
+    GROUPS,
+    group_pairs,
+    standardised_differences,
+)
+
+
+def direct_differences(df):
+    """The difference of each variable for each pair, from the two groups."""
+    categorical = [c for c in CATEGORICAL if c in df]
+    continuous = [c for c in CONTINUOUS if c in df]
+    differences = {}
+    for first, second in group_pairs():
+        a, b = df[df["exp"] == first], df[df["exp"] == second]
+        pair = f"{GROUPS[first]} v {GROUPS[second]}"
+        for name in continuous:
+            x, y = a[name].dropna(), b[name].dropna()
+            differences[name, pair] = (x.mean() - y.mean()) / np.sqrt(
+                (x.var() + y.var()) / 2
+            )
+        for name in categorical:
+            if not (a[name].notna().any() and b[name].notna().any()):
+                differences[name, pair] = np.nan
+                continue
+            categories = sorted(df[name].dropna().unique())
+            p_a = np.array([(a[name] == c).sum() for c in categories])
+            p_b = np.array([(b[name] == c).sum() for c in categories])
+            p_a = p_a[1:] / a[name].notna().sum()
+            p_b = p_b[1:] / b[name].notna().sum()
+            s = np.diag(p_a) - np.outer(p_a, p_a) + np.diag(p_b) - np.outer(p_b, p_b)
+            d = p_a - p_b
+            differences[name, pair] = np.sqrt(d @ np.linalg.pinv(s / 2) @ d)
+    return differences
+
+
+def of(df, weights=None):
+    return standardised_differences(
+        Aggregates.of(
+            df,
+            "exp",
+            categorical=[c for c in CATEGORICAL if c in df],
+            continuous=[c for c in CONTINUOUS if c in df],
+            weights=weights,
+        )
+    ).set_index("variable")
+
+
+def test_differences_equal_each_pair(analysis_dataset):
+    table = of(analysis_dataset)
+    expected = direct_differences(analysis_dataset)
+    assert set(expected) == {
+        (name, pair) for name in table.index for pair in table.columns[1:]
+    }
+    for (name, pair), difference in expected.items():
+        got = table.loc[name, pair]
+        assert got == pytest.approx(difference, rel=1e-9, nan_ok=True), (name, pair)
+
+
+def test_binary_difference(analysis_dataset):
+    table = of(analysis_dataset)
+    a = analysis_dataset.loc[analysis_dataset["exp"] == 1, "male"].mean()
+    b = analysis_dataset.loc[analysis_dataset["exp"] == 2, "male"].mean()
+    expected = abs(a - b) / np.sqrt((a * (1 - a) + b * (1 - b)) / 2)
+    assert table.loc["male", "SGLT2i v DPP4i"] == pytest.approx(expected)
+
+
+def test_weights_equal_replicating_patients(analysis_dataset):
+    df = analysis_dataset.copy()
+    df["weight"] = np.random.default_rng(0).integers(1, 4, len(df))
+    replicated = df.loc[df.index.repeat(df["weight"])]
+    pd.testing.assert_frame_equal(
+        of(df, weights="weight"), of(replicated), rtol=1e-9
+    )
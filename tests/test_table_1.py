@@ -0,0 +1,67 @@
+"""
+Table 1 against counting each cell separately, as the do-file's safecount
+and safetab do.
+"""
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from aggregates import Aggregates
+from derive_cohort import LABELS
+from table_1 import GROUPS, LABELLED, SECTIONS, SMALL_COUNT, VARIABLES, table_1
+
+
+def small(n):
+    return 0 < n <= SMALL_COUNT
+
+
+def naive_table_1(df, redact_tables=False):
+    """One row per cell, with each count redacted as it is counted."""
+    sizes = [(df["exp"] == g).sum() for g in GROUPS]
+    rows = [["N", " - "] + [np.nan if small(n) else n for n in sizes]]
+    for section, names in SECTIONS.items():
+        rows.append([section, ""] + [np.nan] * len(GROUPS))
+        for name in names:
+            if name not in df:
+                continue
+            categories = sorted(df[name].dropna().unique())
+            cells = {
+                c: [((df[name] == c) & (df["exp"] == g)).sum() for g in GROUPS]
+                for c in categories
+            }
+            redact_all = redact_tables and any(
+                small(n) for counts in cells.values() for n in counts
+            )
+            labels = LABELS[name] if name in LABELLED else {}
+            for c in categories:
+                if c == 0:
+                    continue
+                counts = [
+                    np.nan if redact_all or small(n) else n for n in cells[c]
+                ]
+                rows.append([name if c == 1 else "", labels.get(c, "")] + counts)
+
+    table = pd.DataFrame(rows, columns=["variable", "category"] + list(GROUPS))
+    columns = {"variable": table["variable"], "category": table["category"]}
+    for group, name in GROUPS.items():
+        counts = table[group].astype("float64")
+        columns[name] = counts
+        columns[f"{name}_perc"] = np.floor(1000 * counts / counts.iloc[0] + 0.5) / 10
+    return pd.DataFrame(columns)
+
+
+@pytest.mark.parametrize("redact_tables", [False, True])
+@pytest.mark.parametrize("rows", [None, 400])
+def test_table_1_equals_counting_each_cell(analysis_dataset, rows, redact_tables):
+    # A few hundred patients leave small counts to redact
+    df = analysis_dataset
+    if rows is not None:
+        df = df.sample(rows, random_state=0)
+    aggregates = Aggregates.of(df, "exp", categorical=[c for c in VARIABLES if c in df])
+    got = table_1(aggregates, redact_tables=redact_tables)
+    expected = naive_table_1(df, redact_tables)
+    if rows is not None:
+        cells = got[~got["variable"].isin(SECTIONS)][list(GROUPS.values())]
+        assert cells.isna().to_numpy().any()
+    pd.testing.assert_frame_equal(got, expected, check_dtype=False)
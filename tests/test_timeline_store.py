@@ -0,0 +1,74 @@
+"""
+The memory-mapped timeline store against the local extractor.
+"""
+
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from event_tables import format_dates
+from timeline_store import STORE_QUERIES, TimelineStore, build_store
+
+
+@pytest.fixture(scope="module")
+def store(tables, tmp_path_factory):
+    directory = str(tmp_path_factory.mktemp("timelines"))
+    build_store(tables, directory)
+    return TimelineStore(directory)
+
+
+def test_variables_equal_the_extractor(study, tables, extracted, store):
+    assert list(store.patient_ids) == list(tables.patient_ids)
+    variables = store.variables(study.covariate_definitions)
+    assert set(variables) == {
+        name
+        for name, (query_type, args) in study.covariate_definitions.items()
+        if query_type in STORE_QUERIES
+    }
+    for name, values in variables.items():
+        expected = extracted[name]
+        if values.dtype.kind == "f":
+            np.testing.assert_array_equal(values, expected)
+        else:
+            assert list(values) == list(expected), name
+
+
+def test_patients_functions(study, tables, extracted, store, table_directory):
+    codelists = {
+        name: args.get("codelist") or args.get("with_these_diagnoses")
+        for name, (query_type, args) in study.covariate_definitions.items()
+    }
+    admitted = store.admitted_to_hospital(
+        with_these_diagnoses=codelists["hospitalised_covid"],
+        on_or_after="2020-09-01",
+        returning="date_admitted",
+        date_format="YYYY-MM-DD",
+        find_first_match_in_period=True,
+    )
+    assert list(admitted) == list(format_dates(extracted["hospitalised_covid_date"]))
+
+    counts = store.with_these_clinical_events(
+        codelists["hypertension"],
+        on_or_before="2020-09-01",
+        returning="number_of_matches_in_period",
+    )
+    events = pd.read_feather(os.path.join(table_directory, "clinical_events.feather"))
+    events = events[
+        events["code"].isin(list(codelists["hypertension"]))
+        & (events["date"] <= pd.Timestamp("2020-09-01"))
+    ]
+    expected = events.groupby("patient_id").size().reindex(tables.patient_ids)
+    assert counts.sum() > 0
+    assert list(counts) == list(expected.fillna(0).astype(int))
+
+
+def test_refuses_queries_it_does_not_hold(store):
+    with pytest.raises(NotImplementedError):
+        store.query("age_as_of", {"reference_date": "2020-09-01"})
+    with pytest.raises(NotImplementedError, match="episode_defined_as"):
+        store.query(
+            "with_these_clinical_events",
+            {"codelist": ["XaIqq"], "episode_defined_as": "series_ended_date"},
+        )